@@ -1,5 +1,6 @@
 # Author-
 # Description-
+import bisect
 import os
 import re
 import json
@@ -13,6 +14,9 @@ def poly_area(x: np.ndarray, y: np.ndarray) -> float:
 
 
 def contour_area(c: Dict, scale=1.0) -> float:
+    # Precomputed at extraction time by newer exports
+    if "metadata" in c:
+        return scale * scale * abs(c["metadata"]["area"])
     return poly_area(
         x=scale * np.array([v[0] for v in c["simplified"]]),
         y=scale * np.array([v[1] for v in c["simplified"]]),
@@ -56,6 +60,34 @@ def bb_iou(bb1: adsk.core.BoundingBox3D, bb2: adsk.core.BoundingBox3D) -> float:
     return iou
 
 
+def find_ring_role(
+    ring_bbs: List[Tuple[float, float, float, float, str]],
+    bb: adsk.core.BoundingBox3D,
+    tolerance: float = 1e-4,
+) -> str:
+    # The role of the ring whose bounding box matches bb (within tolerance), "" if none.
+    # ring_bbs is sorted by min x, so candidates are found by a binary search.
+    min_x, min_y, max_x, max_y = (
+        bb.minPoint.x,
+        bb.minPoint.y,
+        bb.maxPoint.x,
+        bb.maxPoint.y,
+    )
+    start = bisect.bisect_left(ring_bbs, (min_x - tolerance,))
+    end = bisect.bisect_right(ring_bbs, (min_x + tolerance, float("inf")))
+    roles = [
+        r[4]
+        for r in ring_bbs[start:end]
+        if abs(r[1] - min_y) <= tolerance
+        and abs(r[2] - max_x) <= tolerance
+        and abs(r[3] - max_y) <= tolerance
+    ]
+    # Prefer the exterior, if a hole shares its bounding box
+    if "outer" in roles:
+        return "outer"
+    return roles[0] if roles else ""
+
+
 def get_numbers_from_filename(filename: str) -> str:
     return re.search(r"\d+", filename).group(0)
 
@@ -195,7 +227,26 @@ def run(context):
                 for hole in contour["holes"]:
                     add_contour(hole)
 
+            # Bounding boxes (in sketch space, y is flipped, see vert2point) and roles of
+            # all rings from the exported metadata, sorted by min x
+            rings = [ring for c in contours for ring in [c, *c["holes"]]]
+            has_metadata = all("metadata" in ring for ring in rings)
+            s = contour_import_size_param.value
+            ring_bbs = sorted(
+                (
+                    s * ring["metadata"]["bbox"][0],
+                    -s * ring["metadata"]["bbox"][3],
+                    s * ring["metadata"]["bbox"][2],
+                    -s * ring["metadata"]["bbox"][1],
+                    ring["metadata"]["role"],
+                )
+                for ring in (rings if has_metadata else [])
+            )
+
             def is_outer(p, tolerance: float = 0.01) -> bool:
+                if has_metadata:
+                    return find_ring_role(ring_bbs, p.boundingBox) == "outer"
+                # Older exports, match outer contours by the overlap of bounding boxes
                 for bb in outer_contour_bounding_boxes:
                     if bb_iou(p.boundingBox, bb) >= (1 - tolerance):
                         return True
@@ -0,0 +1,173 @@
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Collection, Dict, List, Optional
+
+# Intermediates of an export, each computed from the previous one
+INTERMEDIATES = ("quantized", "layer_mask", "smoothed_mask", "contours")
+
+
+@dataclass(frozen=True)
+class Artifact:
+    # Path of the output, relative to the directory it's exported to. Per-layer outputs
+    # are formatted w/ {layer_idx}.
+    path: str
+    # The last intermediate it's rendered from, see INTERMEDIATES
+    requires: str
+    # Rough cost of rendering + writing it per output, relative to a layer's contour JSON
+    # (ie: excl. the cost of its intermediate). Measured on the FullBay100 grid.
+    cost: float
+
+
+# Outputs of export_quantize_results
+EXPORT_ARTIFACTS: Dict[str, Artifact] = {
+    "depth_map_quantized": Artifact("depth_map_quantized.png", "quantized", 1),
+    "quantized_depth_values": Artifact("quantized_depth_values.json", "quantized", 0),
+    "layer_mask": Artifact("layer_masks/layer_{layer_idx}.jpg", "layer_mask", 0.1),
+    "layer_mask_smoothed": Artifact(
+        "layer_masks/layer_{layer_idx}_smoothed.jpg", "smoothed_mask", 0.1
+    ),
+    "contours_json": Artifact(
+        "layer_masks/layer_{layer_idx}_contours.json", "contours", 1
+    ),
+    "contours_binary": Artifact(
+        "layer_masks/layer_{layer_idx}_contours", "contours", 0.5
+    ),
+    # A 12x12in matplotlib figure
+    "contours_viz": Artifact(
+        "layer_masks/layer_{layer_idx}_contours_viz.jpg", "contours", 50
+    ),
+    "contours_overlay": Artifact(
+        "layer_masks/layer_{layer_idx}_contours.jpg", "contours", 0.5
+    ),
+}
+# Outputs of scripts/quantize.py, on top of those of the export
+SCRIPT_ARTIFACTS: Dict[str, Artifact] = {
+    "histogram": Artifact("histogram.jpg", "quantized", 10),
+    "depth_map_raw": Artifact("depth_map_raw.png", "quantized", 1),
+    # 1000 dpi
+    "depth_map_raw_plot": Artifact("depth_map_raw_plot.jpg", "quantized", 40),
+    "depth_map_quantized_plot": Artifact(
+        "depth_map_quantized_plot.jpg", "quantized", 40
+    ),
+    # 500 dpi 3D plots
+    "separated_contours": Artifact("separated_contours.jpg", "quantized", 20),
+    "separated_contours_inverted": Artifact(
+        "separated_contours_inverted.jpg", "quantized", 20
+    ),
+}
+ARTIFACTS: Dict[str, Artifact] = {**EXPORT_ARTIFACTS, **SCRIPT_ARTIFACTS}
+# Everything but the binary contours, as exported before artifacts were selectable
+DEFAULT_ARTIFACTS = tuple(name for name in ARTIFACTS if name != "contours_binary")
+# What a CAD import (see fusion360/) needs
+CAD_ARTIFACTS = ("contours_json",)
+
+
+def needs_intermediate(artifacts: Collection[str], intermediate: str) -> bool:
+    # Whether any of the artifacts is rendered from the intermediate (or a later one)
+    level = INTERMEDIATES.index(intermediate)
+    return any(
+        INTERMEDIATES.index(ARTIFACTS[name].requires) >= level for name in artifacts
+    )
+
+
+def estimate_cost(artifacts: Collection[str], n_layers: int) -> float:
+    # Relative cost of rendering + writing the artifacts, see Artifact.cost
+    return sum(
+        ARTIFACTS[name].cost
+        * (n_layers if "{layer_idx}" in ARTIFACTS[name].path else 1)
+        for name in artifacts
+    )
+
+
+def _path_size(path: Path) -> int:
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size
+
+
+class ArtifactManifest:
+    # Records the artifacts produced (w/ their size and the time taken to render + write
+    # them) and the time spent on intermediates. Safe to record from writer threads.
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.artifacts: List[Dict] = []
+        self.stages: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def record_artifact(self, name: str, path: Path, seconds: float) -> None:
+        entry = {
+            "artifact": name,
+            "path": os.path.relpath(path, self.root),
+            "bytes": _path_size(Path(path)),
+            "seconds": seconds,
+        }
+        with self._lock:
+            self.artifacts.append(entry)
+
+    def record_stage(
+        self,
+        stage: str,
+        seconds: float,
+        layer_idx: Optional[int] = None,
+        cached: bool = False,
+    ) -> None:
+        # cached: loaded from the stage cache rather than computed
+        entry = {
+            "stage": stage,
+            "layer_idx": layer_idx,
+            "seconds": seconds,
+            "cached": cached,
+        }
+        with self._lock:
+            self.stages.append(entry)
+
+    def timed_write(
+        self,
+        name: str,
+        path: Path,
+        write: Callable[[], None],
+        render_seconds: float = 0.0,
+    ) -> Callable[[], None]:
+        # Wraps a write to record its artifact once written. render_seconds: time already
+        # spent preparing it (ex: building a figure), added to that of the write.
+        def _write():
+            start = time.perf_counter()
+            write()
+            self.record_artifact(
+                name, path, render_seconds + time.perf_counter() - start
+            )
+
+        return _write
+
+    def merge(self, artifacts: List[Dict], stages: List[Dict]) -> None:
+        # Records made elsewhere (ex: by a worker process), relative to the same root
+        with self._lock:
+            self.artifacts.extend(artifacts)
+            self.stages.extend(stages)
+
+    def write(self, path: Optional[Path] = None) -> Path:
+        # Sorted, so the manifest's layout doesn't depend on the order of writes
+        path = self.root / "manifest.json" if path is None else Path(path)
+        with self._lock:
+            artifacts = sorted(self.artifacts, key=lambda a: a["path"])
+            stages = sorted(
+                self.stages,
+                key=lambda s: (s["layer_idx"] is not None, s["layer_idx"] or 0),
+            )
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "artifacts": artifacts,
+                    "stages": stages,
+                    "total_bytes": sum(a["bytes"] for a in artifacts),
+                    "total_seconds": sum(a["seconds"] for a in artifacts)
+                    + sum(s["seconds"] for s in stages),
+                },
+                f,
+                indent=2,
+            )
+        return path
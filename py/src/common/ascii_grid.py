@@ -0,0 +1,181 @@
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+from typing import Dict, Optional, TextIO, Union
+
+import numpy as np
+
+from .io import remove_stale_sidecars, sidecar_path
+
+# Number of characters parsed per chunk of the grid body. Bounds the transient text/str
+# memory independently of the grid size.
+_CHUNK_CHARS = 16 * 1024 * 1024
+_SIDECAR_SUFFIX = ".npy"
+
+
+@dataclass(frozen=True)
+class AsciiGridHeader:
+    ncols: int
+    nrows: int
+    xllcorner: float
+    yllcorner: float
+    cellsize: float
+    nodata_value: Optional[float]
+    header_lines: int
+    # Any non-standard keys (ex: "cellvalue" in the NOAA bay grids)
+    extra: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class AsciiGrid:
+    header: AsciiGridHeader
+    data: np.ndarray
+
+
+def _as_text(chunk: Union[str, bytes]) -> str:
+    return chunk.decode("ascii") if isinstance(chunk, bytes) else chunk
+
+
+def _read_header(f) -> AsciiGridHeader:
+    values = {}
+    header_lines = 0
+    while True:
+        pos = f.tell()
+        line = _as_text(f.readline())
+        tokens = line.split()
+        if not tokens:
+            if not line:
+                break
+            # blank line within the header
+            header_lines += 1
+            continue
+        if not tokens[0][0].isalpha():
+            # First row of the grid body, rewind so the body parser sees it
+            f.seek(pos)
+            break
+        values[tokens[0].lower()] = float(tokens[1])
+        header_lines += 1
+
+    missing = {"ncols", "nrows", "cellsize"} - set(values)
+    if missing:
+        raise ValueError(f"ASCII grid header is missing required keys: {missing}")
+
+    cellsize = values.pop("cellsize")
+    # Normalize cell-center registration to corner registration
+    if "xllcenter" in values:
+        values["xllcorner"] = values.pop("xllcenter") - cellsize / 2
+    if "yllcenter" in values:
+        values["yllcorner"] = values.pop("yllcenter") - cellsize / 2
+
+    return AsciiGridHeader(
+        ncols=int(values.pop("ncols")),
+        nrows=int(values.pop("nrows")),
+        xllcorner=values.pop("xllcorner", 0.0),
+        yllcorner=values.pop("yllcorner", 0.0),
+        cellsize=cellsize,
+        nodata_value=values.pop("nodata_value", None),
+        header_lines=header_lines,
+        extra=values,
+    )
+
+
+def read_ascii_grid_header(fpath: Union[str, Path, TextIO]) -> AsciiGridHeader:
+    if isinstance(fpath, (str, Path)):
+        with open(fpath, "r") as f:
+            return _read_header(f)
+    pos = fpath.tell()
+    try:
+        return _read_header(fpath)
+    finally:
+        fpath.seek(pos)
+
+
+def _parse_body(f, out: np.ndarray) -> None:
+    # Parse the body in large text chunks directly into the (flat) preallocated output.
+    # Each chunk is cut at the last whitespace so no number is split across chunks.
+    flat = out.reshape(-1)
+    n = 0
+    remainder = ""
+    while True:
+        chunk = _as_text(f.read(_CHUNK_CHARS))
+        text = remainder + chunk
+        if chunk:
+            cut = max(text.rfind(c) for c in " \t\r\n")
+            if cut < 0:
+                remainder = text
+                continue
+            text, remainder = text[:cut], text[cut:]
+        text = text.strip()
+        # NOTE: np.fromstring yields a spurious value for empty input
+        values = (
+            np.fromstring(text, dtype=np.float32, sep=" ")
+            if text
+            else np.empty(0, dtype=np.float32)
+        )
+        if n + values.size > flat.size:
+            raise ValueError(
+                f"ASCII grid body has more values than declared by its header ({flat.size})"
+            )
+        flat[n : n + values.size] = values
+        n += values.size
+        if not chunk:
+            break
+    if n != flat.size:
+        raise ValueError(
+            f"ASCII grid body has {n} values, but its header declares {flat.size}"
+        )
+
+
+def read_ascii_grid(
+    fpath: Union[str, Path, TextIO],
+    use_cache: bool = True,
+    cache_dir: Optional[Path] = None,
+) -> AsciiGrid:
+    # File-like inputs (ex: uploads) have no stable identity to key a cache on. They're
+    # left where they were, so they can be read again (ex: for stats, then the data).
+    if not isinstance(fpath, (str, Path)):
+        pos = fpath.tell()
+        try:
+            header = _read_header(fpath)
+            data = np.empty((header.nrows, header.ncols), dtype=np.float32)
+            _parse_body(fpath, data)
+        finally:
+            fpath.seek(pos)
+        return AsciiGrid(header=header, data=data)
+
+    fpath = Path(fpath)
+    with open(fpath, "r") as f:
+        header = _read_header(f)
+        if not use_cache:
+            data = np.empty((header.nrows, header.ncols), dtype=np.float32)
+            _parse_body(f, data)
+            return AsciiGrid(header=header, data=data)
+
+        sidecar = sidecar_path(fpath, _SIDECAR_SUFFIX, cache_dir=cache_dir)
+        if not sidecar.exists():
+            tmp_path = sidecar.with_name(sidecar.name + f".{os.getpid()}.tmp")
+            try:
+                # Parse straight into the memory-mapped sidecar, the grid is never held in RAM twice
+                data = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(header.nrows, header.ncols),
+                )
+            except OSError:
+                # Read-only location, skip caching
+                data = np.empty((header.nrows, header.ncols), dtype=np.float32)
+                _parse_body(f, data)
+                return AsciiGrid(header=header, data=data)
+            try:
+                _parse_body(f, data)
+                data.flush()
+                del data
+                os.replace(tmp_path, sidecar)
+            finally:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            remove_stale_sidecars(sidecar, fpath, _SIDECAR_SUFFIX)
+
+    # Copy-on-write mapping: in-place edits by callers never touch the sidecar
+    return AsciiGrid(header=header, data=np.load(sidecar, mmap_mode="c"))
@@ -0,0 +1,212 @@
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Binary contours are a directory of .npy buffers + a small JSON header, so each buffer can
+# be memory-mapped (np.load(mmap_mode="r")) rather than parsed:
+#   vertices.npy / simplified.npy: (n, 2) coords of all rings, float32 or int32 fixed-point
+#   vertex_offsets.npy / simplified_offsets.npy: (n_rings + 1,) ring i is
+#       vertices[vertex_offsets[i] : vertex_offsets[i + 1]]
+#   polygon_offsets.npy: (n_polygons + 1,) polygon j is rings
+#       polygon_offsets[j] : polygon_offsets[j + 1], its exterior first then its holes
+#   ring_metadata.npy: optional (n_rings, 9) area, perimeter, bbox (4), centroid (2) and
+#       vertex count of each ring's simplified geometry, see simplify.ring_properties
+# Rings are stored as in the JSON schema, ie: closed.
+CONTOUR_FORMAT_VERSION = 1
+CONTOUR_ENCODINGS = ("float32", "int32")
+_HEADER_NAME = "header.json"
+_BUFFER_NAMES = (
+    "vertices",
+    "vertex_offsets",
+    "simplified",
+    "simplified_offsets",
+    "polygon_offsets",
+)
+_METADATA_NAME = "ring_metadata"
+# Fixed-point scale, normalized coords in [-2, 2) fit an int32 at ~1e-9 resolution
+_FIXED_POINT_SCALE = 2**29
+
+
+@dataclass(frozen=True)
+class ContourBuffers:
+    vertices: np.ndarray
+    vertex_offsets: np.ndarray
+    simplified: np.ndarray
+    simplified_offsets: np.ndarray
+    polygon_offsets: np.ndarray
+    encoding: str = "float32"
+    scale: float = 1.0
+    ring_metadata: Optional[np.ndarray] = None
+
+    @property
+    def n_polygons(self) -> int:
+        return len(self.polygon_offsets) - 1
+
+    def decode(self, coords: np.ndarray) -> np.ndarray:
+        # Coords as float
+        if self.encoding == "int32":
+            return coords.astype(np.float64) / self.scale
+        return coords
+
+    def ring(self, ring_idx: int, simplified: bool = False) -> np.ndarray:
+        coords, offsets = (
+            (self.simplified, self.simplified_offsets)
+            if simplified
+            else (self.vertices, self.vertex_offsets)
+        )
+        return self.decode(coords[offsets[ring_idx] : offsets[ring_idx + 1]])
+
+    def to_layer_shapes(self) -> List[Dict]:
+        # The JSON schema written by export_quantize_results
+        def _ring(ring_idx: int, role: str) -> Dict:
+            ring = {
+                "vertices": self.ring(ring_idx).tolist(),
+                "simplified": self.ring(ring_idx, simplified=True).tolist(),
+            }
+            if self.ring_metadata is not None:
+                m = self.ring_metadata[ring_idx].tolist()
+                ring["metadata"] = {
+                    "role": role,
+                    "area": m[0],
+                    "perimeter": m[1],
+                    "bbox": m[2:6],
+                    "centroid": m[6:8],
+                    "vertex_count": int(m[8]),
+                }
+            return ring
+
+        layer_shapes = []
+        for polygon_idx in range(self.n_polygons):
+            r0, r1 = self.polygon_offsets[polygon_idx : polygon_idx + 2]
+            shape = _ring(r0, "outer")
+            shape["holes"] = [_ring(ring_idx, "hole") for ring_idx in range(r0 + 1, r1)]
+            layer_shapes.append(shape)
+        return layer_shapes
+
+    @staticmethod
+    def from_layer_shapes(
+        layer_shapes: List[Dict], encoding: str = "float32"
+    ) -> "ContourBuffers":
+        assert encoding in CONTOUR_ENCODINGS
+        rings = [
+            ring for shape in layer_shapes for ring in [shape, *shape.get("holes", [])]
+        ]
+        scale = _FIXED_POINT_SCALE if encoding == "int32" else 1.0
+
+        def _pack(key: str) -> tuple:
+            coords = [
+                np.asarray(ring[key], dtype=np.float64).reshape(-1, 2) for ring in rings
+            ]
+            offsets = np.concatenate(([0], np.cumsum([len(c) for c in coords])))
+            coords = np.concatenate(coords) if coords else np.empty((0, 2))
+            if encoding == "int32":
+                coords = np.round(coords * scale).astype(np.int32)
+            else:
+                coords = coords.astype(np.float32)
+            return coords, offsets.astype(np.int64)
+
+        vertices, vertex_offsets = _pack("vertices")
+        simplified, simplified_offsets = _pack("simplified")
+        ring_metadata = (
+            np.array(
+                [
+                    [
+                        ring["metadata"]["area"],
+                        ring["metadata"]["perimeter"],
+                        *ring["metadata"]["bbox"],
+                        *ring["metadata"]["centroid"],
+                        ring["metadata"]["vertex_count"],
+                    ]
+                    for ring in rings
+                ],
+                dtype=np.float64,
+            ).reshape(-1, 9)
+            if all("metadata" in ring for ring in rings)
+            else None
+        )
+        polygon_offsets = np.concatenate(
+            ([0], np.cumsum([1 + len(s.get("holes", [])) for s in layer_shapes]))
+        ).astype(np.int64)
+        return ContourBuffers(
+            vertices=vertices,
+            vertex_offsets=vertex_offsets,
+            simplified=simplified,
+            simplified_offsets=simplified_offsets,
+            polygon_offsets=polygon_offsets,
+            encoding=encoding,
+            scale=float(scale),
+            ring_metadata=ring_metadata,
+        )
+
+
+def write_contours(path: Path, buffers: ContourBuffers) -> None:
+    # Written to a temporary directory first, so readers never see a partial layer
+    path = Path(path)
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    try:
+        for name in _BUFFER_NAMES:
+            np.save(tmp_path / f"{name}.npy", getattr(buffers, name))
+        if buffers.ring_metadata is not None:
+            np.save(tmp_path / f"{_METADATA_NAME}.npy", buffers.ring_metadata)
+        with open(tmp_path / _HEADER_NAME, "w") as f:
+            json.dump(
+                {
+                    "version": CONTOUR_FORMAT_VERSION,
+                    "encoding": buffers.encoding,
+                    "scale": buffers.scale,
+                    "n_polygons": buffers.n_polygons,
+                    "n_rings": len(buffers.vertex_offsets) - 1,
+                    "n_vertices": len(buffers.vertices),
+                    "n_simplified": len(buffers.simplified),
+                    "ring_metadata": buffers.ring_metadata is not None,
+                },
+                f,
+            )
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+
+
+def read_contours(path: Path, mmap: bool = True) -> ContourBuffers:
+    path = Path(path)
+    with open(path / _HEADER_NAME, "r") as f:
+        header = json.load(f)
+    if header["version"] != CONTOUR_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported contour format version {header['version']} in {path}"
+        )
+    mmap_mode = "r" if mmap else None
+    return ContourBuffers(
+        **{
+            name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in _BUFFER_NAMES
+        },
+        encoding=header["encoding"],
+        scale=header["scale"],
+        ring_metadata=(
+            np.load(path / f"{_METADATA_NAME}.npy", mmap_mode=mmap_mode)
+            if header.get("ring_metadata", False)
+            else None
+        ),
+    )
+
+
+def convert_contours(src: Path, dst: Path, encoding: str = "float32") -> None:
+    # JSON <-> binary, by the extension of src (binary contours are a directory)
+    src, dst = Path(src), Path(dst)
+    if src.suffix == ".json":
+        with open(src, "r") as f:
+            layer_shapes = json.load(f)
+        write_contours(dst, ContourBuffers.from_layer_shapes(layer_shapes, encoding))
+    else:
+        with open(dst, "w") as f:
+            json.dump(read_contours(src).to_layer_shapes(), f)
@@ -1,11 +1,23 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import math
 import os
 from pathlib import Path
-from typing import Optional, TextIO, Union
+import tracemalloc
+from typing import Optional, TextIO, Tuple, Union
 
 import numpy as np
-from PIL import Image
-from scipy import stats
+
+from .ascii_grid import read_ascii_grid, read_ascii_grid_header
+from .geotiff import Window, read_tiff_nodata, read_tiff_shape, read_tiff_window
+from .grid_stats import (
+    GridStats,
+    Moments,
+    compute_array_stats,
+    compute_grid_stats,
+    load_or_compute_grid_stats,
+)
+from .io import load_or_compute_json_sidecar
+from .valid_mask import ValidMask
 
 
 @dataclass(frozen=True)
@@ -19,63 +31,417 @@ class Config:
     quantize_depth_start_m: float
     scale_up_factor: int
     force_first_layer: bool
+    level_strategy: str = "linspace"
+    smoothing_method: str = "median"
+    smoothing_strength: Optional[float] = None
+    smooth_once: bool = False
+    simplify_method: str = "douglas_peucker"
+    min_speck_area_m2: float = 0.0
+
+
+@dataclass(frozen=True)
+class MaskedDepthGrid:
+    depth_grid: np.ndarray
+    # Cells without data (NODATA), None if every cell is valid
+    valid_mask: Optional[ValidMask] = None
+    # (row, col) of this grid within the canvas it was trimmed from
+    origin: Tuple[int, int] = (0, 0)
+    # Shape of that canvas, None if this grid is the full canvas
+    canvas_shape: Optional[Tuple[int, int]] = None
+    # Statistics of the valid values, if known (ex: from the dataset's stats sidecar)
+    stats: Optional[GridStats] = None
+    # Peak memory allocated while preprocessing the grid, if measured (see
+    # preprocess_depth_grid)
+    peak_memory_bytes: Optional[int] = None
+
+    def valid_values(self) -> np.ndarray:
+        if self.valid_mask is None:
+            return self.depth_grid.reshape(-1)
+        return self.depth_grid[self.valid_mask.unpack()]
+
+
+def _input_ext(fpath: Union[str, Path, TextIO]) -> Tuple[str, str]:
+    fname = os.path.basename(fpath) if isinstance(fpath, (str, Path)) else fpath.name
+    return fname, os.path.splitext(fname)[1]
+
+
+def read_raw_shape(fpath: Union[str, Path, TextIO]) -> Tuple[int, int]:
+    # The (rows, cols) of the raw grid, read from file metadata only
+    _, ext = _input_ext(fpath)
+    if "asc" in ext.lower():
+        header = read_ascii_grid_header(fpath)
+        return header.nrows, header.ncols
+    elif "tif" in ext.lower():
+        return read_tiff_shape(fpath)
+    raise NotImplementedError(f"Input data format not support: {ext}")
 
 
 def load_raw(
     fpath: Union[str, Path, TextIO],
-) -> np.ndarray:
-    fname = os.path.basename(fpath) if isinstance(fpath, (str, Path)) else fpath.name
+    window: Optional[Window] = None,
+    step: int = 1,
+) -> MaskedDepthGrid:
+    # window: optional (row, col, height, width) pixel window to read
+    # step: optional decimation factor
+    fname, ext = _input_ext(fpath)
     # Read the data differently depending on type
-    ext = os.path.splitext(fname)[1]
     if "asc" in ext.lower():
         # data provided as a grid w/ 100m spacing, with z-depth values representing water depth
         # Depth units are in cm, increasing positive depths. Negative values indicate intertidal.
-        depth_grid = np.loadtxt(fpath, skiprows=7)
-    elif fname.lower().endswith(".geo.tif") or "geotif" in ext.lower():
-        with Image.open(fpath) as im:
-            depth_grid = np.asarray(im).astype(np.float32)
-        depth_grid = np.clip(depth_grid, a_min=None, a_max=0)
-        depth_grid *= -1.0
+        ascii_grid = read_ascii_grid(fpath)
+        depth_grid = ascii_grid.data
+        if window is not None:
+            row, col, height, width = window
+            depth_grid = depth_grid[row : row + height, col : col + width]
+        # Only the (decimated) window is copied out of the memory-mapped grid
+        depth_grid = np.ascontiguousarray(depth_grid[::step, ::step])
+        valid_mask = ValidMask.from_nodata(depth_grid, ascii_grid.header.nodata_value)
     elif "tif" in ext.lower():
-        with Image.open(fpath) as im:
-            depth_grid = np.asarray(im).astype(np.float32)
-        ground_z = depth_grid.max()
-        depth_grid[np.where(depth_grid == 0)] = ground_z
-        depth_grid -= depth_grid.min()
-        depth_grid = depth_grid.max() - depth_grid
+        depth_grid = read_tiff_window(fpath, window=window, step=step)
+        valid_mask = ValidMask.from_nodata(depth_grid, read_tiff_nodata(fpath))
+        if valid_mask is not None:
+            # Treat cells w/o data as ground for the conversions below
+            valid_mask.fill_invalid(depth_grid, 0)
     else:
         raise NotImplementedError(f"Input data format not support: {ext}")
 
-    return depth_grid
+    if fname.lower().endswith(".geo.tif") or "geotif" in ext.lower():
+        np.minimum(depth_grid, 0, out=depth_grid)
+        np.negative(depth_grid, out=depth_grid)
+    elif "tif" in ext.lower():
+        # Windows/decimations are inverted about the max of the whole raster, so their
+        # cells match the same cells of a full read
+        ground_z = (
+            depth_grid.max()
+            if window is None and step == 1
+            else np.float32(load_tiff_ground_z(fpath))
+        )
+        depth_grid[depth_grid == 0] = ground_z
+        # Equivalent to offsetting to a zero min, then inverting about the (unchanged) max
+        np.subtract(ground_z, depth_grid, out=depth_grid)
 
+    return MaskedDepthGrid(depth_grid=depth_grid, valid_mask=valid_mask)
 
-def load_data(
+
+# Rows per block when streaming over a raw grid
+_STATS_BLOCK_ROWS = 1024
+_GROUND_Z_SIDECAR_SUFFIX = ".ground_z.json"
+
+
+def _compute_tiff_ground_z(fpath: Union[str, Path, TextIO]) -> float:
+    # Max of the raster, w/ cells w/o data as 0 (see load_raw), streamed by row blocks
+    rows, cols = read_tiff_shape(fpath)
+    nodata_value = read_tiff_nodata(fpath)
+    ground_z = 0.0
+    for r in range(0, rows, _STATS_BLOCK_ROWS):
+        block = read_tiff_window(fpath, window=(r, 0, _STATS_BLOCK_ROWS, cols))
+        valid_mask = ValidMask.from_nodata(block, nodata_value)
+        if valid_mask is not None:
+            valid_mask.fill_invalid(block, 0)
+        ground_z = float(block.max()) if r == 0 else max(ground_z, float(block.max()))
+    return ground_z
+
+
+def load_tiff_ground_z(
+    fpath: Union[str, Path, TextIO], cache_dir: Optional[Path] = None
+) -> float:
+    # The max of a plain tif, which load_raw inverts depths about. From a sidecar next to
+    # the input file, computed on first use.
+    if not isinstance(fpath, (str, Path)):
+        return _compute_tiff_ground_z(fpath)
+    return load_or_compute_json_sidecar(
+        fpath,
+        _GROUND_Z_SIDECAR_SUFFIX,
+        lambda: _compute_tiff_ground_z(fpath),
+        cache_dir=cache_dir,
+    )
+
+
+def _compute_raw_stats(fpath: Union[str, Path, TextIO], workers: int = 1) -> GridStats:
+    fname, ext = _input_ext(fpath)
+    if isinstance(fpath, (str, Path)) and "tif" in ext.lower():
+        # Decode one window of rows at a time, the raster is never held in full
+        rows, cols = read_raw_shape(fpath)
+        if not (fname.lower().endswith(".geo.tif") or "geotif" in ext.lower()):
+            # Plain tifs are converted about the max of the whole raster (see load_raw),
+            # found by a pass of its own and cached before any block is read
+            load_tiff_ground_z(fpath)
+        return compute_grid_stats(
+            lambda i: load_raw(
+                fpath, window=(i * _STATS_BLOCK_ROWS, 0, _STATS_BLOCK_ROWS, cols)
+            ).valid_values(),
+            n_blocks=math.ceil(rows / _STATS_BLOCK_ROWS),
+            workers=workers,
+        )
+    # ASCII grids are memory-mapped (see read_ascii_grid), so reducing by row blocks is
+    # bounded. File-like tifs have no sidecar for their max, so those are loaded.
+    raw = load_raw(fpath)
+    return compute_array_stats(
+        raw.depth_grid,
+        raw.valid_mask,
+        block_rows=_STATS_BLOCK_ROWS,
+        workers=workers,
+    )
+
+
+def load_grid_stats(
     fpath: Union[str, Path, TextIO],
+    cache_dir: Optional[Path] = None,
+    workers: int = 1,
+) -> GridStats:
+    # Statistics of the raw grid (see load_raw), from a sidecar next to the input file
+    # which is computed on first use by streaming over row blocks.
+    if not isinstance(fpath, (str, Path)):
+        # File-like inputs (ex: uploads) have no stable identity to key a sidecar on
+        return _compute_raw_stats(fpath, workers=workers)
+    return load_or_compute_grid_stats(
+        fpath,
+        lambda: _compute_raw_stats(fpath, workers=workers),
+        cache_dir=cache_dir,
+    )
+
+
+def masked_grid_stats(
+    masked_depth_grid: MaskedDepthGrid, workers: int = 1
+) -> GridStats:
+    # Statistics of the valid cells, reusing the known ones or reducing over row blocks
+    if masked_depth_grid.stats is not None:
+        return masked_depth_grid.stats
+    return compute_array_stats(
+        masked_depth_grid.depth_grid,
+        masked_depth_grid.valid_mask,
+        block_rows=_STATS_BLOCK_ROWS,
+        workers=workers,
+    )
+
+
+@dataclass(frozen=True)
+class PreprocessResult:
+    depth_grid: np.ndarray
+    valid_mask: Optional[ValidMask]
+    # Statistics of the clipped (and offset) grid, before z-score clipping
+    mean_m: float
+    std_m: float
+    max_m: float
+    depth_clip_max_m: Optional[float]
+    # None if it couldn't be told apart from an earlier peak of the caller's tracing
+    peak_memory_bytes: Optional[int]
+    # Statistics of the preprocessed values, when derived from raw grid statistics
+    stats: Optional[GridStats] = None
+
+
+# Rows processed per block by the fused preprocessing passes. Bounds the size of any
+# temporaries independently of the grid size.
+_PREPROCESS_BLOCK_ROWS = 512
+
+
+def preprocess_depth_grid(
+    depth_grid: np.ndarray,
     depth_unit_m: float = 1.0,
     depth_min_m: float = 0,
     depth_max_m: Optional[float] = None,
     max_z_score: float = 0,
-) -> np.ndarray:
-    depth_grid = load_raw(fpath=fpath)
-    # Scale for depth units
-    depth_grid *= depth_unit_m
-
-    # Clip the data
-    if depth_max_m and depth_max_m > 0:
-        depth_grid = np.clip(depth_grid, a_min=depth_min_m, a_max=depth_max_m)
+    valid_mask: Optional[ValidMask] = None,
+    stats: Optional[GridStats] = None,
+    approximate_stats: bool = False,
+) -> PreprocessResult:
+    # Unit scaling, min/max clipping, offsetting and z-score clipping, fused into row blocks
+    # and applied in place (float32). Statistics are gathered in a single pass, over valid
+    # cells only, or derived up front from `stats` (of the raw grid) when provided, leaving
+    # a single pass over the grid. Invalid cells are set to 0 (ie: ground).
+    # Deriving them is exact unless the min/max clip falls within a (non-empty) bin of the
+    # histogram, in which case they're gathered by a pass anyway, unless approximate_stats
+    # (see GridStats.clip_affine for the error). Likewise for the statistics returned.
+    # Peak memory is measured w/ tracemalloc. A caller's tracing is left as is (its peak
+    # isn't reset), so the peak is only known if this call raised it.
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    mem_start, peak_before = tracemalloc.get_traced_memory()
+
+    if depth_grid.dtype != np.float32 or not depth_grid.flags.writeable:
+        depth_grid = depth_grid.astype(np.float32)
+    a_max = depth_max_m if depth_max_m and depth_max_m > 0 else None
+
+    rows_any = valid_mask.rows_any() if valid_mask is not None else None
+    clip = dict(
+        scale=depth_unit_m, lo=depth_min_m, hi=a_max if a_max is not None else np.inf
+    )
+    clipped_stats = stats.clip_affine(**clip) if stats is not None else None
+    # Whether pass 1 is skipped
+    derived = clipped_stats is not None and (
+        approximate_stats or stats.clip_affine_is_exact(**clip)
+    )
+    if derived:
+        # Known up front, pass 1 is skipped
+        moments = Moments(
+            count=clipped_stats.count,
+            min=clipped_stats.min,
+            max=clipped_stats.max,
+            mean=clipped_stats.mean,
+            m2=clipped_stats.std**2 * max(clipped_stats.count - 1, 0),
+        )
     else:
-        depth_grid = np.clip(depth_grid, a_min=depth_min_m, a_max=None)
-    depth_grid -= depth_grid.min()
+        # Pass 1: scale + clip, accumulating min/max and mean/variance (merged per block)
+        moments = Moments()
+        for r in range(0, depth_grid.shape[0], _PREPROCESS_BLOCK_ROWS):
+            if (
+                rows_any is not None
+                and not rows_any[r : r + _PREPROCESS_BLOCK_ROWS].any()
+            ):
+                # Entirely NODATA, nothing to scale or measure
+                continue
+            block = depth_grid[r : r + _PREPROCESS_BLOCK_ROWS]
+            np.multiply(block, depth_unit_m, out=block)
+            np.clip(block, depth_min_m, a_max, out=block)
+            values = (
+                block
+                if valid_mask is None
+                else block[valid_mask.unpack(r, r + _PREPROCESS_BLOCK_ROWS)]
+            )
+            moments = moments.merge(Moments.of(values))
+        if clipped_stats is not None:
+            if moments.count:
+                # The min is exact regardless, and that of the full grid if this is a window
+                # (as computed in float32 by the pass)
+                moments = replace(moments, min=float(np.float32(clipped_stats.min)))
+            # Not exact, see clip_affine_is_exact
+            clipped_stats = None
+    grid_min, grid_max = (moments.min, moments.max) if moments.count else (0.0, 0.0)
+    mean, std = moments.mean, moments.std
 
+    depth_clip_max_m = None
     if max_z_score > 0:
-        # Clip/remove/smooth any outliers (depth readings more than a configurable number of std-devs away from the mean)
-        # x = µ + Zσ
-        depth_clip_max_m = np.mean(depth_grid, axis=None) + max_z_score * stats.tstd(
-            depth_grid, axis=None
-        )
+        # x = µ + Zσ (on the offset grid)
+        depth_clip_max_m = (mean - grid_min) + max_z_score * std
         print(
             f"Clipping data (for z score) to a max depth of {round(depth_clip_max_m, 1)}m"
         )
-        depth_grid = np.clip(depth_grid, a_min=0, a_max=depth_clip_max_m)
 
-    return depth_grid
+    # Pass 2: (scale + clip, when pass 1 was skipped) offset to a zero minimum + clip outliers
+    out_max = 0.0
+    for r in range(0, depth_grid.shape[0], _PREPROCESS_BLOCK_ROWS):
+        block = depth_grid[r : r + _PREPROCESS_BLOCK_ROWS]
+        if rows_any is not None and not rows_any[r : r + _PREPROCESS_BLOCK_ROWS].any():
+            block.fill(0)
+            continue
+        if derived:
+            np.multiply(block, depth_unit_m, out=block)
+            np.clip(block, depth_min_m, a_max, out=block)
+        np.subtract(block, np.float32(grid_min), out=block)
+        if depth_clip_max_m is not None:
+            np.minimum(block, np.float32(depth_clip_max_m), out=block)
+        if valid_mask is not None:
+            block[~valid_mask.unpack(r, r + _PREPROCESS_BLOCK_ROWS)] = 0
+        out_max = max(out_max, float(block.max()))
+
+    peak = tracemalloc.get_traced_memory()[1]
+    peak_memory_bytes = peak - mem_start if not tracing or peak > peak_before else None
+    if not tracing:
+        tracemalloc.stop()
+
+    preprocessed_stats = None
+    if clipped_stats is not None:
+        preprocessed_stats = clipped_stats.clip_affine(offset=-grid_min)
+        if depth_clip_max_m is not None:
+            preprocessed_stats = (
+                preprocessed_stats.clip_affine(hi=depth_clip_max_m)
+                if approximate_stats
+                or preprocessed_stats.clip_affine_is_exact(hi=depth_clip_max_m)
+                else None
+            )
+    if preprocessed_stats is not None:
+        # The max (quantization range) is kept exact, as measured on the output grid
+        preprocessed_stats = replace(preprocessed_stats, max=out_max)
+
+    return PreprocessResult(
+        depth_grid=depth_grid,
+        valid_mask=valid_mask,
+        mean_m=mean - grid_min,
+        std_m=std,
+        max_m=grid_max - grid_min,
+        depth_clip_max_m=depth_clip_max_m,
+        peak_memory_bytes=peak_memory_bytes,
+        stats=preprocessed_stats,
+    )
+
+
+def load_data(
+    fpath: Union[str, Path, TextIO],
+    depth_unit_m: float = 1.0,
+    depth_min_m: float = 0,
+    depth_max_m: Optional[float] = None,
+    max_z_score: float = 0,
+    window: Optional[Window] = None,
+    step: int = 1,
+    stats: Optional[GridStats] = None,
+    approximate_stats: bool = False,
+) -> MaskedDepthGrid:
+    # stats: statistics of the raw grid, read from the dataset's sidecar when not provided
+    # approximate_stats: see preprocess_depth_grid, always the case for a window/decimation
+    if stats is None and isinstance(fpath, (str, Path)):
+        stats = load_grid_stats(fpath)
+    raw = load_raw(fpath=fpath, window=window, step=step)
+    is_full_grid = window is None and step == 1
+    result = preprocess_depth_grid(
+        raw.depth_grid,
+        depth_unit_m=depth_unit_m,
+        depth_min_m=depth_min_m,
+        depth_max_m=depth_max_m,
+        max_z_score=max_z_score,
+        valid_mask=raw.valid_mask,
+        stats=stats,
+        # A window/decimation is clipped by the moments of the full grid (as if cropped
+        # after loading it), which only its stats have, even if they're approximate
+        approximate_stats=approximate_stats or not is_full_grid,
+    )
+    return MaskedDepthGrid(
+        depth_grid=result.depth_grid,
+        valid_mask=result.valid_mask,
+        # Statistics describe the full dataset, not a window/decimation of it
+        stats=result.stats if is_full_grid else None,
+        peak_memory_bytes=result.peak_memory_bytes,
+    )
+
+
+def trim_to_data_extent(
+    masked_depth_grid: MaskedDepthGrid, margin: int = 16
+) -> MaskedDepthGrid:
+    # Crop to the bounding box of cells w/ depth (plus a margin). Cells w/o data and ground
+    # are both 0 after preprocessing, so those are all that can be trimmed away.
+    # The margin should cover the reach of smoothing so trimmed results match untrimmed.
+    depth_grid = masked_depth_grid.depth_grid
+    rows_any = np.zeros(depth_grid.shape[0], dtype=bool)
+    cols_any = np.zeros(depth_grid.shape[1], dtype=bool)
+    for r in range(0, depth_grid.shape[0], _PREPROCESS_BLOCK_ROWS):
+        has_depth = depth_grid[r : r + _PREPROCESS_BLOCK_ROWS] > 0
+        rows_any[r : r + _PREPROCESS_BLOCK_ROWS] = has_depth.any(axis=1)
+        cols_any |= has_depth.any(axis=0)
+    if not rows_any.any():
+        return masked_depth_grid
+
+    rows, cols = np.flatnonzero(rows_any), np.flatnonzero(cols_any)
+    row0, row1 = max(int(rows[0]) - margin, 0), min(
+        int(rows[-1]) + 1 + margin, len(rows_any)
+    )
+    col0, col1 = max(int(cols[0]) - margin, 0), min(
+        int(cols[-1]) + 1 + margin, len(cols_any)
+    )
+    print(
+        f"Trimmed {depth_grid.shape} grid to its data extent of {(row1 - row0, col1 - col0)}"
+    )
+
+    valid_mask = masked_depth_grid.valid_mask
+    return MaskedDepthGrid(
+        # Copy, so the full grid can be released
+        depth_grid=depth_grid[row0:row1, col0:col1].copy(),
+        valid_mask=(
+            valid_mask.crop(row0, row1, col0, col1) if valid_mask is not None else None
+        ),
+        origin=(
+            masked_depth_grid.origin[0] + row0,
+            masked_depth_grid.origin[1] + col0,
+        ),
+        canvas_shape=masked_depth_grid.canvas_shape or depth_grid.shape[:2],
+        peak_memory_bytes=masked_depth_grid.peak_memory_bytes,
+    )
@@ -0,0 +1,275 @@
+from dataclasses import dataclass
+import math
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple, Union
+import zlib
+
+import numpy as np
+from PIL import Image
+
+try:
+    # Optional, decodes LZW blocks individually. w/o it, LZW rasters are decoded in full
+    # by Pillow (ie: windows cost as much as a full read)
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+# (row offset, col offset, height, width) in source pixels
+Window = Tuple[int, int, int, int]
+
+_TAG_WIDTH = 256
+_TAG_HEIGHT = 257
+_TAG_BITS_PER_SAMPLE = 258
+_TAG_COMPRESSION = 259
+_TAG_STRIP_OFFSETS = 273
+_TAG_SAMPLES_PER_PIXEL = 277
+_TAG_ROWS_PER_STRIP = 278
+_TAG_STRIP_BYTE_COUNTS = 279
+_TAG_PLANAR_CONFIG = 284
+_TAG_PREDICTOR = 317
+_TAG_TILE_WIDTH = 322
+_TAG_TILE_HEIGHT = 323
+_TAG_TILE_OFFSETS = 324
+_TAG_TILE_BYTE_COUNTS = 325
+_TAG_SAMPLE_FORMAT = 339
+_TAG_GDAL_NODATA = 42113
+
+_COMPRESSION_NONE = 1
+_COMPRESSION_LZW = 5
+_COMPRESSION_DEFLATE = (8, 32946)
+_SUPPORTED_COMPRESSION = (_COMPRESSION_NONE, _COMPRESSION_LZW, *_COMPRESSION_DEFLATE)
+
+# SampleFormat -> numpy kind
+_SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+
+
+@dataclass(frozen=True)
+class TiffLayout:
+    width: int
+    height: int
+    dtype: np.dtype
+    samples_per_pixel: int
+    # Blocks are tiles, or strips of `block_height` rows spanning the full width
+    tiled: bool
+    block_width: int
+    block_height: int
+    offsets: Tuple[int, ...]
+    byte_counts: Tuple[int, ...]
+    compression: int
+    predictor: int
+    planar_config: int
+
+    @property
+    def blocks_across(self) -> int:
+        return math.ceil(self.width / self.block_width)
+
+    @property
+    def blocks_down(self) -> int:
+        return math.ceil(self.height / self.block_height)
+
+
+def _read_layout(f: BinaryIO, im: Image.Image) -> Optional[TiffLayout]:
+    if not hasattr(im, "tag_v2"):
+        return None
+    tags = im.tag_v2
+
+    def _first(tag: int, default):
+        value = tags.get(tag, default)
+        return value[0] if isinstance(value, tuple) else value
+
+    f.seek(0)
+    endian = "<" if f.read(2) == b"II" else ">"
+    bits = _first(_TAG_BITS_PER_SAMPLE, 1)
+    kind = _SAMPLE_KINDS.get(_first(_TAG_SAMPLE_FORMAT, 1))
+    if kind is None or bits not in (8, 16, 32, 64):
+        return None
+
+    width, height = tags[_TAG_WIDTH], tags[_TAG_HEIGHT]
+    if _TAG_TILE_OFFSETS in tags:
+        tiled = True
+        block_width, block_height = tags[_TAG_TILE_WIDTH], tags[_TAG_TILE_HEIGHT]
+        offsets, byte_counts = tags[_TAG_TILE_OFFSETS], tags[_TAG_TILE_BYTE_COUNTS]
+    else:
+        tiled = False
+        block_width = width
+        block_height = min(_first(_TAG_ROWS_PER_STRIP, height), height)
+        offsets, byte_counts = tags[_TAG_STRIP_OFFSETS], tags[_TAG_STRIP_BYTE_COUNTS]
+
+    return TiffLayout(
+        width=width,
+        height=height,
+        dtype=np.dtype(f"{endian}{kind}{bits // 8}"),
+        samples_per_pixel=_first(_TAG_SAMPLES_PER_PIXEL, 1),
+        tiled=tiled,
+        block_width=block_width,
+        block_height=block_height,
+        offsets=tuple(offsets),
+        byte_counts=tuple(byte_counts),
+        compression=_first(_TAG_COMPRESSION, _COMPRESSION_NONE),
+        # Only applied by the LZW/deflate codecs
+        predictor=(
+            _first(_TAG_PREDICTOR, 1)
+            if _first(_TAG_COMPRESSION, _COMPRESSION_NONE) != _COMPRESSION_NONE
+            else 1
+        ),
+        planar_config=_first(_TAG_PLANAR_CONFIG, 1),
+    )
+
+
+def _decodes_blocks(layout: TiffLayout) -> bool:
+    # Whether blocks of the layout can be decoded individually
+    if layout.compression == _COMPRESSION_LZW:
+        return imagecodecs is not None
+    return layout.compression in _SUPPORTED_COMPRESSION
+
+
+def _decode_block(
+    f: BinaryIO, layout: TiffLayout, block_idx: int, rows: int
+) -> np.ndarray:
+    f.seek(layout.offsets[block_idx])
+    data = f.read(layout.byte_counts[block_idx])
+    if layout.compression == _COMPRESSION_LZW:
+        data = imagecodecs.lzw_decode(data)
+    elif layout.compression in _COMPRESSION_DEFLATE:
+        data = zlib.decompress(data)
+
+    spp = layout.samples_per_pixel if layout.planar_config == 1 else 1
+    row_values = layout.block_width * spp
+    if layout.predictor == 3:
+        # Floating point predictor: byte-wise horizontal differencing over byte planes,
+        # which are stored most significant byte first
+        raw = np.frombuffer(
+            data, dtype=np.uint8, count=rows * row_values * layout.dtype.itemsize
+        )
+        raw = raw.reshape(rows, -1, spp)
+        raw = np.cumsum(raw, axis=1, dtype=np.uint8).reshape(
+            rows, layout.dtype.itemsize, row_values
+        )
+        block = np.ascontiguousarray(raw.transpose(0, 2, 1)).view(
+            layout.dtype.newbyteorder(">")
+        )
+    else:
+        block = np.frombuffer(data, dtype=layout.dtype, count=rows * row_values)
+        block = block.reshape(rows, row_values)
+        if layout.predictor == 2:
+            # Horizontal differencing of the samples' bits as unsigned integers (as in
+            # libtiff, also for floats), integer wrap-around is intended
+            native = block.astype(layout.dtype.newbyteorder("="))
+            bits = native.view(f"u{layout.dtype.itemsize}")
+            block = np.cumsum(
+                bits.reshape(rows, layout.block_width, spp),
+                axis=1,
+                dtype=bits.dtype,
+            ).view(native.dtype)
+    # Only the first sample (band) is used for depth data
+    return block.reshape(rows, layout.block_width, spp)[:, :, 0]
+
+
+def _first_sample_index(start: int, block_start: int, step: int) -> int:
+    # The first row/col >= block_start on the decimation lattice start + k * step
+    return start + max(0, math.ceil((block_start - start) / step)) * step
+
+
+def _read_blocks(
+    f: BinaryIO, layout: TiffLayout, window: Window, step: int
+) -> np.ndarray:
+    row_off, col_off, height, width = window
+    row_end, col_end = row_off + height, col_off + width
+    out = np.empty(
+        (math.ceil(height / step), math.ceil(width / step)), dtype=np.float32
+    )
+
+    for block_row in range(
+        row_off // layout.block_height, math.ceil(row_end / layout.block_height)
+    ):
+        br0 = block_row * layout.block_height
+        br1 = min(br0 + layout.block_height, layout.height)
+        r0 = _first_sample_index(row_off, br0, step)
+        r1 = min(br1, row_end)
+        if r0 >= r1:
+            # No sampled rows within this block
+            continue
+        for block_col in range(
+            col_off // layout.block_width, math.ceil(col_end / layout.block_width)
+        ):
+            bc0 = block_col * layout.block_width
+            c0 = _first_sample_index(col_off, bc0, step)
+            c1 = min(bc0 + layout.block_width, col_end)
+            if c0 >= c1:
+                continue
+            # Tiles are always stored full size (padded), strips are truncated at the bottom
+            rows = layout.block_height if layout.tiled else br1 - br0
+            block = _decode_block(
+                f,
+                layout,
+                block_idx=block_row * layout.blocks_across + block_col,
+                rows=rows,
+            )
+            out[
+                (r0 - row_off) // step : (r1 - row_off + step - 1) // step,
+                (c0 - col_off) // step : (c1 - col_off + step - 1) // step,
+            ] = block[r0 - br0 : r1 - br0 : step, c0 - bc0 : c1 - bc0 : step]
+    return out
+
+
+def _clip_window(window: Optional[Window], width: int, height: int) -> Window:
+    if window is None:
+        return (0, 0, height, width)
+    row_off, col_off, h, w = window
+    row_off, col_off = max(0, row_off), max(0, col_off)
+    return (
+        row_off,
+        col_off,
+        max(0, min(h, height - row_off)),
+        max(0, min(w, width - col_off)),
+    )
+
+
+def read_tiff_shape(fpath: Union[str, Path, BinaryIO]) -> Tuple[int, int]:
+    with Image.open(fpath) as im:
+        width, height = im.size
+    if not isinstance(fpath, (str, Path)):
+        fpath.seek(0)
+    return height, width
+
+
+def read_tiff_nodata(fpath: Union[str, Path, BinaryIO]) -> Optional[float]:
+    # The NODATA value declared by GDAL style GeoTIFFs (stored as an ASCII string)
+    with Image.open(fpath) as im:
+        value = getattr(im, "tag_v2", {}).get(_TAG_GDAL_NODATA)
+    if not isinstance(fpath, (str, Path)):
+        fpath.seek(0)
+    if value is None:
+        return None
+    value = value.strip("\x00 ")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def read_tiff_window(
+    fpath: Union[str, Path, BinaryIO],
+    window: Optional[Window] = None,
+    step: int = 1,
+) -> np.ndarray:
+    # Read (a decimated) pixel window of the first band as float32, decoding only the
+    # tiles/strips which intersect the window.
+    assert step >= 1
+    f = open(fpath, "rb") if isinstance(fpath, (str, Path)) else fpath
+    try:
+        with Image.open(f) as im:
+            window = _clip_window(window, *im.size)
+            layout = _read_layout(f, im)
+            if layout is None or not _decodes_blocks(layout):
+                # Unsupported layout (ex: JPEG compression), fall back to decoding everything
+                row_off, col_off, height, width = window
+                return np.asarray(im)[
+                    row_off : row_off + height : step, col_off : col_off + width : step
+                ].astype(np.float32)
+        return _read_blocks(f, layout, window=window, step=step)
+    finally:
+        if f is not fpath:
+            f.close()
+        else:
+            f.seek(0)
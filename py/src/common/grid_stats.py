@@ -0,0 +1,340 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import reduce
+import math
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+from .io import load_or_compute_json_sidecar
+from .valid_mask import ValidMask
+
+# Rows per block when reducing an in-memory/memory-mapped grid
+_BLOCK_ROWS = 1024
+_HIST_BINS = 1024
+_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+_SIDECAR_SUFFIX = ".stats.json"
+
+
+@dataclass(frozen=True)
+class GridStats:
+    # Statistics over the valid cells of a grid
+    count: int
+    min: float
+    max: float
+    mean: float
+    # Sample std-dev (ddof=1), as in scipy.stats.tstd
+    std: float
+    # Fixed-bin histogram, w/ the sum and sum of squares of the values in each bin so
+    # moments of clipped/offset values can be derived exactly for all un-clipped bins
+    hist_edges: np.ndarray
+    hist_counts: np.ndarray
+    hist_sums: np.ndarray
+    hist_sumsqs: np.ndarray
+    percentiles: Dict[int, float] = field(default_factory=dict)
+
+    def to_json(self) -> Dict:
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "std": self.std,
+            "hist_edges": self.hist_edges.tolist(),
+            "hist_counts": self.hist_counts.tolist(),
+            "hist_sums": self.hist_sums.tolist(),
+            "hist_sumsqs": self.hist_sumsqs.tolist(),
+            "percentiles": {str(k): v for k, v in self.percentiles.items()},
+        }
+
+    @staticmethod
+    def from_json(d: Dict) -> "GridStats":
+        return GridStats(
+            count=d["count"],
+            min=d["min"],
+            max=d["max"],
+            mean=d["mean"],
+            std=d["std"],
+            hist_edges=np.array(d["hist_edges"], dtype=np.float64),
+            hist_counts=np.array(d["hist_counts"], dtype=np.int64),
+            hist_sums=np.array(d["hist_sums"], dtype=np.float64),
+            hist_sumsqs=np.array(d["hist_sumsqs"], dtype=np.float64),
+            percentiles={int(k): v for k, v in d["percentiles"].items()},
+        )
+
+    def hist_centers(self) -> np.ndarray:
+        # The mean value of each bin (its midpoint when empty)
+        midpoints = (self.hist_edges[:-1] + self.hist_edges[1:]) / 2
+        return np.divide(
+            self.hist_sums,
+            self.hist_counts,
+            out=midpoints,
+            where=self.hist_counts > 0,
+        )
+
+    def quantiles(self, q: np.ndarray) -> np.ndarray:
+        # Approximate quantiles (q in [0, 1]), exact at bin edges
+        return _quantiles_from_histogram(self.hist_edges, self.hist_counts, q)
+
+    def cdf(self, value: float) -> float:
+        # Approximate fraction of the values <= value
+        cdf = np.concatenate(([0], np.cumsum(self.hist_counts))) / max(self.count, 1)
+        return float(np.interp(value, self.hist_edges, cdf))
+
+    def clip_affine_is_exact(
+        self,
+        scale: float = 1.0,
+        offset: float = 0.0,
+        lo: float = -np.inf,
+        hi: float = np.inf,
+    ) -> bool:
+        # Whether clip_affine is exact, ie: no (non-empty) bin straddles lo or hi
+        edges = scale * self.hist_edges + offset
+        straddles = ((edges[:-1] < lo) & (edges[1:] > lo)) | (
+            (edges[:-1] < hi) & (edges[1:] > hi)
+        )
+        return not (straddles & (self.hist_counts > 0)).any()
+
+    def clip_affine(
+        self,
+        scale: float = 1.0,
+        offset: float = 0.0,
+        lo: float = -np.inf,
+        hi: float = np.inf,
+    ) -> "GridStats":
+        # Statistics of clip(scale * x + offset, lo, hi), derived from the histogram alone.
+        # Exact for bins left un-clipped (or entirely clipped), bins straddling lo/hi are
+        # approximated by their mean value (see clip_affine_is_exact). The error of the
+        # mean is then at most the fraction of values in those bins times the bin width.
+        assert scale > 0
+        edges = scale * self.hist_edges + offset
+        inside = (edges[:-1] >= lo) & (edges[1:] <= hi)
+        counts = self.hist_counts
+        sums = np.where(inside, scale * self.hist_sums + offset * counts, 0)
+        sumsqs = np.where(
+            inside,
+            scale**2 * self.hist_sumsqs
+            + 2 * scale * offset * self.hist_sums
+            + offset**2 * counts,
+            0,
+        )
+        clipped_values = np.clip(scale * self.hist_centers() + offset, lo, hi)
+        sums = np.where(inside, sums, counts * clipped_values)
+        sumsqs = np.where(inside, sumsqs, counts * clipped_values**2)
+
+        def _f(v: float) -> float:
+            return float(np.clip(scale * v + offset, lo, hi))
+
+        return _from_histogram(
+            hist_edges=np.clip(edges, lo, hi),
+            hist_counts=counts,
+            hist_sums=sums,
+            hist_sumsqs=sumsqs,
+            min_value=_f(self.min),
+            max_value=_f(self.max),
+            # Percentiles commute w/ monotonic transforms
+            percentiles={p: _f(v) for p, v in self.percentiles.items()},
+        )
+
+
+def _from_histogram(
+    hist_edges: np.ndarray,
+    hist_counts: np.ndarray,
+    hist_sums: np.ndarray,
+    hist_sumsqs: np.ndarray,
+    min_value: float,
+    max_value: float,
+    percentiles: Dict[int, float],
+) -> GridStats:
+    count = int(hist_counts.sum())
+    mean = float(hist_sums.sum() / count) if count else 0.0
+    var = (
+        max(float(hist_sumsqs.sum()) - count * mean**2, 0.0) / (count - 1)
+        if count > 1
+        else 0.0
+    )
+    return GridStats(
+        count=count,
+        min=min_value,
+        max=max_value,
+        mean=mean,
+        std=var**0.5,
+        hist_edges=hist_edges,
+        hist_counts=hist_counts,
+        hist_sums=hist_sums,
+        hist_sumsqs=hist_sumsqs,
+        percentiles=percentiles,
+    )
+
+
+def _quantiles_from_histogram(
+    edges: np.ndarray, counts: np.ndarray, q: np.ndarray
+) -> np.ndarray:
+    # Approximate quantiles: linear interpolation of the CDF within bins
+    cdf = np.concatenate(([0], np.cumsum(counts))) / max(counts.sum(), 1)
+    return np.interp(q, cdf, edges)
+
+
+@dataclass(frozen=True)
+class Moments:
+    # Count, range and mean/sum of squared deviations (Welford), mergeable across blocks
+    count: int = 0
+    min: float = np.inf
+    max: float = -np.inf
+    mean: float = 0.0
+    m2: float = 0.0
+
+    @staticmethod
+    def of(values: np.ndarray) -> "Moments":
+        if not values.size:
+            return Moments()
+        mean = float(values.mean(dtype=np.float64))
+        return Moments(
+            count=values.size,
+            min=float(values.min()),
+            max=float(values.max()),
+            mean=mean,
+            m2=float(values.var(dtype=np.float64)) * values.size,
+        )
+
+    def merge(self, other: "Moments") -> "Moments":
+        # Chan et al.'s pairwise update
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return Moments(
+            count=count,
+            min=min(self.min, other.min),
+            max=max(self.max, other.max),
+            mean=self.mean + delta * other.count / count,
+            m2=self.m2 + other.m2 + delta**2 * self.count * other.count / count,
+        )
+
+    @property
+    def std(self) -> float:
+        # Sample std-dev (ddof=1), as in scipy.stats.tstd
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+
+@dataclass(frozen=True)
+class Histogram:
+    # Fixed bins, so histograms of different blocks merge by addition
+    edges: np.ndarray
+    counts: np.ndarray
+    sums: np.ndarray
+    sumsqs: np.ndarray
+
+    @staticmethod
+    def of(values: np.ndarray, edges: np.ndarray) -> "Histogram":
+        bins = len(edges) - 1
+        values = values.astype(np.float64)
+        bin_idx = np.clip(
+            ((values - edges[0]) * (bins / (edges[-1] - edges[0]))).astype(np.intp),
+            0,
+            bins - 1,
+        )
+        return Histogram(
+            edges=edges,
+            counts=np.bincount(bin_idx, minlength=bins),
+            sums=np.bincount(bin_idx, weights=values, minlength=bins),
+            sumsqs=np.bincount(bin_idx, weights=values * values, minlength=bins),
+        )
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        return Histogram(
+            edges=self.edges,
+            counts=self.counts + other.counts,
+            sums=self.sums + other.sums,
+            sumsqs=self.sumsqs + other.sumsqs,
+        )
+
+
+def _map_blocks(fn: Callable[[int], Any], n_blocks: int, workers: int) -> Iterable[Any]:
+    # Results are always in block order, so merged results don't depend on `workers`
+    if workers <= 1:
+        return map(fn, range(n_blocks))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, range(n_blocks)))
+
+
+def compute_grid_stats(
+    load_block: Callable[[int], np.ndarray],
+    n_blocks: int,
+    bins: int = _HIST_BINS,
+    workers: int = 1,
+) -> GridStats:
+    # load_block(i) returns the valid values of the i'th block of the grid. Two passes over
+    # the blocks: moments + range, then the histogram over that range. Memory is bounded by
+    # a block per worker, blocks are read and reduced concurrently when workers > 1.
+    moments = reduce(
+        Moments.merge,
+        _map_blocks(lambda i: Moments.of(load_block(i)), n_blocks, workers),
+        Moments(),
+    )
+    vmin, vmax = (moments.min, moments.max) if moments.count else (0.0, 0.0)
+
+    edges = np.linspace(vmin, vmax if vmax > vmin else vmin + 1, bins + 1)
+    hist = reduce(
+        Histogram.merge,
+        _map_blocks(lambda i: Histogram.of(load_block(i), edges), n_blocks, workers),
+        Histogram.of(np.empty(0), edges),
+    )
+
+    return GridStats(
+        count=moments.count,
+        min=vmin,
+        max=vmax,
+        mean=moments.mean,
+        std=moments.std,
+        hist_edges=edges,
+        hist_counts=hist.counts,
+        hist_sums=hist.sums,
+        hist_sumsqs=hist.sumsqs,
+        percentiles=dict(
+            zip(
+                _PERCENTILES,
+                _quantiles_from_histogram(
+                    edges, hist.counts, np.array(_PERCENTILES) / 100
+                ).tolist(),
+            )
+        ),
+    )
+
+
+def compute_array_stats(
+    grid: np.ndarray,
+    valid_mask: Optional[ValidMask] = None,
+    block_rows: int = _BLOCK_ROWS,
+    workers: int = 1,
+) -> GridStats:
+    # Statistics of the valid cells of a (possibly memory-mapped) grid, by row blocks
+    def _load_block(i: int) -> np.ndarray:
+        r = i * block_rows
+        block = grid[r : r + block_rows]
+        if valid_mask is None:
+            return block.reshape(-1)
+        return block[valid_mask.unpack(r, r + block_rows)]
+
+    return compute_grid_stats(
+        _load_block, n_blocks=math.ceil(grid.shape[0] / block_rows), workers=workers
+    )
+
+
+def load_or_compute_grid_stats(
+    fpath: Path,
+    compute: Callable[[], GridStats],
+    cache_dir: Optional[Path] = None,
+) -> GridStats:
+    # Read the statistics sidecar of fpath, computing (and writing) it when missing/stale
+    return GridStats.from_json(
+        load_or_compute_json_sidecar(
+            fpath,
+            _SIDECAR_SUFFIX,
+            lambda: compute().to_json(),
+            cache_dir=cache_dir,
+        )
+    )
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Optional, Tuple
 import cv2
 import numpy as np
 
@@ -45,29 +45,64 @@ def to_rgb_img(depth_grid: np.ndarray) -> np.ndarray:
     return np.stack(((255.0 * depth_grid).astype(np.uint8),) * 3, axis=-1)
 
 
-def crop_box(
-    img: np.ndarray, box: Tuple, imagine_out_of_bounds: bool = True
-) -> np.ndarray:
-    if imagine_out_of_bounds:
-        # Pad the image w/ replicated borders before cropping...
-        rows, cols = img.shape[0], img.shape[1]
-        pad_x = rows // 2
-        pad_y = cols // 2
-        img = cv2.copyMakeBorder(img, pad_y, pad_y, pad_x, pad_x, cv2.BORDER_REPLICATE)
-        # offset the desired crop center point by the applied padding
-        box = (tuple(map(sum, zip(box[0], (pad_x, pad_y)))), *box[1:])
-
-    rows, cols = img.shape[0], img.shape[1]
-    angle = box[2]
-    m = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
-    img_rot = cv2.warpAffine(img, m, (cols, rows))
-
-    # rotate bounding box
-    rect_no_rot = (box[0], box[1], 0.0)
-    box = cv2.boxPoints(rect_no_rot)
-
-    pts = np.int0(box)
+def _crop_box_geometry(
+    shape: Tuple, box: Tuple, imagine_out_of_bounds: bool
+) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+    # The rotation (about the image center) and the output extents (x0, y0, x1, y1) of a
+    # crop, both in (unpadded) image coordinates
+    rows, cols = shape[0], shape[1]
+    # When imagining out of bounds, the image is conceptually padded by half its size
+    pad_x, pad_y = (rows // 2, cols // 2) if imagine_out_of_bounds else (0, 0)
+    m = cv2.getRotationMatrix2D((cols / 2, rows / 2), box[2], 1)
+
+    # bounding box of the un-rotated box, clipped to the (padded) image
+    center = (box[0][0] + pad_x, box[0][1] + pad_y)
+    pts = np.intp(cv2.boxPoints((center, box[1], 0.0)))
     pts[pts < 0] = 0
+    x0, y0 = pts[1]
+    x1 = min(pts[2][0], cols + 2 * pad_x)
+    y1 = min(pts[0][1], rows + 2 * pad_y)
+    return m, (x0 - pad_x, y0 - pad_y, max(x1, x0) - pad_x, max(y1, y0) - pad_y)
+
+
+def crop_box_window(
+    shape: Tuple, box: Tuple, imagine_out_of_bounds: bool = True
+) -> Tuple[int, int, int, int]:
+    # The (row, col, height, width) window of the source image sampled by crop_box
+    m, (x0, y0, x1, y1) = _crop_box_geometry(shape, box, imagine_out_of_bounds)
+    m_inv = cv2.invertAffineTransform(m)
+    corners = np.array([[x0, y0, 1], [x1, y0, 1], [x1, y1, 1], [x0, y1, 1]], np.float64)
+    src = corners @ m_inv.T
+    # Add a margin for interpolation
+    c0, r0 = np.floor(src.min(axis=0)).astype(int) - 2
+    c1, r1 = np.ceil(src.max(axis=0)).astype(int) + 2
+    r0, c0 = max(int(r0), 0), max(int(c0), 0)
+    r1, c1 = min(int(r1), shape[0]), min(int(c1), shape[1])
+    return (r0, c0, max(r1 - r0, 0), max(c1 - c0, 0))
+
 
-    # crop
-    return img_rot[pts[1][1] : pts[0][1], pts[1][0] : pts[2][0]]
+def crop_box(
+    img: np.ndarray,
+    box: Tuple,
+    imagine_out_of_bounds: bool = True,
+    origin: Tuple[int, int] = (0, 0),
+    full_shape: Optional[Tuple] = None,
+) -> np.ndarray:
+    # img may be a window (see crop_box_window) of a larger image, in which case origin is
+    # the (row, col) of the window and full_shape the shape of the full image.
+    m, (x0, y0, x1, y1) = _crop_box_geometry(
+        full_shape or img.shape, box, imagine_out_of_bounds
+    )
+    # Rotate and crop in one warp: window coords -> full image coords -> rotated -> cropped
+    m = m.copy()
+    m[:, 2] += m[:, :2] @ np.array([origin[1], origin[0]], np.float64)
+    m[:, 2] -= (x0, y0)
+    return cv2.warpAffine(
+        img,
+        m,
+        (x1 - x0, y1 - y0),
+        # Replicated borders imagine any missing data
+        borderMode=(
+            cv2.BORDER_REPLICATE if imagine_out_of_bounds else cv2.BORDER_CONSTANT
+        ),
+    )
@@ -1,7 +1,10 @@
+import json
 import os
 import os.path as osp
 from pathlib import Path
-from typing import List
+import queue
+import threading
+from typing import Any, Callable, List, Optional
 import zipfile
 
 BATHY_FILE_EXTS = {".asc", ".geo.tif", ".geotif", ".tif"}
@@ -24,3 +27,119 @@ def make_zip_archive(src_path, dst_path):
             for name in filenames:
                 path = osp.join(dirpath, name)
                 archive.write(path, osp.relpath(path, src_path))
+
+
+def sidecar_path(fpath: Path, suffix: str, cache_dir: Optional[Path] = None) -> Path:
+    # Keyed on file size + mtime, so any modification of the source invalidates the sidecar
+    st = os.stat(fpath)
+    parent = Path(cache_dir) if cache_dir is not None else fpath.parent
+    return parent / f".{fpath.name}.{st.st_size}-{st.st_mtime_ns}{suffix}"
+
+
+def remove_stale_sidecars(sidecar: Path, fpath: Path, suffix: str) -> None:
+    for stale in sidecar.parent.glob(f".{fpath.name}.*-*{suffix}"):
+        if stale != sidecar:
+            try:
+                stale.unlink()
+            except OSError:
+                pass
+
+
+def load_or_compute_json_sidecar(
+    fpath: Path,
+    suffix: str,
+    compute: Callable[[], Any],
+    cache_dir: Optional[Path] = None,
+) -> Any:
+    # Read the JSON sidecar of fpath, computing (and writing) it when missing/stale
+    fpath = Path(fpath)
+    sidecar = sidecar_path(fpath, suffix, cache_dir=cache_dir)
+    if sidecar.exists():
+        with open(sidecar, "r") as f:
+            return json.load(f)
+
+    value = compute()
+    tmp_path = sidecar.with_name(sidecar.name + f".{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, sidecar)
+        remove_stale_sidecars(sidecar, fpath, suffix)
+    except OSError:
+        # Read-only location, skip caching
+        pass
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return value
+
+
+class ArtifactWriter:
+    # Writes artifacts in the background: each write is a callable (encode + write, ex:
+    # `partial(image.save, path)`) queued for a pool of writer threads, so compute overlaps
+    # w/ disk I/O. The queue is bounded, submit() blocks once max_pending writes are
+    # queued, bounding the memory held by pending artifacts. The first failed write is
+    # raised by the next submit() or by flush(). w/ threads=0, writes are synchronous.
+    def __init__(self, threads: int = 2, max_pending: int = 8):
+        self._queue: queue.Queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._error: Optional[BaseException] = None
+        self._threads = [
+            threading.Thread(target=self._drain, daemon=True) for _ in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _drain(self):
+        while True:
+            write = self._queue.get()
+            try:
+                if write is None:
+                    return
+                if self._error is None:
+                    write()
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, write: Callable[[], None]) -> None:
+        self._raise_error()
+        if not self._threads:
+            write()
+            return
+        self._queue.put(write)
+
+    def flush(self) -> None:
+        # Wait for every queued write, raising the first that failed
+        if self._threads:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def __enter__(self) -> "ArtifactWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Already failing, still wait for the writers but don't mask the error
+        try:
+            self.close()
+        except BaseException:
+            pass
@@ -0,0 +1,191 @@
+from dataclasses import dataclass
+import math
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Corners of a cell, w/ (x, y) positions within it: top-left, top-right, bottom-right,
+# bottom-left. The case of a cell is the bitmask of its corners inside the region.
+_CORNERS = np.array([(0, 0), (1, 0), (1, 1), (0, 1)], dtype=np.float64)
+# Edges of a cell: top, right, bottom, left, w/ their midpoints and the edges of each corner
+_EDGE_MIDPOINTS = np.array([(0.5, 0), (1, 0.5), (0.5, 1), (0, 0.5)], dtype=np.float64)
+_CORNER_EDGES = ((0, 3), (0, 1), (1, 2), (2, 3))
+
+
+def _case_segments(case: int) -> list:
+    # The (start edge, end edge) segments crossing a cell, oriented w/ the region on the
+    # left (in image coordinates, ie: y down), as cv2.findContours winds its rings. Saddles join the inside corners, so the
+    # region is 8-connected as for cv2.findContours.
+    inside = [bool(case >> c & 1) for c in range(4)]
+    n_inside = sum(inside)
+    cuts = []
+    if n_inside == 1:
+        c = inside.index(True)
+        cuts.append((_CORNER_EDGES[c], _CORNERS[c]))
+    elif n_inside == 3:
+        c = inside.index(False)
+        cuts.append((_CORNER_EDGES[c], np.array([0.5, 0.5])))
+    elif n_inside == 2 and inside[0] == inside[2]:
+        # Saddle, cut off each outside corner
+        for c in range(4):
+            if not inside[c]:
+                cuts.append((_CORNER_EDGES[c], np.array([0.5, 0.5])))
+    elif n_inside == 2:
+        crossed = tuple(e for e in range(4) if inside[e] != inside[(e + 1) % 4])
+        ref = _CORNERS[[c for c in range(4) if inside[c]]].mean(axis=0)
+        cuts.append((crossed, ref))
+
+    segments = []
+    for (e0, e1), ref in cuts:
+        d = _EDGE_MIDPOINTS[e1] - _EDGE_MIDPOINTS[e0]
+        r = ref - _EDGE_MIDPOINTS[e0]
+        if d[0] * r[1] - d[1] * r[0] > 0:
+            e0, e1 = e1, e0
+        segments.append((e0, e1))
+    return segments
+
+
+# (16 cases, 2 segment slots, start/end edge), -1 where a case has fewer segments
+_CASE_TABLE = np.full((16, 2, 2), -1, dtype=np.int8)
+for _case in range(16):
+    for _slot, _segment in enumerate(_case_segments(_case)):
+        _CASE_TABLE[_case, _slot] = _segment
+# An inside corner of each case
+_CASE_INSIDE_CORNER = np.array(
+    [next((c for c in range(4) if case >> c & 1), 0) for case in range(16)],
+    dtype=np.intp,
+)
+
+
+@dataclass(frozen=True)
+class IsoRings:
+    # Rings as a flat (n, 2) (x, y) vertex buffer in grid coordinates, w/ ring offsets
+    points: np.ndarray
+    ring_offsets: np.ndarray
+    # Holes wind the opposite way to outer rings
+    is_hole: np.ndarray
+    # The (8-connected) region each ring bounds: one outer ring per region, and its holes
+    region: np.ndarray
+
+
+def _cycles(next_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Decompose a permutation into its cycles by pointer jumping. Returns the cycle of each
+    # element (labelled by its smallest element) and its distance to the end of the cycle
+    # when walked from that smallest element.
+    n = len(next_idx)
+    label = np.arange(n)
+    jump = next_idx.copy()
+    for _ in range(max(1, math.ceil(math.log2(max(n, 2)))) + 1):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+    # List ranking, w/ the link back to the start of each cycle cut
+    succ = np.where(next_idx == label, np.arange(n), next_idx)
+    dist = (succ != np.arange(n)).astype(np.int64)
+    for _ in range(max(1, math.ceil(math.log2(max(n, 2)))) + 1):
+        dist = dist + dist[succ]
+        succ = succ[succ]
+    return label, dist
+
+
+def trace_iso_rings(
+    values: np.ndarray, threshold: float, valid: Optional[np.ndarray] = None
+) -> IsoRings:
+    # Marching squares over the grid points, for the region values > threshold (and valid).
+    # Crossings are linearly interpolated between valid points, and halfway to invalid
+    # points and the grid border. All rings are closed, in one vectorized pass.
+    rows, cols = values.shape
+    inside = np.zeros((rows + 2, cols + 2), dtype=bool)
+    inside[1:-1, 1:-1] = values > threshold
+    has_value = np.zeros((rows + 2, cols + 2), dtype=bool)
+    has_value[1:-1, 1:-1] = True if valid is None else valid
+    inside &= has_value
+
+    cases = (
+        inside[:-1, :-1].astype(np.uint8)
+        | inside[:-1, 1:].astype(np.uint8) << 1
+        | inside[1:, 1:].astype(np.uint8) << 2
+        | inside[1:, :-1].astype(np.uint8) << 3
+    )
+    cells = np.flatnonzero((cases != 0) & (cases != 15))
+    cell_cases = cases.reshape(-1)[cells]
+    ci, cj = np.divmod(cells, cols + 1)
+
+    # Global ids of the top, right, bottom and left edges of each cell. Horizontal edges
+    # come first, (rows + 2) x (cols + 1), then vertical ones, (rows + 1) x (cols + 2).
+    n_horizontal = (rows + 2) * (cols + 1)
+    cell_edges = np.stack(
+        (
+            ci * (cols + 1) + cj,
+            n_horizontal + ci * (cols + 2) + cj + 1,
+            (ci + 1) * (cols + 1) + cj,
+            n_horizontal + ci * (cols + 2) + cj,
+        ),
+        axis=1,
+    )
+    starts, ends, seg_cells = [], [], []
+    for slot in range(2):
+        has_slot = _CASE_TABLE[cell_cases, slot, 0] >= 0
+        k = np.flatnonzero(has_slot)
+        starts.append(cell_edges[k, _CASE_TABLE[cell_cases[k], slot, 0]])
+        ends.append(cell_edges[k, _CASE_TABLE[cell_cases[k], slot, 1]])
+        seg_cells.append(k)
+    starts, ends, seg_cells = (np.concatenate(a) for a in (starts, ends, seg_cells))
+    if not len(starts):
+        return IsoRings(
+            points=np.empty((0, 2)),
+            ring_offsets=np.zeros(1, dtype=np.intp),
+            is_hole=np.empty(0, dtype=bool),
+            region=np.empty(0, dtype=np.int32),
+        )
+
+    # Each crossed edge starts one segment and ends another, the next segment is found by
+    # a binary search over the (sorted) start edges, ie: memory is per crossed edge
+    # rather than per edge of the grid
+    by_start = np.argsort(starts)
+    label, dist = _cycles(by_start[np.searchsorted(starts[by_start], ends)])
+    order = np.lexsort((-dist, label))
+
+    # Crossing on the start edge of each segment, in ring order
+    edges = starts[order]
+    is_vertical = edges >= n_horizontal
+    r0 = np.where(
+        is_vertical, (edges - n_horizontal) // (cols + 2), edges // (cols + 1)
+    )
+    c0 = np.where(is_vertical, (edges - n_horizontal) % (cols + 2), edges % (cols + 1))
+    r1, c1 = r0 + is_vertical, c0 + ~is_vertical
+    # Values at the (padded) grid points, the padding has no value
+    v0 = values[np.clip(r0 - 1, 0, rows - 1), np.clip(c0 - 1, 0, cols - 1)]
+    v1 = values[np.clip(r1 - 1, 0, rows - 1), np.clip(c1 - 1, 0, cols - 1)]
+    v0, v1 = v0.astype(np.float64), v1.astype(np.float64)
+    interpolate = has_value[r0, c0] & has_value[r1, c1] & (v0 != v1)
+    s = np.full(len(edges), 0.5)
+    s[interpolate] = (threshold - v0[interpolate]) / (v1[interpolate] - v0[interpolate])
+    # Keep crossings off the grid points, so rings never touch themselves there
+    s = np.clip(s, 1e-3, 1 - 1e-3)
+    points = np.stack((c0 + s * ~is_vertical - 1, r0 + s * is_vertical - 1), axis=1)
+
+    ring_labels, ring_starts = np.unique(label[order], return_index=True)
+    ring_offsets = np.append(ring_starts, len(order))
+    # Shoelace, the sign of the area tells outer rings from holes
+    x, y = points[:, 0], points[:, 1]
+    ring_of = np.repeat(np.arange(len(ring_labels)), np.diff(ring_offsets))
+    nxt = np.arange(len(points)) + 1
+    nxt[ring_offsets[1:] - 1] = ring_starts
+    area2 = np.bincount(ring_of, weights=x * y[nxt] - x[nxt] * y)
+
+    # Region of each ring, from an inside corner of its first segment's cell
+    regions = cv2.connectedComponents(inside.astype(np.uint8), connectivity=8)[1]
+    first_cells = cells[seg_cells[order[ring_starts]]]
+    corner = _CORNERS[_CASE_INSIDE_CORNER[cases.reshape(-1)[first_cells]]].astype(
+        np.intp
+    )
+    fi, fj = np.divmod(first_cells, cols + 1)
+    return IsoRings(
+        points=points,
+        ring_offsets=ring_offsets,
+        # Region on the left in y-down coordinates: outer rings have a negative area and
+        # holes a positive one, as for cv2.findContours
+        is_hole=area2 > 0,
+        region=regions[fi + corner[:, 1], fj + corner[:, 0]],
+    )
@@ -1,14 +1,35 @@
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
+from functools import cache, cached_property, partial
+from io import BytesIO
 import json
+import math
 from pathlib import Path
-from typing import Any, Dict, List
+import time
+from typing import Any, Callable, Collection, Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
 from PIL import Image
-from shapely import geometry
+from sklearn.cluster import KMeans
 import matplotlib.pyplot as plt
 
+from .artifacts import (
+    DEFAULT_ARTIFACTS,
+    EXPORT_ARTIFACTS,
+    ArtifactManifest,
+    needs_intermediate,
+)
+from .contour_format import ContourBuffers, write_contours
+from .grid_stats import GridStats, compute_array_stats
+from .io import ArtifactWriter
+from .marching_squares import trace_iso_rings
+from .shared_grid import Grid, as_array, share_grid
+from .simplify import ring_properties, simplify_rings
+from .smoothing import remove_specks, smooth_layer_count_field, smooth_mask
+from .stage_cache import StageCache, lazy_stage, run_stage, stage_key
+from .valid_mask import ValidMask
 from .viz import _plot_contour_results, plot_polys
 
 
@@ -40,77 +61,376 @@ def calculate_normalized_quantized_depths(
     )
 
 
+def _level_population(
+    stats: GridStats, max_depth_m: float, quantize_depth_start_m: float
+) -> Tuple[float, np.ndarray]:
+    # The depth from which levels are chosen (clipped as in calculate_normalized_quantized_depths)
+    # and a mask of the histogram bins at/beyond it, ground is never part of the population
+    start_m = max(quantize_depth_start_m, 0.004 * max_depth_m)
+    in_population = (stats.hist_counts > 0) & (stats.hist_centers() >= start_m)
+    return start_m, in_population
+
+
+def _normalize_levels(depths_m: np.ndarray, max_depth_m: float) -> np.ndarray:
+    depths_norm = np.maximum(np.sort(depths_m) / max_depth_m, 0.004).astype(np.float32)
+    # pre-pend a zero for the ground depth
+    return np.insert(depths_norm, 0, 0)
+
+
+def _linspace_levels(
+    stats: GridStats, max_depth_m: float, levels: int, quantize_depth_start_m: float
+) -> np.ndarray:
+    # Evenly spaced from the starting depth
+    return calculate_normalized_quantized_depths(
+        max_depth_m=max_depth_m,
+        levels=levels,
+        quantize_depth_start_m=quantize_depth_start_m,
+    )
+
+
+def _quantile_levels(
+    stats: GridStats, max_depth_m: float, levels: int, quantize_depth_start_m: float
+) -> np.ndarray:
+    # Equal-area: the cells beyond the starting depth split into equal shares, w/ a level
+    # at the center (quantile) of each share. Cells take their nearest level, so levels
+    # at the ends of the range (ex: the max) would only take half a share, or less.
+    start_m, _ = _level_population(stats, max_depth_m, quantize_depth_start_m)
+    start_q = stats.cdf(start_m)
+    n_classes = levels - 1
+    q = start_q + (1 - start_q) * (np.arange(n_classes) + 0.5) / n_classes
+    return _normalize_levels(stats.quantiles(q), max_depth_m)
+
+
+def _jenks_levels(
+    stats: GridStats, max_depth_m: float, levels: int, quantize_depth_start_m: float
+) -> np.ndarray:
+    # Jenks natural breaks (Fisher's exact dynamic program) over the histogram bins beyond
+    # the starting depth, w/ levels at the mean depth of each class. O(levels * bins^2).
+    _, in_population = _level_population(stats, max_depth_m, quantize_depth_start_m)
+    n_classes = levels - 1
+    n_bins = int(in_population.sum())
+    if n_bins <= n_classes:
+        return _linspace_levels(stats, max_depth_m, levels, quantize_depth_start_m)
+
+    # Prefix sums over bins, the cost of a class of bins [i, j) is its sum of squared deviations
+    cum_n = np.concatenate(([0], np.cumsum(stats.hist_counts[in_population])))
+    cum_s = np.concatenate(([0], np.cumsum(stats.hist_sums[in_population])))
+    cum_q = np.concatenate(([0], np.cumsum(stats.hist_sumsqs[in_population])))
+    n = cum_n[None, :] - cum_n[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cost = (cum_q[None, :] - cum_q[:, None]) - (
+            cum_s[None, :] - cum_s[:, None]
+        ) ** 2 / n
+    cost[np.tril_indices(n_bins + 1)] = np.inf
+
+    # best[k][j]: min cost of splitting bins [0, j) into k + 1 classes
+    best = [cost[0]]
+    split = []
+    for _ in range(n_classes - 1):
+        candidates = best[-1][:, None] + cost
+        split.append(candidates.argmin(axis=0))
+        best.append(candidates.min(axis=0))
+
+    bounds = [n_bins]
+    for k in reversed(range(n_classes - 1)):
+        bounds.append(int(split[k][bounds[-1]]))
+    bounds.append(0)
+    bounds = bounds[::-1]
+    means = [
+        (cum_s[j] - cum_s[i]) / (cum_n[j] - cum_n[i])
+        for i, j in zip(bounds[:-1], bounds[1:])
+    ]
+    return _normalize_levels(np.array(means), max_depth_m)
+
+
+def _kmeans_levels(
+    stats: GridStats, max_depth_m: float, levels: int, quantize_depth_start_m: float
+) -> np.ndarray:
+    # 1D k-means over the histogram bins beyond the starting depth (weighted by count),
+    # w/ levels at the cluster centers
+    _, in_population = _level_population(stats, max_depth_m, quantize_depth_start_m)
+    n_classes = levels - 1
+    if int(in_population.sum()) <= n_classes:
+        return _linspace_levels(stats, max_depth_m, levels, quantize_depth_start_m)
+    kmeans = KMeans(n_clusters=n_classes, n_init=10, random_state=0).fit(
+        stats.hist_centers()[in_population, None],
+        sample_weight=stats.hist_counts[in_population],
+    )
+    return _normalize_levels(kmeans.cluster_centers_[:, 0], max_depth_m)
+
+
+# Level selection strategies, by name. Each maps (stats of the depth grid, max depth,
+# levels, starting depth) to normalized depths incl. the ground (0) level. All but linspace
+# work from the histogram in `stats`, so their cost doesn't depend on the grid size.
+LEVEL_STRATEGIES: Dict[str, Callable[[GridStats, float, int, float], np.ndarray]] = {
+    "linspace": _linspace_levels,
+    "quantiles": _quantile_levels,
+    "jenks": _jenks_levels,
+    "kmeans": _kmeans_levels,
+}
+
+
 @dataclass(frozen=True, eq=True)
 class QuantizeResult:
-    depth_grid_quant: np.ndarray
-    depth_map_im_quant: Image.Image
+    # Index into quantized_depth_values, per cell
+    level_grid: np.ndarray
     quantized_depth_values: np.ndarray
     quantized_depth_values_norm: np.ndarray
+    valid_mask: Optional[ValidMask] = None
+    # Placement of the grid within a larger canvas (see data_helpers.trim_to_data_extent)
+    origin: Tuple[int, int] = (0, 0)
+    canvas_shape: Optional[Tuple[int, int]] = None
+    # The top of the quantization range, ie: what quantized_depth_values_norm are relative to
+    max_depth_m: Optional[float] = None
 
+    @cached_property
+    def depth_grid_quant(self) -> np.ndarray:
+        # Quantized depth (m) per cell, only materialized when asked for
+        return self.quantized_depth_values[self.level_grid]
 
-def quantize_depth_grid(
+    @cached_property
+    def depth_map_im_quant(self) -> Image.Image:
+        # Grayscale image w/ pixel values in range 0-255 corresponding to 0-max-depth
+        level_pixels = (255.0 * self.quantized_depth_values_norm).astype(np.uint8)
+        return Image.fromarray(level_pixels[self.level_grid])
+
+    def layer_mask(self, layer_idx: int, force_first_layer: bool = False) -> np.ndarray:
+        return layer_levels(self.quantized_depth_values, force_first_layer)[layer_idx][
+            self.level_grid
+        ]
+
+    def layer_threshold_m(
+        self, layer_idx: int, force_first_layer: bool = False
+    ) -> float:
+        # The depth above which cells are assigned to the levels of a layer, ie: the iso
+        # depth bounding layer_mask(layer_idx)
+        order = np.argsort(self.quantized_depth_values_norm, kind="stable")
+        in_layer = layer_levels(self.quantized_depth_values, force_first_layer)[
+            layer_idx
+        ][order]
+        first = int(np.argmax(in_layer)) if in_layer.any() else len(order)
+        assert in_layer[first:].all(), "A layer takes the levels above a depth"
+        if first == 0:
+            return -np.inf
+        if first == len(order):
+            return np.inf
+        sorted_norm = self.quantized_depth_values_norm[order]
+        return float(
+            (sorted_norm[first - 1] + sorted_norm[first]) / 2 * self.max_depth_m
+        )
+
+
+def layer_levels(
+    quantized_depth_values: np.ndarray, force_first_layer: bool = False
+) -> np.ndarray:
+    # (layers, levels) bool: whether each level is part of each layer. A layer takes the
+    # levels quantized to at least its depth (ie: quantized_depth_values[layer_idx + 1]).
+    # If forced, the first layer takes anything quantized to a depth > 0.
+    in_layer = quantized_depth_values[None, :] >= quantized_depth_values[1:, None]
+    if force_first_layer and len(in_layer):
+        in_layer[0] = quantized_depth_values > 0
+    return in_layer
+
+
+# Rows assigned to levels per block, bounds the transient index temporaries
+_QUANTIZE_BLOCK_ROWS = 1024
+
+
+def level_thresholds(sorted_norm: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    # The smallest value (of dtype) assigned to each level above the first: nearer to it
+    # than to the level below, w/ distances computed in dtype and ties to the lower level
+    # (ie: as by an argmin over |x - level|)
+    lo = sorted_norm[:-1].astype(dtype)
+    hi = sorted_norm[1:].astype(dtype)
+
+    def _upper_wins(x: np.ndarray) -> np.ndarray:
+        return (hi - x) < (x - lo)
+
+    # Rounding moves the switch off the midpoint by a few ulps at most
+    thresholds = ((lo + hi) / 2).astype(dtype)
+    # Duplicate levels never win, the lower is always taken
+    search = lo < hi
+    step = search & ~_upper_wins(thresholds)
+    while step.any():
+        thresholds[step] = np.nextafter(thresholds, hi)[step]
+        step = search & ~_upper_wins(thresholds)
+    below = np.nextafter(thresholds, lo)
+    step = search & _upper_wins(below)
+    while step.any():
+        thresholds[step] = below[step]
+        below = np.nextafter(thresholds, lo)
+        step = search & _upper_wins(below)
+    thresholds[~search] = np.inf
+    return thresholds
+
+
+def assign_levels(
     depth_grid: np.ndarray,
+    quantized_depth_values_norm: np.ndarray,
+    max_depth_m: float,
+    valid_mask: Optional[ValidMask] = None,
+) -> np.ndarray:
+    # Index of the nearest level for each cell (ties to the lower level): a binary search
+    # over the thresholds between the (sorted) levels, a cell on a threshold takes the
+    # level above
+    order = np.argsort(quantized_depth_values_norm, kind="stable")
+    dtype = (
+        depth_grid.dtype if np.issubdtype(depth_grid.dtype, np.floating) else np.float64
+    )
+    thresholds = level_thresholds(quantized_depth_values_norm[order], dtype)
+    level_lut = order.astype(np.uint8)
+    level_grid = np.zeros(depth_grid.shape, dtype=np.uint8)
+    rows_any = valid_mask.rows_any() if valid_mask is not None else None
+    for r in range(0, depth_grid.shape[0], _QUANTIZE_BLOCK_ROWS):
+        if rows_any is not None and not rows_any[r : r + _QUANTIZE_BLOCK_ROWS].any():
+            # Entirely NODATA, leave at the ground level
+            continue
+        # Normalized in the grid's precision
+        depth_norm = np.divide(
+            depth_grid[r : r + _QUANTIZE_BLOCK_ROWS], np.asarray(max_depth_m, dtype)
+        )
+        level_grid[r : r + _QUANTIZE_BLOCK_ROWS] = level_lut[
+            np.searchsorted(thresholds, depth_norm, side="right")
+        ]
+    return level_grid
+
+
+def decode_quantized_depths(
+    quantized_depth_values_norm: np.ndarray, max_depth_m: float
+) -> np.ndarray:
+    # Depths are those representable in the 8bit encoding of the depth map image
+    return (
+        np.array((255.0 * quantized_depth_values_norm).astype(np.uint8)).astype(
+            np.float32
+        )
+        * max_depth_m
+        / 255.0
+    )
+
+
+def quantize_depth_grid(
+    depth_grid: Grid,
     levels: int,
     quantize_depth_start_m: float = 0,
+    valid_mask: Optional[ValidMask] = None,
+    origin: Tuple[int, int] = (0, 0),
+    canvas_shape: Optional[Tuple[int, int]] = None,
+    max_depth_m: Optional[float] = None,
+    level_strategy: str = "linspace",
+    stats: Optional[GridStats] = None,
 ) -> QuantizeResult:
-    max_depth_m = depth_grid.max()
-    depth_grid_norm = depth_grid / depth_grid.max()
+    # max_depth_m: the top of the quantization range, if already known (ex: from GridStats)
+    # level_strategy: how levels are chosen, see LEVEL_STRATEGIES
+    # stats: statistics of the valid cells of depth_grid, computed if needed and not provided
+    assert levels <= 256, "Level indices are stored as uint8"
+    depth_grid = as_array(depth_grid)
+    if stats is None and level_strategy != "linspace":
+        stats = compute_array_stats(depth_grid, valid_mask)
+    if max_depth_m is None:
+        max_depth_m = stats.max if stats is not None else depth_grid.max()
 
     # Older method... producing pretty but randomly spaced intervals
     # depth_map_im_quant = depth_map_im_raw.quantize(args.levels)
 
-    # New method, producing evenly spaced intervals starting from a configurable depth
-    quantized_depth_values_norm = calculate_normalized_quantized_depths(
-        max_depth_m=max_depth_m,
-        levels=levels,
-        quantize_depth_start_m=quantize_depth_start_m,
-    )
-    depth_grid_norm_quant = np.zeros_like(depth_grid_norm)
-    for y in range(depth_grid_norm.shape[0]):
-        depth_grid_norm_quant[y] = quantized_depth_values_norm[
-            abs(depth_grid_norm[y, :] - quantized_depth_values_norm[:, None]).argmin(
-                axis=0
-            )
-        ]
-    depth_map_im_quant = Image.fromarray(
-        (255.0 * depth_grid_norm_quant).astype(np.uint8)
+    # New method, producing intervals (evenly spaced by default) starting from a configurable depth
+    quantized_depth_values_norm = LEVEL_STRATEGIES[level_strategy](
+        stats, max_depth_m, levels, quantize_depth_start_m
     )
 
-    # Convert image back to data
-    # # Convert back to RGB to avoid reduced colormap issues, and reduce back to 1 channel
-    depth_grid_quant = np.array(depth_map_im_quant.convert("RGB"))[:, :, 0].astype(
-        np.float32
+    level_grid = assign_levels(
+        depth_grid,
+        quantized_depth_values_norm,
+        max_depth_m=max_depth_m,
+        valid_mask=valid_mask,
     )
-    # # Convert from pixel range 0-255 back to depth range 0-max_depth
-    depth_grid_quant *= max_depth_m / 255.0
 
-    quantized_depth_values = (
-        np.array((255.0 * quantized_depth_values_norm).astype(np.uint8)).astype(
-            np.float32
-        )
-        * max_depth_m
-        / 255.0
+    quantized_depth_values = decode_quantized_depths(
+        quantized_depth_values_norm, max_depth_m
     )
 
     return QuantizeResult(
-        depth_grid_quant=depth_grid_quant,
-        depth_map_im_quant=depth_map_im_quant,
+        level_grid=level_grid,
         quantized_depth_values=quantized_depth_values,
         quantized_depth_values_norm=quantized_depth_values_norm,
+        valid_mask=valid_mask,
+        origin=origin,
+        canvas_shape=canvas_shape,
+        max_depth_m=float(max_depth_m),
     )
 
 
-def smooth_layer_mask(layer_mask: np.ndarray, scale_up_factor: int = 4) -> np.ndarray:
-    wip = layer_mask.astype(np.uint8) * 255
-    # Scale up
-    for _ in range(scale_up_factor // 2):
-        wip = cv2.pyrUp(wip)
-    for _ in range(15):
-        wip = cv2.medianBlur(wip, 7)
-    for _ in range(scale_up_factor // 2):
-        wip = cv2.pyrDown(wip)
-    # Threshold back
-    return wip >= 128
+def smooth_layer_mask(
+    layer_mask: Grid,
+    scale_up_factor: int = 4,
+    valid_mask: Optional[ValidMask] = None,
+    smoothing_method: str = "median",
+    smoothing_strength: Optional[float] = None,
+    smoothing_tile_size: Optional[int] = None,
+    smoothing_workers: int = 1,
+) -> np.ndarray:
+    # smoothing_method/smoothing_strength: see smoothing.SMOOTHING_METHODS
+    # smoothing_tile_size/smoothing_workers: if provided, smooth by (halo overlapped) tiles
+    # of this many cells across processes, bounding memory for large grids
+    layer_mask = as_array(layer_mask)
+    if not layer_mask.any():
+        # Nothing to smooth
+        return np.zeros(layer_mask.shape, dtype=bool)
+    wip = smooth_mask(
+        layer_mask,
+        scale_up_factor=scale_up_factor,
+        method=smoothing_method,
+        strength=smoothing_strength,
+        tile_size=smoothing_tile_size,
+        workers=smoothing_workers,
+    )
+    if valid_mask is not None:
+        # Don't let smoothing bleed into cells w/o data
+        wip &= valid_mask.unpack()
+    return wip
+
+
+def smooth_layer_counts(
+    quantize_results: QuantizeResult,
+    force_first_layer: bool = True,
+    scale_up_factor: int = 4,
+    smoothing_method: str = "median",
+    smoothing_strength: Optional[float] = None,
+    smoothing_tile_size: Optional[int] = None,
+    smoothing_workers: int = 1,
+) -> np.ndarray:
+    # Smooth every layer at once: the count of layers covering each cell is smoothed as a
+    # single field, and smoothed layer k is `result > k`. Layers are nested by construction
+    # and the cost doesn't grow w/ the number of layers.
+    in_layer = layer_levels(quantize_results.quantized_depth_values, force_first_layer)
+    layer_counts = in_layer.sum(axis=0).astype(np.uint8)[quantize_results.level_grid]
+    if not layer_counts.any():
+        # Nothing to smooth
+        return layer_counts
+    smoothed = smooth_layer_count_field(
+        layer_counts,
+        n_layers=len(in_layer),
+        scale_up_factor=scale_up_factor,
+        method=smoothing_method,
+        strength=smoothing_strength,
+        tile_size=smoothing_tile_size,
+        workers=smoothing_workers,
+    )
+    if quantize_results.valid_mask is not None:
+        # Don't let smoothing bleed into cells w/o data
+        quantize_results.valid_mask.fill_invalid(smoothed, 0)
+    return smoothed
+
+
+def remove_layer_specks(
+    layer_mask: Grid, min_speck_area_m2: float, cell_size_m: float
+) -> np.ndarray:
+    # Remove islands and fill holes (including pits w/o data) w/ a smaller physical area
+    # than min_speck_area_m2, so they never become contours. Applied to nested layers, nesting is preserved: a layer's
+    # islands/holes are within the (smaller) islands/holes of the layer above.
+    min_cells = math.ceil(min_speck_area_m2 / float(cell_size_m) ** 2)
+    if min_cells <= 1:
+        return layer_mask
+    return remove_specks(layer_mask, min_cells)
 
 
 @dataclass(frozen=True, eq=True)
@@ -121,81 +441,645 @@ class ContourResult:
     layer_shapes: List[Dict]
 
 
-def get_contours(
-    layer_mask: np.ndarray, simplify_tolerance: float = 0.001
+@dataclass(frozen=True, eq=True)
+class TracedContours:
+    # Contours before simplification, see simplify_contours
+    layer_mask_bw: np.ndarray
+    contours: Any
+    hierarchy: Any
+    # Normalized (n, 2) coords of each ring, and the (exterior, holes) ring indices of each
+    # shape
+    rings: List[np.ndarray]
+    shape_indices: List[Tuple[int, List[int]]]
+
+
+def _foreground_bounds(mask: np.ndarray, margin: int = 1) -> Optional[tuple]:
+    # (row0, row1, col0, col1) bounding the foreground w/ a margin, None if empty
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask[rows[0] : rows[-1] + 1].any(axis=0))
+    return (
+        max(rows[0] - margin, 0),
+        min(rows[-1] + 1 + margin, mask.shape[0]),
+        max(cols[0] - margin, 0),
+        min(cols[-1] + 1 + margin, mask.shape[1]),
+    )
+
+
+def _layer_shapes(
+    rings: List[np.ndarray],
+    shape_indices: List[Tuple[int, List[int]]],
+    simplify_tolerance: float,
+    simplify_method: str,
+    min_area: float = 0.0,
+) -> List[Dict]:
+    # rings: normalized (n, 2) coords, shape_indices: (exterior, holes) indices into rings
+    # Each ring gets the metadata of its simplified geometry (see simplify.ring_properties)
+    # and a role. Shapes/holes whose simplified area is below min_area are dropped.
+    def close_ring(ring: np.ndarray) -> List[List[float]]:
+        # Closed ring, as the exterior of a polygon
+        c = ring.tolist()
+        if c[0] != c[-1]:
+            c.append(c[0])
+        return c
+
+    # Simplify the rings of all shapes in one batch, holes are kept within their exterior
+    ring_indices = []
+    ring_parents = []
+    for contour_idx, hole_indices in shape_indices:
+        ring_parents += [-1] + [len(ring_indices)] * len(hole_indices)
+        ring_indices += [contour_idx, *hole_indices]
+    simplified, simplified_offsets = simplify_rings(
+        (
+            np.concatenate([rings[i] for i in ring_indices])
+            if ring_indices
+            else np.empty((0, 2))
+        ),
+        np.concatenate(([0], np.cumsum([len(rings[i]) for i in ring_indices]))),
+        tolerance=simplify_tolerance,
+        method=simplify_method,
+        ring_parents=np.array(ring_parents, dtype=np.intp),
+    )
+    properties = ring_properties(simplified, simplified_offsets)
+    simplified_rings = np.split(simplified, simplified_offsets[1:-1])
+    position = {ring_idx: k for k, ring_idx in enumerate(ring_indices)}
+
+    def ring_dict(ring_idx: int, role: str) -> Dict:
+        k = position[ring_idx]
+        return {
+            "vertices": close_ring(rings[ring_idx]),
+            "simplified": close_ring(simplified_rings[k]),
+            "metadata": {
+                "role": role,
+                "area": float(properties["area"][k]),
+                "perimeter": float(properties["perimeter"][k]),
+                "bbox": properties["bbox"][k].tolist(),
+                "centroid": properties["centroid"][k].tolist(),
+                "vertex_count": int(properties["vertex_count"][k]),
+            },
+        }
+
+    def keep(ring_idx: int) -> bool:
+        return abs(properties["area"][position[ring_idx]]) >= min_area
+
+    return [
+        {
+            **ring_dict(contour_idx, "outer"),
+            "holes": [
+                ring_dict(h_idx, "hole") for h_idx in hole_indices if keep(h_idx)
+            ],
+        }
+        for contour_idx, hole_indices in shape_indices
+        if keep(contour_idx)
+    ]
+
+
+def simplify_contours(
+    traced: TracedContours,
+    simplify_tolerance: float = 0.001,
+    simplify_method: str = "douglas_peucker",
+    min_area: float = 0.0,
 ) -> ContourResult:
+    # simplify_method: see simplify.SIMPLIFY_METHODS, simplify_tolerance is in normalized
+    # coordinates
+    # min_area: shapes/holes w/ a smaller (simplified, normalized) area are dropped
+    return ContourResult(
+        layer_mask_bw=traced.layer_mask_bw,
+        contours=traced.contours,
+        hierarchy=traced.hierarchy,
+        layer_shapes=_layer_shapes(
+            traced.rings,
+            traced.shape_indices,
+            simplify_tolerance=simplify_tolerance,
+            simplify_method=simplify_method,
+            min_area=min_area,
+        ),
+    )
+
+
+def trace_contours(
+    layer_mask: Grid,
+    valid_mask: Optional[ValidMask] = None,
+    origin: Tuple[int, int] = (0, 0),
+    canvas_shape: Optional[Tuple[int, int]] = None,
+) -> TracedContours:
+    # origin/canvas_shape: placement of the mask within a larger canvas, normalized
+    # coordinates are relative to that canvas
+    layer_mask = as_array(layer_mask)
+    if valid_mask is not None:
+        layer_mask = layer_mask & valid_mask.unpack()
     result = 255 * layer_mask.astype(np.uint8)
 
-    # Detect contours and save polygon info
-    contours, hierarchy = cv2.findContours(
-        result, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
+    # Detect contours and save polygon info, tracing only the region holding foreground
+    bounds = _foreground_bounds(layer_mask)
+    if bounds is None:
+        contours, hierarchy = (), None
+    else:
+        r0, r1, c0, c1 = bounds
+        contours, hierarchy = cv2.findContours(
+            result[r0:r1, c0:c1],
+            cv2.RETR_TREE,
+            cv2.CHAIN_APPROX_SIMPLE,
+            offset=(int(c0), int(r0)),
+        )
+    if hierarchy is None:
+        hierarchy = np.empty((1, 0, 4), dtype=np.int32)
+    canvas_offset = np.array([origin[1], origin[0]], dtype=np.float32)
+    canvas_size = int(max(canvas_shape or result.shape))
+
+    # Normalize all contours at once, to coords on a square canvas (range 0:1)
+    vert_counts = np.array([len(c) for c in contours], dtype=np.intp)
+    points = (
+        (
+            np.concatenate(contours).reshape(-1, 2).astype(np.float32)
+            if len(contours)
+            else np.empty((0, 2), dtype=np.float32)
+        )
+        + canvas_offset
+    ) / canvas_size
+    contour_points = (
+        np.split(points, np.cumsum(vert_counts)[:-1]) if len(contours) else []
+    )
+
+    # Children of each contour, in index order, by grouping contours on their parent
+    parents = hierarchy[0][:, 3]
+    by_parent = np.argsort(parents, kind="stable")
+    child_ranges = np.searchsorted(
+        parents[by_parent], np.arange(-1, len(contours) + 1), side="left"
     )
-    # Normalize to range 0:1
-    layer_shapes = []
-    for top_level_contour_idx in [
-        c_idx for c_idx in range(hierarchy.shape[1]) if hierarchy[0][c_idx][3] == -1
-    ]:
-
-        def get_poly(contour_index: int, simp_tolerance: float = 0):
-            # # Store as normalized coords relative to original image
-            # c = np.squeeze(contours[contour_index], axis=1).astype(np.float32)
-            # c[:, 0] /= int(result.shape[1])
-            # c[:, 1] /= int(result.shape[0])
-            # c = c.tolist()
-
-            # Store as normalized coords on a square canvas
-            c = (
-                np.squeeze(contours[contour_index], axis=1).astype(np.float32)
-                / int(max(result.shape))
-            ).tolist()
-
-            # Convert to polygon
-            poly = geometry.Polygon(c)
-            if simp_tolerance > 0:
-                return poly.simplify(tolerance=simp_tolerance)
-            return poly
-
-        def get_verts(poly):
-            return [list(xy) for xy in zip(*poly.exterior.coords.xy)]
-
-        def get_vert_count(contour_index: int):
-            return len(np.squeeze(contours[contour_index], axis=1))
-
-        if get_vert_count(top_level_contour_idx) <= 2:
-            continue
 
-        # identify contours which represent holes in this contour
-        hole_indices = [
-            c_idx
-            for c_idx in range(hierarchy.shape[1])
-            if hierarchy[0][c_idx][3] == top_level_contour_idx
+    def get_children(contour_index: int) -> np.ndarray:
+        # contour_index -1 for top level contours
+        return by_parent[
+            child_ranges[contour_index + 1] : child_ranges[contour_index + 2]
         ]
 
-        layer_shapes.append(
-            {
-                "vertices": get_verts(get_poly(top_level_contour_idx)),
-                "simplified": get_verts(
-                    get_poly(top_level_contour_idx, simp_tolerance=simplify_tolerance)
-                ),
-                "holes": [
-                    {
-                        "vertices": get_verts(get_poly(h_idx)),
-                        "simplified": get_verts(
-                            get_poly(h_idx, simp_tolerance=simplify_tolerance)
-                        ),
-                    }
-                    for h_idx in hole_indices
-                    if get_vert_count(h_idx) > 2
-                ],
-            }
+    # Polygons are the contours at even depths of the tree (outer boundaries, islands within
+    # their holes, ...) w/ their children as holes. Depth first, so each polygon is followed
+    # by the polygons nested within it.
+    shape_indices = []
+    stack = get_children(-1)[::-1].tolist()
+    while stack:
+        contour_idx = stack.pop()
+        hole_indices = get_children(contour_idx)
+        stack.extend(
+            nested_idx
+            for h_idx in hole_indices[::-1]
+            for nested_idx in get_children(h_idx)[::-1]
+        )
+        if vert_counts[contour_idx] <= 2:
+            continue
+        shape_indices.append(
+            (contour_idx, [h_idx for h_idx in hole_indices if vert_counts[h_idx] > 2])
         )
 
-    return ContourResult(
+    return TracedContours(
         layer_mask_bw=result,
         contours=contours,
         hierarchy=hierarchy,
-        layer_shapes=layer_shapes,
+        rings=contour_points,
+        shape_indices=shape_indices,
+    )
+
+
+def get_contours(
+    layer_mask: Grid,
+    simplify_tolerance: float = 0.001,
+    valid_mask: Optional[ValidMask] = None,
+    origin: Tuple[int, int] = (0, 0),
+    canvas_shape: Optional[Tuple[int, int]] = None,
+    simplify_method: str = "douglas_peucker",
+    min_area: float = 0.0,
+) -> ContourResult:
+    # Trace then simplify, see trace_contours and simplify_contours
+    return simplify_contours(
+        trace_contours(
+            layer_mask, valid_mask=valid_mask, origin=origin, canvas_shape=canvas_shape
+        ),
+        simplify_tolerance=simplify_tolerance,
+        simplify_method=simplify_method,
+        min_area=min_area,
+    )
+
+
+# How layer contours are traced: from the (smoothed, upsampled) layer mask, or as iso
+# lines of the depth grid
+CONTOUR_METHODS = ("raster", "marching_squares")
+
+
+def filter_depth_grid(
+    depth_grid: Grid, sigma: float, valid_mask: Optional[ValidMask] = None
+) -> np.ndarray:
+    # Gaussian blur (sigma in cells) of the valid cells only, normalized by the blurred
+    # valid weight so cells w/o data don't drag depths towards 0
+    values = as_array(depth_grid).astype(np.float32)
+    if valid_mask is None:
+        return cv2.GaussianBlur(values, (0, 0), sigmaX=sigma)
+    weights = valid_mask.unpack().astype(np.float32)
+    blurred = cv2.GaussianBlur(values * weights, (0, 0), sigmaX=sigma)
+    blurred_weights = cv2.GaussianBlur(weights, (0, 0), sigmaX=sigma)
+    return np.divide(blurred, blurred_weights, out=values, where=blurred_weights > 0)
+
+
+def trace_iso_contours(
+    depth_grid: Grid,
+    threshold_m: float,
+    valid_mask: Optional[ValidMask] = None,
+    origin: Tuple[int, int] = (0, 0),
+    canvas_shape: Optional[Tuple[int, int]] = None,
+    smoothing_sigma: float = 0.0,
+) -> TracedContours:
+    # Contours of the cells deeper than threshold_m (see QuantizeResult.layer_threshold_m),
+    # traced by marching squares on the depth grid itself. Crossings are interpolated to
+    # sub-cell accuracy, so contours are smooth at native resolution w/o upsampling.
+    # smoothing_sigma: if > 0, the depth grid is lightly blurred first (in cells)
+    # See trace_contours for the other arguments.
+    depth_grid = as_array(depth_grid)
+    if smoothing_sigma > 0:
+        depth_grid = filter_depth_grid(depth_grid, smoothing_sigma, valid_mask)
+    valid = valid_mask.unpack() if valid_mask is not None else None
+    iso_rings = trace_iso_rings(depth_grid, threshold_m, valid=valid)
+    layer_mask = depth_grid > threshold_m
+    if valid is not None:
+        layer_mask &= valid
+    result = 255 * layer_mask.astype(np.uint8)
+
+    canvas_offset = np.array([origin[1], origin[0]], dtype=np.float64)
+    canvas_size = int(max(canvas_shape or result.shape))
+    grid_rings = np.split(iso_rings.points, iso_rings.ring_offsets[1:-1])
+    rings = [(ring + canvas_offset) / canvas_size for ring in grid_rings]
+
+    # Each region is bounded by one outer ring, w/ its holes
+    holes_by_region: Dict[int, List[int]] = {}
+    for ring_idx in np.flatnonzero(iso_rings.is_hole):
+        holes_by_region.setdefault(int(iso_rings.region[ring_idx]), []).append(
+            int(ring_idx)
+        )
+    shape_indices = [
+        (int(ring_idx), holes_by_region.get(int(iso_rings.region[ring_idx]), []))
+        for ring_idx in np.flatnonzero(~iso_rings.is_hole)
+    ]
+
+    # cv2 style contours/hierarchy (parent only) for plotting
+    outer_of_region = {
+        int(iso_rings.region[ring_idx]): int(ring_idx) for ring_idx, _ in shape_indices
+    }
+    hierarchy = np.full((1, len(grid_rings), 4), -1, dtype=np.int32)
+    for ring_idx in np.flatnonzero(iso_rings.is_hole):
+        hierarchy[0, ring_idx, 3] = outer_of_region.get(
+            int(iso_rings.region[ring_idx]), -1
+        )
+    contours = [
+        np.round(ring).astype(np.int32).reshape(-1, 1, 2) for ring in grid_rings
+    ]
+
+    return TracedContours(
+        layer_mask_bw=result,
+        contours=contours,
+        hierarchy=hierarchy,
+        rings=rings,
+        shape_indices=shape_indices,
+    )
+
+
+def get_iso_contours(
+    depth_grid: Grid,
+    threshold_m: float,
+    simplify_tolerance: float = 0.001,
+    valid_mask: Optional[ValidMask] = None,
+    origin: Tuple[int, int] = (0, 0),
+    canvas_shape: Optional[Tuple[int, int]] = None,
+    simplify_method: str = "douglas_peucker",
+    smoothing_sigma: float = 0.0,
+    min_area: float = 0.0,
+) -> ContourResult:
+    # Trace then simplify, see trace_iso_contours and simplify_contours
+    return simplify_contours(
+        trace_iso_contours(
+            depth_grid,
+            threshold_m,
+            valid_mask=valid_mask,
+            origin=origin,
+            canvas_shape=canvas_shape,
+            smoothing_sigma=smoothing_sigma,
+        ),
+        simplify_tolerance=simplify_tolerance,
+        simplify_method=simplify_method,
+        min_area=min_area,
+    )
+
+
+@dataclass(frozen=True)
+class _LayerExport:
+    # Everything needed to export any single layer, see export_quantize_results
+    quantize_results: QuantizeResult
+    output_dir: Path
+    # The artifacts to export, see artifacts.EXPORT_ARTIFACTS
+    artifacts: Tuple[str, ...]
+    # Paths in the manifest are relative to it
+    manifest_root: Path
+    force_first_layer: bool
+    scale_up_factor: int
+    simplify_tolerance: float
+    smoothing_method: str
+    smoothing_strength: Optional[float]
+    smoothing_tile_size: Optional[int]
+    smoothing_workers: int
+    simplify_method: str
+    contour_method: str
+    min_area: float
+    min_speck_area_m2: float
+    cell_size_m: Optional[float]
+    # Filtered once for all layers, if tracing iso lines
+    depth_grid: Optional[np.ndarray]
+    iso_smoothing_sigma: float
+    # Smoothed once for all layers, if smoothing once
+    smoothed_layer_counts: Optional[np.ndarray]
+    writer_threads: int
+    # Stage outputs are cached in cache, if provided, downstream of cache_key (the key of
+    # the quantize results). smooth_once_key: the key of smoothed_layer_counts.
+    cache: Optional[StageCache]
+    cache_key: Optional[str]
+    smooth_once_key: Optional[str]
+
+
+def _write_json(path: Path, obj: Any) -> None:
+    with open(path, "w") as f:
+        json.dump(obj, f)
+
+
+def _export_layer(
+    job: _LayerExport,
+    layer_idx: int,
+    writer: ArtifactWriter,
+    manifest: ArtifactManifest,
+) -> int:
+    # Artifacts are written by the writer, in the background. Stages are computed lazily,
+    # only if the selected artifacts need them and they aren't cached (see stage_cache).
+    def _wants(name: str) -> bool:
+        return name in job.artifacts
+
+    def _path(name: str) -> Path:
+        return job.output_dir / EXPORT_ARTIFACTS[name].path.format(layer_idx=layer_idx)
+
+    def _submit(name: str, write: Callable[[Path], Any], render_start: float):
+        path = _path(name)
+        writer.submit(
+            manifest.timed_write(
+                name,
+                path,
+                partial(write, path),
+                render_seconds=time.perf_counter() - render_start,
+            )
+        )
+
+    def _stage(
+        stage: str, key: str, compute: Callable[..., Any], *inputs: Callable[[], Any]
+    ) -> Callable[[], Any]:
+        return lazy_stage(
+            job.cache,
+            key,
+            compute,
+            *inputs,
+            record=lambda seconds, cached: manifest.record_stage(
+                stage, seconds, layer_idx, cached=cached
+            ),
+        )
+
+    # Retrieve the mask for this layer. If configured for the first layer, ignore the
+    # quantization and take anything with a depth reading > 0. Cheaper to derive than to
+    # load, so it's keyed but not cached.
+    mask_key = stage_key(
+        "mask",
+        {"layer_idx": layer_idx, "force_first_layer": job.force_first_layer},
+        job.cache_key,
     )
+    layer_mask = cache(
+        partial(
+            job.quantize_results.layer_mask,
+            layer_idx,
+            force_first_layer=job.force_first_layer,
+        )
+    )
+    if job.contour_method == "marching_squares":
+        contour_key = stage_key(
+            "contour",
+            {
+                "method": job.contour_method,
+                "iso_smoothing_sigma": job.iso_smoothing_sigma,
+            },
+            mask_key,
+        )
+        traced = _stage(
+            "contour",
+            contour_key,
+            lambda: trace_iso_contours(
+                as_array(job.depth_grid),
+                threshold_m=job.quantize_results.layer_threshold_m(
+                    layer_idx, force_first_layer=job.force_first_layer
+                ),
+                valid_mask=job.quantize_results.valid_mask,
+                origin=job.quantize_results.origin,
+                canvas_shape=job.quantize_results.canvas_shape,
+            ),
+        )
+
+        def layer_mask_smoothed():
+            return traced().layer_mask_bw > 0
+
+    else:
+
+        def _smooth(layer_mask: np.ndarray) -> np.ndarray:
+            if job.smoothed_layer_counts is not None:
+                smoothed = job.smoothed_layer_counts > layer_idx
+            else:
+                smoothed = smooth_layer_mask(
+                    layer_mask,
+                    scale_up_factor=job.scale_up_factor,
+                    valid_mask=job.quantize_results.valid_mask,
+                    smoothing_method=job.smoothing_method,
+                    smoothing_strength=job.smoothing_strength,
+                    smoothing_tile_size=job.smoothing_tile_size,
+                    smoothing_workers=job.smoothing_workers,
+                )
+            if job.min_speck_area_m2 > 0:
+                smoothed = remove_layer_specks(
+                    smoothed, job.min_speck_area_m2, job.cell_size_m
+                )
+            return smoothed
+
+        # Tiling doesn't change the result, so isn't part of the key
+        smooth_key = stage_key(
+            "smooth",
+            {
+                "scale_up_factor": job.scale_up_factor,
+                "smoothing_method": job.smoothing_method,
+                "smoothing_strength": job.smoothing_strength,
+                "min_speck_area_m2": job.min_speck_area_m2,
+                "cell_size_m": job.cell_size_m,
+            },
+            mask_key,
+            job.smooth_once_key,
+        )
+        layer_mask_smoothed = _stage("smooth", smooth_key, _smooth, layer_mask)
+        contour_key = stage_key("contour", {"method": job.contour_method}, smooth_key)
+        traced = _stage(
+            "contour",
+            contour_key,
+            lambda layer_mask_smoothed: trace_contours(
+                layer_mask_smoothed,
+                # Already applied when smoothing, and filled holes may cover cells w/o data
+                valid_mask=(
+                    None
+                    if job.min_speck_area_m2 > 0
+                    else job.quantize_results.valid_mask
+                ),
+                origin=job.quantize_results.origin,
+                canvas_shape=job.quantize_results.canvas_shape,
+            ),
+            layer_mask_smoothed,
+        )
+    contour_results = _stage(
+        "simplify",
+        stage_key(
+            "simplify",
+            {
+                "simplify_tolerance": job.simplify_tolerance,
+                "simplify_method": job.simplify_method,
+                "min_area": job.min_area,
+            },
+            contour_key,
+        ),
+        lambda traced: simplify_contours(
+            traced,
+            simplify_tolerance=job.simplify_tolerance,
+            simplify_method=job.simplify_method,
+            min_area=job.min_area,
+        ),
+        traced,
+    )
+
+    # Each artifact's render time starts once the stages it's rendered from are resolved,
+    # their time is recorded w/ the stages
+    if _wants("layer_mask"):
+        mask = layer_mask()
+        start = time.perf_counter()
+        layer_mask_im = Image.fromarray(255 * mask.astype(np.uint8))
+        _submit("layer_mask", layer_mask_im.save, start)
+    if _wants("layer_mask_smoothed"):
+        mask_smoothed = layer_mask_smoothed()
+        start = time.perf_counter()
+        im_smoothed = Image.fromarray(np.invert(mask_smoothed))
+        _submit("layer_mask_smoothed", im_smoothed.save, start)
+    # with NamedTemporaryFile("w", suffix=".pnm") as f:
+    #     # potrace raster-> svg required .pnm file as input
+    #     im_smoothed.save(f.name)
+    #     subprocess.run(
+    #         [
+    #             "potrace",
+    #             f.name,
+    #             "-s",
+    #             "-o",
+    #             osp.join(output_layers_dir, f"layer_{layer_idx}_smoothed.svg"),
+    #         ]
+    #     )
+    if _wants("contours_json"):
+        layer_shapes = contour_results().layer_shapes
+        _submit(
+            "contours_json",
+            lambda path: _write_json(path, layer_shapes),
+            time.perf_counter(),
+        )
+    if _wants("contours_binary"):
+        layer_shapes = contour_results().layer_shapes
+        _submit(
+            "contours_binary",
+            lambda path: write_contours(
+                path, ContourBuffers.from_layer_shapes(layer_shapes)
+            ),
+            time.perf_counter(),
+        )
+    if _wants("contours_viz"):
+        layer_shapes = contour_results().layer_shapes
+        start = time.perf_counter()
+        # Rendered here rather than by a writer thread, as pyplot isn't thread-safe. The
+        # writer only writes the encoded image.
+        fig = plot_polys(layer_shapes)
+        encoded = BytesIO()
+        fig.savefig(encoded, format=_path("contours_viz").suffix[1:])
+        plt.close(fig)
+        _submit(
+            "contours_viz", lambda path: path.write_bytes(encoded.getvalue()), start
+        )
+    if _wants("contours_overlay"):
+        results = contour_results()
+        start = time.perf_counter()
+        contours_im = _plot_contour_results(
+            background=results.layer_mask_bw,
+            contours=results.contours,
+            hierarchy=results.hierarchy,
+        )
+        _submit(
+            "contours_overlay",
+            lambda path: cv2.imwrite(str(path), contours_im),
+            start,
+        )
+    return layer_idx
+
+
+# The export of the current worker process, set once by _init_export_worker
+_worker_export: Optional[_LayerExport] = None
+
+
+def _share_job_grids(job: _LayerExport, stack: ExitStack) -> _LayerExport:
+    # The job w/ its grids moved to shared memory (for the duration of stack), so workers
+    # attach to one copy of them rather than each receiving its own
+    def _share(grid: Optional[np.ndarray]) -> Optional[Grid]:
+        return None if grid is None else stack.enter_context(share_grid(grid))
+
+    return replace(
+        job,
+        quantize_results=replace(
+            job.quantize_results,
+            level_grid=_share(job.quantize_results.level_grid),
+        ),
+        depth_grid=_share(job.depth_grid),
+        smoothed_layer_counts=_share(job.smoothed_layer_counts),
+    )
+
+
+def _attach_job_grids(job: _LayerExport) -> _LayerExport:
+    # Inverse of _share_job_grids, in a worker
+    def _attach(grid: Optional[Grid]) -> Optional[np.ndarray]:
+        return None if grid is None else as_array(grid)
+
+    return replace(
+        job,
+        quantize_results=replace(
+            job.quantize_results,
+            level_grid=_attach(job.quantize_results.level_grid),
+        ),
+        depth_grid=_attach(job.depth_grid),
+        smoothed_layer_counts=_attach(job.smoothed_layer_counts),
+    )
+
+
+def _init_export_worker(job: _LayerExport):
+    # The job is handed to each worker once, rather than pickled per layer, and its grids
+    # are attached from shared memory
+    global _worker_export
+    _worker_export = _attach_job_grids(job)
+    # Parallelism is across layers, avoid oversubscribing cores w/ cv2's own threads
+    cv2.setNumThreads(1)
+
+
+def _export_layer_in_worker(layer_idx: int) -> Tuple[List[Dict], List[Dict]]:
+    # The layer is done once its artifacts are written. Returns its manifest records.
+    manifest = ArtifactManifest(_worker_export.manifest_root)
+    with ArtifactWriter(threads=_worker_export.writer_threads) as writer:
+        _export_layer(_worker_export, layer_idx, writer, manifest)
+    return manifest.artifacts, manifest.stages
 
 
 def export_quantize_results(
@@ -204,63 +1088,205 @@ def export_quantize_results(
     force_first_layer: bool = True,
     scale_up_factor: int = 4,
     simplify_tolerance: float = 0.001,
+    smoothing_method: str = "median",
+    smoothing_strength: Optional[float] = None,
+    smooth_once: bool = False,
+    smoothing_tile_size: Optional[int] = None,
+    smoothing_workers: int = 1,
+    simplify_method: str = "douglas_peucker",
+    binary_contours: bool = False,
+    contour_method: str = "raster",
+    depth_grid: Optional[Grid] = None,
+    iso_smoothing_sigma: float = 0.0,
+    min_area: float = 0.0,
+    min_speck_area_m2: float = 0.0,
+    cell_size_m: Optional[float] = None,
+    workers: int = 1,
+    progress: Optional[Callable[[int, int], None]] = None,
+    writer_threads: int = 2,
+    artifacts: Optional[Collection[str]] = None,
+    manifest: Optional[ArtifactManifest] = None,
+    cache: Optional[StageCache] = None,
+    cache_key: Optional[str] = None,
 ):
+    # contour_method: see CONTOUR_METHODS. marching_squares traces the depth_grid the
+    # results were quantized from, lightly blurred by iso_smoothing_sigma (in cells), and
+    # ignores the mask smoothing arguments.
+    # smooth_once: smooth all layers from a single field (see smooth_layer_counts), rather
+    # than each layer mask independently
+    # smoothing_tile_size/smoothing_workers: see smooth_layer_mask
+    # min_area: see get_contours
+    # min_speck_area_m2/cell_size_m: see remove_layer_specks, applied to the smoothed masks
+    # of raster contours
+    # binary_contours: also write each layer's contours in the binary format, see
+    # contour_format. Same as selecting the contours_binary artifact.
+    # workers: the number of processes exporting layers concurrently. Layers are
+    # independent, so the output is identical to exporting them one by one.
+    # progress: called w/ (layers done, layers total) as each layer is exported
+    # writer_threads: the number of threads writing artifacts in the background (per
+    # worker), see io.ArtifactWriter. 0 writes them synchronously.
+    # artifacts: the outputs to export (see artifacts.EXPORT_ARTIFACTS, others are
+    # ignored), all of them but the binary contours by default. Only the intermediates
+    # they need are computed.
+    # manifest: records what was exported, w/ sizes and timings. If not provided, one is
+    # written to output_dir/manifest.json.
+    # cache: caches the output of each stage (smooth, contour, simplify) per layer, so
+    # re-exporting w/ a tweaked parameter only recomputes the stages downstream of it.
+    # cache_key: the key of the quantize results (and depth grid) in the cache, see
+    # stage_cache.stage_key
+    assert (
+        min_speck_area_m2 <= 0 or cell_size_m is not None
+    ), "Removing specks requires the cell size"
+    assert cache is None or cache_key is not None, "Caching requires the results' key"
+    if artifacts is None:
+        artifacts = DEFAULT_ARTIFACTS
+    artifacts = tuple(
+        name
+        for name in EXPORT_ARTIFACTS
+        if name in artifacts or (binary_contours and name == "contours_binary")
+    )
+    write_manifest = manifest is None
+    if write_manifest:
+        manifest = ArtifactManifest(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    quantize_results.depth_map_im_quant.save(output_dir / "depth_map_quantized.png")
-
-    with open(output_dir / "quantized_depth_values.json", "w") as f:
-        json.dump(quantize_results.quantized_depth_values.tolist(), f)
-
-    output_layers_dir = output_dir / "layer_masks"
-    output_layers_dir.mkdir(parents=True, exist_ok=True)
-    for layer_idx, layer_depth in enumerate(
-        quantize_results.quantized_depth_values[1:]
-    ):
-        # Retrieve the mask for this layer. If configured for the first layer, ignore the quantization and take anything with a depth reading > 0
-        layer_mask = (
-            quantize_results.depth_grid_quant > 0
-            if layer_idx == 0 and force_first_layer
-            else quantize_results.depth_grid_quant >= layer_depth
-        )
-        layer_mask_smoothed = smooth_layer_mask(
-            layer_mask, scale_up_factor=scale_up_factor
-        )
-        layer_mask_im = Image.fromarray(255 * layer_mask.astype(np.uint8))
-        layer_mask_im.save(output_layers_dir / f"layer_{layer_idx}.jpg")
-
-        im_smoothed = Image.fromarray(np.invert(layer_mask_smoothed))
-        im_smoothed.save(output_layers_dir / f"layer_{layer_idx}_smoothed.jpg")
-        # with NamedTemporaryFile("w", suffix=".pnm") as f:
-        #     # potrace raster-> svg required .pnm file as input
-        #     im_smoothed.save(f.name)
-        #     subprocess.run(
-        #         [
-        #             "potrace",
-        #             f.name,
-        #             "-s",
-        #             "-o",
-        #             osp.join(output_layers_dir, f"layer_{layer_idx}_smoothed.svg"),
-        #         ]
-        #     )
-
-        contour_results = get_contours(
-            layer_mask=layer_mask_smoothed, simplify_tolerance=simplify_tolerance
-        )
-        with open(output_layers_dir / f"layer_{layer_idx}_contours.json", "w") as f:
-            json.dump(
-                contour_results.layer_shapes,
-                f,
+    (output_dir / "layer_masks").mkdir(parents=True, exist_ok=True)
+    with ArtifactWriter(threads=writer_threads) as writer:
+        if "depth_map_quantized" in artifacts:
+            start = time.perf_counter()
+            depth_map_im_quant = quantize_results.depth_map_im_quant
+            path = output_dir / EXPORT_ARTIFACTS["depth_map_quantized"].path
+            writer.submit(
+                manifest.timed_write(
+                    "depth_map_quantized",
+                    path,
+                    partial(depth_map_im_quant.save, path),
+                    render_seconds=time.perf_counter() - start,
+                )
+            )
+        if "quantized_depth_values" in artifacts:
+            path = output_dir / EXPORT_ARTIFACTS["quantized_depth_values"].path
+            writer.submit(
+                manifest.timed_write(
+                    "quantized_depth_values",
+                    path,
+                    partial(
+                        _write_json,
+                        path,
+                        quantize_results.quantized_depth_values.tolist(),
+                    ),
+                )
             )
 
-        fig = plot_polys(contour_results.layer_shapes)
-        plt.savefig(output_layers_dir / f"layer_{layer_idx}_contours_viz.jpg")
-        plt.close()
-
-        cv2.imwrite(
-            str(output_layers_dir / f"layer_{layer_idx}_contours.jpg"),
-            _plot_contour_results(
-                background=contour_results.layer_mask_bw,
-                contours=contour_results.contours,
-                hierarchy=contour_results.hierarchy,
-            ),
+        smoothed_layer_counts, smooth_once_key = None, None
+        if (
+            smooth_once
+            and contour_method == "raster"
+            and needs_intermediate(artifacts, "smoothed_mask")
+        ):
+            start = time.perf_counter()
+            smooth_once_key = stage_key(
+                "smooth_once",
+                {
+                    "force_first_layer": force_first_layer,
+                    "scale_up_factor": scale_up_factor,
+                    "smoothing_method": smoothing_method,
+                    "smoothing_strength": smoothing_strength,
+                },
+                cache_key,
+            )
+            smoothed_layer_counts, cached = run_stage(
+                cache,
+                smooth_once_key,
+                lambda: smooth_layer_counts(
+                    quantize_results,
+                    force_first_layer=force_first_layer,
+                    scale_up_factor=scale_up_factor,
+                    smoothing_method=smoothing_method,
+                    smoothing_strength=smoothing_strength,
+                    smoothing_tile_size=smoothing_tile_size,
+                    smoothing_workers=smoothing_workers,
+                ),
+            )
+            manifest.record_stage(
+                "smooth_once", time.perf_counter() - start, cached=cached
+            )
+        if contour_method == "marching_squares" and needs_intermediate(
+            artifacts, "smoothed_mask"
+        ):
+            assert depth_grid is not None, "Tracing iso lines requires the depth grid"
+            depth_grid = as_array(depth_grid)
+            if iso_smoothing_sigma > 0:
+                # Once for all layers
+                start = time.perf_counter()
+                depth_grid, cached = run_stage(
+                    cache,
+                    stage_key(
+                        "filter_depth_grid",
+                        {"iso_smoothing_sigma": iso_smoothing_sigma},
+                        cache_key,
+                    ),
+                    partial(
+                        filter_depth_grid,
+                        depth_grid,
+                        iso_smoothing_sigma,
+                        quantize_results.valid_mask,
+                    ),
+                )
+                manifest.record_stage(
+                    "filter_depth_grid", time.perf_counter() - start, cached=cached
+                )
+        else:
+            depth_grid = None
+        job = _LayerExport(
+            quantize_results=quantize_results,
+            output_dir=output_dir,
+            artifacts=artifacts,
+            manifest_root=manifest.root,
+            force_first_layer=force_first_layer,
+            scale_up_factor=scale_up_factor,
+            simplify_tolerance=simplify_tolerance,
+            smoothing_method=smoothing_method,
+            smoothing_strength=smoothing_strength,
+            smoothing_tile_size=smoothing_tile_size,
+            smoothing_workers=smoothing_workers,
+            simplify_method=simplify_method,
+            contour_method=contour_method,
+            min_area=min_area,
+            min_speck_area_m2=min_speck_area_m2,
+            cell_size_m=cell_size_m,
+            depth_grid=depth_grid,
+            iso_smoothing_sigma=iso_smoothing_sigma,
+            smoothed_layer_counts=smoothed_layer_counts,
+            writer_threads=writer_threads,
+            cache=cache,
+            cache_key=cache_key,
+            smooth_once_key=smooth_once_key,
         )
+        n_layers = len(quantize_results.quantized_depth_values) - 1
+        if progress is not None:
+            progress(0, n_layers)
+        if workers <= 1 or n_layers <= 1:
+            for layer_idx in range(n_layers):
+                _export_layer(job, layer_idx, writer, manifest)
+                if progress is not None:
+                    progress(layer_idx + 1, n_layers)
+        else:
+            # Workers write their own layers. No writes in flight while forking them, a
+            # writer thread could hold a lock the workers inherit.
+            writer.flush()
+            with ExitStack() as stack, ProcessPoolExecutor(
+                max_workers=min(workers, n_layers),
+                initializer=_init_export_worker,
+                initargs=(_share_job_grids(job, stack),),
+            ) as executor:
+                futures = [
+                    executor.submit(_export_layer_in_worker, layer_idx)
+                    for layer_idx in range(n_layers)
+                ]
+                for n_done, future in enumerate(as_completed(futures), start=1):
+                    # Raises if the layer failed
+                    manifest.merge(*future.result())
+                    if progress is not None:
+                        progress(n_done, n_layers)
+    if write_manifest:
+        manifest.write()
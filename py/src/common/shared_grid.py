@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, Iterator, Tuple, Union
+
+import numpy as np
+
+# Segments attached by this process, by name. Kept open for the life of the process (ie:
+# a pool worker), so attached views stay valid and repeated attaches are free.
+_attached: Dict[str, shared_memory.SharedMemory] = {}
+
+
+@dataclass(frozen=True)
+class SharedGrid:
+    # A handle to a grid in shared memory. Cheap to pickle, so it can be handed to any
+    # number of worker processes, which all attach to the one physical copy.
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+    def attach(self) -> np.ndarray:
+        # Read-only view of the grid, w/o copying
+        shm = _attached.get(self.name)
+        if shm is None:
+            shm = _attached[self.name] = shared_memory.SharedMemory(name=self.name)
+        view = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        view.flags.writeable = False
+        return view
+
+
+# A grid, either in this process' memory or shared
+Grid = Union[np.ndarray, SharedGrid]
+
+
+def as_array(grid: Grid) -> np.ndarray:
+    # Accept either kind of grid, shared grids are attached (read-only)
+    if isinstance(grid, SharedGrid):
+        return grid.attach()
+    return grid
+
+
+@contextmanager
+def share_grid(grid: np.ndarray) -> Iterator[SharedGrid]:
+    # Copy a grid to shared memory for the duration of the context. The segment is
+    # unlinked on exit (or by the resource tracker if this process dies first), so the
+    # grid's memory is released once every attached process is done w/ it.
+    grid = np.ascontiguousarray(grid)
+    shm = shared_memory.SharedMemory(create=True, size=max(grid.nbytes, 1))
+    try:
+        np.ndarray(grid.shape, dtype=grid.dtype, buffer=shm.buf)[...] = grid
+        yield SharedGrid(name=shm.name, shape=grid.shape, dtype=grid.dtype.str)
+    finally:
+        # Views attached by this process itself may outlive the context, in which case
+        # its mapping is kept until exit
+        attached = _attached.pop(shm.name, None)
+        if attached is not None:
+            try:
+                attached.close()
+            except BufferError:
+                _attached[shm.name] = attached
+        shm.close()
+        shm.unlink()
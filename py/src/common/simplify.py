@@ -0,0 +1,450 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+import shapely
+from shapely import geometry
+import numpy as np
+
+# Rings are passed as a flat (N, 2) vertex buffer w/ ring offsets, ie: ring i is
+# points[ring_offsets[i] : ring_offsets[i + 1]]. Rings are open (the first vertex isn't
+# repeated at the end), all rings are simplified together in vectorized passes.
+
+
+def _close_rings(
+    points: np.ndarray, ring_offsets: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Append the first vertex of each ring to its end so the closing edge is explicit
+    counts = np.diff(ring_offsets)
+    closed_offsets = np.concatenate(([0], np.cumsum(counts + 1)))
+    closed_points = np.empty((len(points) + len(counts), 2), dtype=np.float64)
+    closing = closed_offsets[1:] - 1
+    is_closing = np.zeros(len(closed_points), dtype=bool)
+    is_closing[closing] = True
+    closed_points[~is_closing] = points
+    closed_points[closing] = points[ring_offsets[:-1]]
+    return closed_points, closed_offsets
+
+
+def _open_rings(
+    closed_points: np.ndarray, closed_offsets: np.ndarray, keep: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Drop the closing vertices and the vertices not kept
+    keep = keep.copy()
+    keep[closed_offsets[1:] - 1] = False
+    counts = np.add.reduceat(keep, closed_offsets[:-1])
+    return closed_points[keep], np.concatenate(([0], np.cumsum(counts)))
+
+
+def _segment_distances2(
+    xs: np.ndarray, ys: np.ndarray, idx: np.ndarray, a: np.ndarray, b: np.ndarray
+) -> np.ndarray:
+    # Squared distance of the idx'th vertices to the segments a->b (one per vertex).
+    # Segment terms are computed once per segment, then repeated to the vertices.
+    lens = b - a - 1
+    ax, ay = xs[a], ys[a]
+    abx, aby = xs[b] - ax, ys[b] - ay
+    ab_len2 = abx * abx + aby * aby
+    inv_len2 = np.divide(1.0, ab_len2, out=np.zeros(len(a)), where=ab_len2 > 0)
+    ax, ay, abx, aby, inv_len2 = (
+        np.repeat(v, lens) for v in (ax, ay, abx, aby, inv_len2)
+    )
+    px = xs[idx] - ax
+    py = ys[idx] - ay
+    t = np.clip((px * abx + py * aby) * inv_len2, 0, 1)
+    px -= t * abx
+    py -= t * aby
+    return px * px + py * py
+
+
+def _expand_segments(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # The interior vertex indices of segments a->b (b - a > 1), w/ the start of each
+    # segment's run in the result
+    lens = b - a - 1
+    starts = np.concatenate(([0], np.cumsum(lens)[:-1]))
+    idx = np.ones(lens.sum(), dtype=np.intp)
+    idx[starts[1:]] = a[1:] + 1 - (a[:-1] + lens[:-1])
+    idx[0] = a[0] + 1
+    return np.cumsum(idx), starts
+
+
+def _farthest(
+    xs: np.ndarray, ys: np.ndarray, a: np.ndarray, b: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # The interior vertex farthest from each segment a->b (b - a > 1), and its squared
+    # distance
+    idx, starts = _expand_segments(a, b)
+    d2 = _segment_distances2(xs, ys, idx, a, b)
+    d2_max = np.maximum.reduceat(d2, starts)
+    # First vertex attaining the max, for ties
+    at_max = np.flatnonzero(d2 == np.repeat(d2_max, b - a - 1))
+    first = at_max[np.searchsorted(at_max, starts)]
+    return idx[first], d2_max
+
+
+def _douglas_peucker(
+    closed_points: np.ndarray,
+    closed_offsets: np.ndarray,
+    tolerance: float,
+    min_vertices: int,
+) -> np.ndarray:
+    # Keep mask over the closed buffer. Each ring is split at its first vertex and the
+    # vertex farthest from it, then all segments of all rings are refined together, one
+    # level of the recursion per pass.
+    xs = np.ascontiguousarray(closed_points[:, 0])
+    ys = np.ascontiguousarray(closed_points[:, 1])
+    tolerance2 = tolerance**2
+    keep = np.zeros(len(closed_points), dtype=bool)
+    starts, ends = closed_offsets[:-1], closed_offsets[1:] - 1
+    keep[starts] = keep[ends] = True
+
+    # Anchor: the vertex farthest from the first vertex of the ring
+    lens = np.diff(closed_offsets)
+    d2 = (xs - np.repeat(xs[starts], lens)) ** 2 + (
+        ys - np.repeat(ys[starts], lens)
+    ) ** 2
+    at_max = np.flatnonzero(d2 == np.repeat(np.maximum.reduceat(d2, starts), lens))
+    anchors = at_max[np.searchsorted(at_max, starts)]
+    keep[anchors] = True
+
+    a = np.concatenate((starts, anchors))
+    b = np.concatenate((anchors, ends))
+    while True:
+        active = b - a > 1
+        a, b = a[active], b[active]
+        if not len(a):
+            break
+        far_idx, far_d2 = _farthest(xs, ys, a, b)
+        split = far_d2 > tolerance2
+        keep[far_idx[split]] = True
+        a, b = (
+            np.concatenate((a[split], far_idx[split])),
+            np.concatenate((far_idx[split], b[split])),
+        )
+
+    if min_vertices > 0:
+        # Rings collapsed to their first vertex and anchor keep the vertex farthest from
+        # either half of the ring
+        collapsed = np.flatnonzero(np.add.reduceat(keep, starts) - 1 < min_vertices)
+        a = np.concatenate((starts[collapsed], anchors[collapsed]))
+        b = np.concatenate((anchors[collapsed], ends[collapsed]))
+        far_idx = np.full(len(a), -1)
+        far_d2 = np.full(len(a), -np.inf)
+        active = b - a > 1
+        if active.any():
+            far_idx[active], far_d2[active] = _farthest(xs, ys, a[active], b[active])
+        halves = np.stack((far_d2[: len(collapsed)], far_d2[len(collapsed) :]))
+        third = np.stack((far_idx[: len(collapsed)], far_idx[len(collapsed) :]))[
+            np.argmax(halves, axis=0), np.arange(len(collapsed))
+        ]
+        keep[third[third >= 0]] = True
+    return keep
+
+
+def _visvalingam_whyatt(
+    closed_points: np.ndarray,
+    closed_offsets: np.ndarray,
+    tolerance: float,
+    min_vertices: int,
+) -> np.ndarray:
+    # Keep mask over the closed buffer. Vertices whose triangle w/ their neighbours has an
+    # area < tolerance ** 2 are removed, smallest first. Each pass removes every vertex
+    # which is a local minimum (its area is smaller than both neighbours'), so vertices
+    # removed together never share a triangle.
+    double_area_threshold = 2 * tolerance**2
+    is_end = np.zeros(len(closed_points), dtype=bool)
+    is_end[closed_offsets[:-1]] = is_end[closed_offsets[1:] - 1] = True
+    ring_ids = np.repeat(np.arange(len(closed_offsets) - 1), np.diff(closed_offsets))
+    # Indices of the remaining vertices, areas are recomputed for all of them each pass
+    idx = np.arange(len(closed_points))
+    while True:
+        xs, ys = closed_points[idx, 0], closed_points[idx, 1]
+        interior = ~is_end[idx]
+        double_areas = np.full(len(idx), np.inf)
+        double_areas[1:-1] = np.abs(
+            (xs[1:-1] - xs[:-2]) * (ys[2:] - ys[:-2])
+            - (xs[2:] - xs[:-2]) * (ys[1:-1] - ys[:-2])
+        )
+        double_areas[~interior] = np.inf
+        # Ties go to the later vertex, so neighbours are never both removed
+        prev_areas = np.roll(double_areas, 1)
+        next_areas = np.roll(double_areas, -1)
+        remove = (
+            (double_areas < double_area_threshold)
+            & (double_areas <= prev_areas)
+            & (double_areas < next_areas)
+        )
+        if min_vertices > 0 and remove.any():
+            # Limit removals so rings keep min_vertices (excl. the closing vertex),
+            # smallest areas first
+            rings = ring_ids[idx]
+            n_rings = len(closed_offsets) - 1
+            allowed = np.maximum(
+                np.bincount(rings, minlength=n_rings) - 1 - min_vertices, 0
+            )
+            candidates = np.flatnonzero(remove)
+            over = np.bincount(rings[candidates], minlength=n_rings) > allowed
+            limited = candidates[over[rings[candidates]]]
+            by_ring = limited[np.lexsort((double_areas[limited], rings[limited]))]
+            ring_starts = np.searchsorted(rings[by_ring], rings[by_ring], side="left")
+            rank = np.arange(len(by_ring)) - ring_starts
+            remove[by_ring[rank >= allowed[rings[by_ring]]]] = False
+        if not remove.any():
+            break
+        idx = idx[~remove]
+    keep = np.zeros(len(closed_points), dtype=bool)
+    keep[idx] = True
+    return keep
+
+
+# Times a self intersecting ring is simplified again w/ half the tolerance
+_MAX_RETRIES = 4
+
+SIMPLIFY_METHODS: Dict[
+    str, Callable[[np.ndarray, np.ndarray, float, int], np.ndarray]
+] = {
+    "douglas_peucker": _douglas_peucker,
+    "visvalingam_whyatt": _visvalingam_whyatt,
+}
+
+
+def _simplify_rings(
+    points: np.ndarray,
+    ring_offsets: np.ndarray,
+    tolerance: float,
+    method: str,
+    preserve_topology: bool,
+    retries: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    closed_points, closed_offsets = _close_rings(points, ring_offsets)
+    keep = SIMPLIFY_METHODS[method](
+        closed_points, closed_offsets, tolerance, 3 if preserve_topology else 0
+    )
+    simplified, simplified_offsets = _open_rings(closed_points, closed_offsets, keep)
+    if not preserve_topology:
+        return simplified, simplified_offsets
+
+    # Rings which lost vertices and now self intersect, where they didn't before (rings
+    # traced from a raster may touch themselves already)
+    def _is_simple(ring: np.ndarray) -> bool:
+        return len(ring) < 3 or geometry.LinearRing(ring).is_simple
+
+    counts = np.diff(ring_offsets)
+    simplified_counts = np.diff(simplified_offsets)
+    invalid = [
+        ring_idx
+        for ring_idx in np.flatnonzero(simplified_counts < counts)
+        if not _is_simple(
+            simplified[simplified_offsets[ring_idx] : simplified_offsets[ring_idx + 1]]
+        )
+        and _is_simple(points[ring_offsets[ring_idx] : ring_offsets[ring_idx + 1]])
+    ]
+    if not invalid:
+        return simplified, simplified_offsets
+
+    retry_points = np.concatenate(
+        [points[ring_offsets[i] : ring_offsets[i + 1]] for i in invalid]
+    )
+    retry_offsets = np.concatenate(([0], np.cumsum(counts[invalid])))
+    if retries > 0:
+        retry_points, retry_offsets = _simplify_rings(
+            retry_points,
+            retry_offsets,
+            tolerance / 2,
+            method=method,
+            preserve_topology=True,
+            retries=retries - 1,
+        )
+    # Splice the retried rings back in
+    rings = [
+        simplified[simplified_offsets[i] : simplified_offsets[i + 1]]
+        for i in range(len(counts))
+    ]
+    for j, ring_idx in enumerate(invalid):
+        rings[ring_idx] = retry_points[retry_offsets[j] : retry_offsets[j + 1]]
+    return np.concatenate(rings), np.concatenate(
+        ([0], np.cumsum([len(r) for r in rings]))
+    )
+
+
+def _restore_nesting(
+    points: np.ndarray,
+    ring_offsets: np.ndarray,
+    simplified: np.ndarray,
+    simplified_offsets: np.ndarray,
+    ring_parents: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Holes which cross or escape their (simplified) parent ring, where they didn't before,
+    # are restored to their original ring. If the original hole still conflicts, the parent
+    # is restored too and its other holes are checked against it again.
+    original = np.split(points, ring_offsets[1:-1])
+    rings: List[np.ndarray] = np.split(simplified, simplified_offsets[1:-1])
+    restored = np.zeros(len(rings), dtype=bool)
+
+    def _polygon(ring: np.ndarray) -> Optional[geometry.Polygon]:
+        # None for degenerate or invalid rings, which no hole is checked against
+        if len(ring) < 3:
+            return None
+        polygon = geometry.Polygon(ring)
+        if not polygon.is_valid:
+            return None
+        shapely.prepare(polygon)
+        return polygon
+
+    def _within(hole: np.ndarray, parent: Optional[geometry.Polygon]) -> bool:
+        # Touching the parent's boundary is allowed, as for rings traced from a raster
+        return (
+            parent is None
+            or len(hole) < 3
+            or parent.contains(geometry.LinearRing(hole))
+        )
+
+    holes = np.flatnonzero(ring_parents >= 0)
+    while True:
+        # Each parent polygon is built once per pass
+        parents: Dict[int, Optional[geometry.Polygon]] = {}
+        conflicts = []
+        for ring_idx in holes:
+            parent_idx = ring_parents[ring_idx]
+            if parent_idx not in parents:
+                parents[parent_idx] = _polygon(rings[parent_idx])
+            if not _within(rings[ring_idx], parents[parent_idx]) and _within(
+                original[ring_idx], _polygon(original[parent_idx])
+            ):
+                conflicts.append(ring_idx)
+        if not conflicts:
+            break
+        for ring_idx in conflicts:
+            parent_idx = ring_parents[ring_idx]
+            if not restored[ring_idx]:
+                rings[ring_idx] = original[ring_idx]
+                restored[ring_idx] = True
+            else:
+                rings[parent_idx] = original[parent_idx]
+                restored[parent_idx] = True
+    if not restored.any():
+        return simplified, simplified_offsets
+    return np.concatenate(rings), np.concatenate(
+        ([0], np.cumsum([len(r) for r in rings]))
+    )
+
+
+def simplify_rings(
+    points: np.ndarray,
+    ring_offsets: np.ndarray,
+    tolerance: float,
+    method: str = "douglas_peucker",
+    preserve_topology: bool = True,
+    ring_parents: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Simplify all rings at once, returning the simplified (open) rings as a vertex buffer
+    # and ring offsets. tolerance is a distance for douglas_peucker, and the square root of
+    # the triangle area below which vertices are removed for visvalingam_whyatt.
+    # preserve_topology: rings are never collapsed below a triangle, and rings which self
+    # intersect once simplified are simplified again w/ half the tolerance (kept as is if
+    # that fails a few times).
+    # ring_parents: the index of the ring each ring is a hole of (-1 for none). If provided
+    # (and preserving topology), holes are kept within their parent, see _restore_nesting.
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    ring_offsets = np.asarray(ring_offsets, dtype=np.intp)
+    if tolerance <= 0 or len(ring_offsets) < 2:
+        return points, ring_offsets
+    simplified, simplified_offsets = _simplify_rings(
+        points,
+        ring_offsets,
+        tolerance,
+        method=method,
+        preserve_topology=preserve_topology,
+        retries=_MAX_RETRIES,
+    )
+    if preserve_topology and ring_parents is not None:
+        simplified, simplified_offsets = _restore_nesting(
+            points,
+            ring_offsets,
+            simplified,
+            simplified_offsets,
+            np.asarray(ring_parents, dtype=np.intp),
+        )
+    return simplified, simplified_offsets
+
+
+# Per-ring properties, see ring_properties
+RING_PROPERTIES = (
+    "area",
+    "perimeter",
+    "bbox",
+    "centroid",
+    "vertex_count",
+)
+
+
+def ring_properties(
+    points: np.ndarray, ring_offsets: np.ndarray
+) -> Dict[str, np.ndarray]:
+    # Geometry of all (open) rings at once:
+    #   area: signed (shoelace) area, its sign is the winding of the ring
+    #   perimeter: including the closing edge
+    #   bbox: (n_rings, 4) x min, y min, x max, y max
+    #   centroid: (n_rings, 2) area centroid, the vertex mean for degenerate rings
+    #   vertex_count: distinct vertices
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    ring_offsets = np.asarray(ring_offsets, dtype=np.intp)
+    counts = np.diff(ring_offsets)
+    n_rings = len(counts)
+    if not len(points):
+        return {
+            "area": np.zeros(n_rings),
+            "perimeter": np.zeros(n_rings),
+            "bbox": np.zeros((n_rings, 4)),
+            "centroid": np.zeros((n_rings, 2)),
+            "vertex_count": counts,
+        }
+    ring_of = np.repeat(np.arange(n_rings), counts)
+    starts = ring_offsets[:-1]
+    nxt = np.arange(len(points)) + 1
+    nxt[ring_offsets[1:][counts > 0] - 1] = starts[counts > 0]
+    x, y = points[:, 0], points[:, 1]
+    cross = x * y[nxt] - x[nxt] * y
+    area2 = np.bincount(ring_of, weights=cross, minlength=n_rings)
+    perimeter = np.bincount(
+        ring_of, weights=np.hypot(x[nxt] - x, y[nxt] - y), minlength=n_rings
+    )
+    # Centroid, falling back to the vertex mean where the area vanishes
+    safe_counts = np.maximum(counts, 1)
+    mean = np.stack(
+        (
+            np.bincount(ring_of, weights=x, minlength=n_rings) / safe_counts,
+            np.bincount(ring_of, weights=y, minlength=n_rings) / safe_counts,
+        ),
+        axis=1,
+    )
+    centroid = np.stack(
+        (
+            np.bincount(ring_of, weights=(x + x[nxt]) * cross, minlength=n_rings),
+            np.bincount(ring_of, weights=(y + y[nxt]) * cross, minlength=n_rings),
+        ),
+        axis=1,
+    )
+    degenerate = np.abs(area2) <= np.finfo(np.float64).eps
+    centroid = np.divide(
+        centroid,
+        3 * area2[:, None],
+        out=mean,
+        where=~degenerate[:, None],
+    )
+    non_empty = starts[counts > 0]
+    bbox = np.zeros((n_rings, 4))
+    bbox[counts > 0] = np.stack(
+        (
+            np.minimum.reduceat(x, non_empty),
+            np.minimum.reduceat(y, non_empty),
+            np.maximum.reduceat(x, non_empty),
+            np.maximum.reduceat(y, non_empty),
+        ),
+        axis=1,
+    )
+    return {
+        "area": area2 / 2,
+        "perimeter": perimeter,
+        "bbox": bbox,
+        "centroid": centroid,
+        "vertex_count": counts,
+    }
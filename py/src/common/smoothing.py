@@ -0,0 +1,276 @@
+from concurrent.futures import ProcessPoolExecutor
+import math
+from typing import Callable, Dict, Iterator, Optional
+
+import cv2
+import numpy as np
+
+from .shared_grid import Grid, as_array, share_grid
+
+
+def _median(wip: np.ndarray, strength: float, scale: int) -> np.ndarray:
+    # strength: the number of 7x7 median passes (at the upsampled resolution)
+    for _ in range(int(strength)):
+        wip = cv2.medianBlur(wip, 7)
+    return wip
+
+
+def _gaussian(wip: np.ndarray, strength: float, scale: int) -> np.ndarray:
+    # strength: the std-dev of the blur, in cells of the original grid
+    return cv2.GaussianBlur(wip, (0, 0), sigmaX=strength * scale)
+
+
+def _morphological(wip: np.ndarray, strength: float, scale: int) -> np.ndarray:
+    # strength: the radius of the structuring element, in cells of the original grid.
+    # Opening removes specks/spurs, closing then fills pits/inlets of the same size.
+    radius = max(1, int(round(strength * scale)))
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1)
+    )
+    wip = cv2.morphologyEx(wip, cv2.MORPH_OPEN, kernel)
+    return cv2.morphologyEx(wip, cv2.MORPH_CLOSE, kernel)
+
+
+def _signed_distance(wip: np.ndarray, strength: float, scale: int) -> np.ndarray:
+    # strength: the std-dev of the blur applied to the signed distance field, in cells of
+    # the original grid. Unlike blurring the mask itself, the zero crossing moves by
+    # curvature only, so thin channels are not eroded away.
+    sdf = cv2.distanceTransform(wip, cv2.DIST_L2, 5)
+    sdf -= cv2.distanceTransform(255 - wip, cv2.DIST_L2, 5)
+    sdf = cv2.GaussianBlur(sdf, (0, 0), sigmaX=strength * scale)
+    return np.where(sdf > 0, 255, 0).astype(np.uint8)
+
+
+# Smoothing methods by name, each w/ its default strength. A method maps the (upsampled)
+# uint8 0/255 mask to a uint8 image which is thresholded at 128 after downsampling.
+SMOOTHING_METHODS: Dict[str, Callable[[np.ndarray, float, int], np.ndarray]] = {
+    "median": _median,
+    "gaussian": _gaussian,
+    "morphological": _morphological,
+    "sdf": _signed_distance,
+}
+DEFAULT_SMOOTHING_STRENGTHS: Dict[str, float] = {
+    "median": 15,
+    "gaussian": 1.5,
+    "morphological": 1.5,
+    "sdf": 1.5,
+}
+
+
+def _filter_radius(method: str, strength: float, scale: int) -> Optional[int]:
+    # The radius (in upsampled pixels) a method reads around each pixel, None if unbounded
+    if method == "median":
+        return 3 * int(strength)
+    if method == "gaussian":
+        # cv2's kernel size for uint8 images when derived from sigma
+        return (int(round(strength * scale * 3 * 2 + 1)) | 1) // 2
+    if method == "morphological":
+        # Opening then closing: erode, dilate, dilate, erode
+        return 4 * max(1, int(round(strength * scale)))
+    # The signed distance transform is global
+    return None
+
+
+def smoothing_halo(
+    scale_up_factor: int, method: str, strength: Optional[float] = None
+) -> Optional[int]:
+    # The number of cells around a tile which affect the smoothed tile, ie: the overlap
+    # needed for tiles to stitch back seamlessly. pyrUp reads +/-1 and pyrDown +/-2 pixels
+    # at each level, < 2 cells each over all levels. None if the method can't be tiled.
+    if strength is None:
+        strength = DEFAULT_SMOOTHING_STRENGTHS[method]
+    scale = 2 ** (scale_up_factor // 2)
+    radius = _filter_radius(method, strength, scale)
+    if radius is None:
+        return None
+    return math.ceil(radius / scale) + 2 + 2 + 1
+
+
+def _init_tile_worker():
+    # Parallelism is across tiles, avoid oversubscribing cores w/ cv2's own threads
+    cv2.setNumThreads(1)
+
+
+def _smooth_tile(args: tuple) -> np.ndarray:
+    src, window, crop, scale_up_factor, method, strength = args
+    pr0, pr1, pc0, pc1 = window
+    r0, r1, c0, c1 = crop
+    wip = as_array(src)[pr0:pr1, pc0:pc1]
+    return _smooth_image(wip, scale_up_factor, method, strength)[r0:r1, c0:c1]
+
+
+def _smooth_image_tiled(
+    wip: np.ndarray,
+    scale_up_factor: int,
+    method: str,
+    strength: float,
+    tile_size: int,
+    workers: int,
+) -> np.ndarray:
+    # Smooth tile_size x tile_size tiles, each w/ a halo of neighbouring cells, and stitch
+    # the tile interiors back. Tiles at the edges of the image keep its true border, so the
+    # result is bit-identical to smoothing in one piece. Peak memory is bounded by the
+    # upsampled (tile + halo) per worker, rather than the upsampled image.
+    halo = smoothing_halo(scale_up_factor, method, strength)
+    if halo is None:
+        raise ValueError(f"Smoothing method {method} can't be tiled")
+    rows, cols = wip.shape[:2]
+
+    def _tiles(src: Grid):
+        for r in range(0, rows, tile_size):
+            for c in range(0, cols, tile_size):
+                pr0, pc0 = max(r - halo, 0), max(c - halo, 0)
+                pr1 = min(r + tile_size + halo, rows)
+                pc1 = min(c + tile_size + halo, cols)
+                crop = (
+                    r - pr0,
+                    min(r + tile_size, rows) - pr0,
+                    c - pc0,
+                    min(c + tile_size, cols) - pc0,
+                )
+                yield (r, c), (
+                    src,
+                    (pr0, pr1, pc0, pc1),
+                    crop,
+                    scale_up_factor,
+                    method,
+                    strength,
+                )
+
+    out = np.empty_like(wip)
+
+    def _stitch(tile_args: Iterator[tuple]):
+        offsets, tile_args = zip(*tile_args)
+        if workers <= 1:
+            smoothed_tiles = map(_smooth_tile, tile_args)
+        else:
+            executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_tile_worker
+            )
+            smoothed_tiles = executor.map(_smooth_tile, tile_args)
+        try:
+            for (r, c), tile in zip(offsets, smoothed_tiles):
+                out[r : r + tile.shape[0], c : c + tile.shape[1]] = tile
+        finally:
+            if workers > 1:
+                executor.shutdown()
+
+    if workers <= 1:
+        _stitch(_tiles(wip))
+    else:
+        # Workers attach to the image rather than each tile being pickled to them
+        with share_grid(wip) as shared:
+            _stitch(_tiles(shared))
+    return out
+
+
+def _smooth_image(
+    wip: np.ndarray,
+    scale_up_factor: int,
+    method: str,
+    strength: Optional[float],
+    tile_size: Optional[int] = None,
+    workers: int = 1,
+) -> np.ndarray:
+    # Upsample, smooth and downsample a uint8 image. If tile_size is provided, this is done
+    # by tiles (see _smooth_image_tiled) across `workers` processes.
+    if strength is None:
+        strength = DEFAULT_SMOOTHING_STRENGTHS[method]
+    if tile_size is not None and max(wip.shape[:2]) > tile_size:
+        return _smooth_image_tiled(
+            wip, scale_up_factor, method, strength, tile_size, workers
+        )
+    # Scale up
+    for _ in range(scale_up_factor // 2):
+        wip = cv2.pyrUp(wip)
+    # Each pyrUp doubles the resolution
+    wip = SMOOTHING_METHODS[method](wip, strength, 2 ** (scale_up_factor // 2))
+    for _ in range(scale_up_factor // 2):
+        wip = cv2.pyrDown(wip)
+    return wip
+
+
+def smooth_mask(
+    mask: Grid,
+    scale_up_factor: int = 4,
+    method: str = "median",
+    strength: Optional[float] = None,
+    tile_size: Optional[int] = None,
+    workers: int = 1,
+) -> np.ndarray:
+    # Upsample, smooth, downsample and threshold a boolean mask
+    wip = _smooth_image(
+        as_array(mask).astype(np.uint8) * 255,
+        scale_up_factor=scale_up_factor,
+        method=method,
+        strength=strength,
+        tile_size=tile_size,
+        workers=workers,
+    )
+    # Threshold back
+    return wip >= 128
+
+
+# Methods which apply to a multi-level field as well as to a binary mask. The signed
+# distance field of a single mask has no multi-level counterpart.
+FIELD_SMOOTHING_METHODS = ("median", "gaussian", "morphological")
+
+
+def smooth_layer_count_field(
+    layer_counts: Grid,
+    n_layers: int,
+    scale_up_factor: int = 4,
+    method: str = "median",
+    strength: Optional[float] = None,
+    tile_size: Optional[int] = None,
+    workers: int = 1,
+) -> np.ndarray:
+    # Smooth the field of how many (nested) layers cover each cell in one go, and round it
+    # back to counts. Layer k is then `result > k`: every layer is thresholded from the same
+    # field so layers stay nested. For a single layer this matches smooth_mask.
+    if method not in FIELD_SMOOTHING_METHODS:
+        raise ValueError(
+            f"Smoothing method {method} can't smooth a layer field, use one of {FIELD_SMOOTHING_METHODS}"
+        )
+    assert 0 < n_layers <= 255
+    # Layer counts spread evenly over the uint8 range (255 for a single layer, as in smooth_mask)
+    level_step = 255 // n_layers
+    wip = _smooth_image(
+        as_array(layer_counts).astype(np.uint8) * np.uint8(level_step),
+        scale_up_factor=scale_up_factor,
+        method=method,
+        strength=strength,
+        tile_size=tile_size,
+        workers=workers,
+    )
+    # Round to the nearest count, ie: layer k is kept where the field is >= (k + 0.5) steps
+    counts = (wip.astype(np.uint16) * 2 + level_step) // (2 * level_step)
+    return np.minimum(counts, n_layers).astype(np.uint8)
+
+
+def remove_specks(
+    mask: Grid, min_island_cells: int, min_hole_cells: Optional[int] = None
+) -> np.ndarray:
+    # Remove foreground components smaller than min_island_cells, and fill holes (background
+    # components not touching the border) smaller than min_hole_cells (defaults to the
+    # same). Connectivity matches cv2.findContours: 8 for islands, 4 for holes.
+    if min_hole_cells is None:
+        min_hole_cells = min_island_cells
+    mask = as_array(mask)
+    rows, cols = mask.shape
+    wip = mask.astype(np.uint8)
+    if min_island_cells > 1:
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(wip, connectivity=8)
+        keep = stats[:, cv2.CC_STAT_AREA] >= min_island_cells
+        keep[0] = False
+        wip = keep[labels].astype(np.uint8)
+    if min_hole_cells > 1:
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(1 - wip, connectivity=4)
+        left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        right = left + stats[:, cv2.CC_STAT_WIDTH]
+        bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+        is_hole = (left > 0) & (top > 0) & (right < cols) & (bottom < rows)
+        fill = is_hole & (stats[:, cv2.CC_STAT_AREA] < min_hole_cells)
+        fill[0] = False
+        wip = wip | fill[labels]
+    return wip.astype(bool)
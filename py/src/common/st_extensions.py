@@ -1,11 +1,13 @@
-from typing import Tuple
+import math
+from typing import Any, Dict, Optional, Tuple
 import cv2
 import numpy as np
 import streamlit as st
 
-from .data_helpers import load_data, load_raw
-from .image_utils import im_resize, crop_box
+from .data_helpers import MaskedDepthGrid, load_data, load_grid_stats, read_raw_shape
+from .image_utils import im_resize, crop_box, crop_box_window
 from .io import list_bathy_files
+from .valid_mask import ValidMask
 from .viz import (
     _plot_depth_3D_as_contours,
     _plot_depth_3D_as_height_map,
@@ -22,12 +24,18 @@ def cached_load_data(**kwargs):
 
 
 @st.cache(allow_output_mutation=True)
-def load_raw_cached(**kwargs):
-    with st.spinner("Loading raw data..."):
-        return load_raw(**kwargs)
+def load_grid_stats_cached(**kwargs):
+    with st.spinner("Loading dataset statistics..."):
+        return load_grid_stats(**kwargs)
 
 
-def crop_depth_grid(depth_grid: np.ndarray) -> np.ndarray:
+def crop_depth_grid(load_kwargs: Dict[str, Any]) -> MaskedDepthGrid:
+    # Only a decimated preview and the window under the crop box are ever read
+    full_shape = read_raw_shape(load_kwargs["fpath"])
+    preview = cached_load_data(
+        **load_kwargs, step=max(1, math.ceil(max(full_shape) / 1080))
+    ).depth_grid
+
     c1, _, c2 = st.columns((1, 1, 4))
     crop_rotation_angle_cw = c1.slider(
         label="Rotation (deg CW)",
@@ -75,7 +83,7 @@ def crop_depth_grid(depth_grid: np.ndarray) -> np.ndarray:
             crop_rotation_angle_cw,
         )
 
-    resized = im_resize(img=depth_grid, max_dim=1080)
+    resized = im_resize(img=preview, max_dim=1080)
     resized_norm_rgb = np.stack(
         ((255.0 * resized / resized.max()).astype(np.uint8()),) * 3, axis=-1
     )
@@ -86,14 +94,36 @@ def crop_depth_grid(depth_grid: np.ndarray) -> np.ndarray:
         ),
         channels="BGR",
     )
-    return crop_box(
-        img=depth_grid,
-        box=scaled_crop_config(dims=depth_grid.shape),
-        imagine_out_of_bounds=bool(image_out_of_bounds),
+    box = scaled_crop_config(dims=full_shape)
+    window = crop_box_window(
+        shape=full_shape, box=box, imagine_out_of_bounds=bool(image_out_of_bounds)
+    )
+    cropped = cached_load_data(**load_kwargs, window=window)
+
+    def _crop(img: np.ndarray) -> np.ndarray:
+        return crop_box(
+            img=img,
+            box=box,
+            imagine_out_of_bounds=bool(image_out_of_bounds),
+            origin=window[:2],
+            full_shape=full_shape,
+        )
+
+    valid_mask = None
+    if cropped.valid_mask is not None:
+        valid_mask = ValidMask.from_bool(
+            _crop(255 * cropped.valid_mask.unpack().astype(np.uint8)) >= 128
+        )
+    return MaskedDepthGrid(
+        depth_grid=_crop(cropped.depth_grid),
+        valid_mask=valid_mask,
+        peak_memory_bytes=cropped.peak_memory_bytes,
     )
 
 
-def upload_and_configure_depth_grid() -> np.ndarray:
+def upload_and_configure_depth_grid(
+    allow_crop: bool = False,
+) -> Optional[MaskedDepthGrid]:
     if st.sidebar.checkbox(label="File upload", value=True):
         input_file = st.sidebar.file_uploader(
             label="GeoTiff",
@@ -123,9 +153,9 @@ def upload_and_configure_depth_grid() -> np.ndarray:
     )
     depth_unit_m = depth_units_map[depth_unit_name]
 
-    max_possible_depth_as_read = int(
-        (load_raw_cached(fpath=input_file) * depth_unit_m).max() + 0.5
-    )
+    # Read from the dataset's statistics sidecar, not from a pass over the full grid
+    stats = load_grid_stats_cached(fpath=input_file)
+    max_possible_depth_as_read = int(stats.max * depth_unit_m + 0.5)
     depth_grid_min_max_m = st.sidebar.slider(
         label="Min/max depth (m)",
         min_value=0,
@@ -144,13 +174,17 @@ def upload_and_configure_depth_grid() -> np.ndarray:
         help="The max z-score beyond which data is clipped.",
     )
 
-    return cached_load_data(
+    load_kwargs = dict(
         fpath=input_file,
         depth_unit_m=depth_unit_m,
         depth_min_m=min(depth_grid_min_max_m),
         depth_max_m=max(depth_grid_min_max_m),
         max_z_score=max_z_score,
+        stats=stats,
     )
+    if allow_crop and st.checkbox(label="Crop Region", value=False):
+        return crop_depth_grid(load_kwargs=load_kwargs)
+    return cached_load_data(**load_kwargs)
 
 
 def viz_depth_grid(depth_grid: np.ndarray, cell_size_m) -> None:
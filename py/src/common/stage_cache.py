@@ -0,0 +1,142 @@
+from functools import cache
+import hashlib
+import json
+import os
+from pathlib import Path
+import pickle
+import time
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Part of every key, bump to invalidate entries written by incompatible code
+_CACHE_VERSION = 1
+_ENTRY_SUFFIX = ".pkl"
+
+
+def stage_key(stage: str, params: Dict[str, Any], *upstream: Optional[str]) -> str:
+    # The key of a stage's output: a hash of the stage, its parameters and the keys of the
+    # stages it consumes. Changing a parameter changes the key of its stage and of every
+    # stage downstream, while upstream keys (and their cached outputs) are unchanged.
+    material = json.dumps(
+        {
+            "version": _CACHE_VERSION,
+            "stage": stage,
+            "params": params,
+            "upstream": upstream,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def file_identity(fpath: Path) -> Dict[str, Any]:
+    # As for sidecars, size + mtime stand in for the file's content
+    st = os.stat(fpath)
+    return {
+        "path": os.path.abspath(fpath),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+
+
+class StageCache:
+    # Stage outputs pickled to cache_dir, one file per key. The least recently used
+    # entries are evicted once the cache exceeds max_bytes. Safe to share between
+    # processes: entries are written atomically, and ones evicted concurrently are misses.
+    def __init__(self, cache_dir: Path, max_bytes: int = 4 * 2**30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{_ENTRY_SUFFIX}"
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        # (hit, value)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+        try:
+            # Entry mtimes record their last use
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return True, value
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        # Remove the least recently used entries until the cache fits in max_bytes
+        entries = []
+        for path in self.cache_dir.glob(f"*{_ENTRY_SUFFIX}"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def run_stage(
+    cache: Optional[StageCache], key: str, compute: Callable[[], T]
+) -> Tuple[T, bool]:
+    # The stage's output, from the cache if there, else computed (and cached).
+    # Returns (output, cache hit). w/o a cache, always computed.
+    if cache is not None:
+        hit, value = cache.get(key)
+        if hit:
+            return value, True
+    value = compute()
+    if cache is not None:
+        cache.put(key, value)
+    return value, False
+
+
+def lazy_stage(
+    stage_cache: Optional[StageCache],
+    key: str,
+    compute: Callable[..., T],
+    *inputs: Callable[[], Any],
+    record: Optional[Callable[[float, bool], None]] = None,
+) -> Callable[[], T]:
+    # The stage's output, computed from its inputs (the outputs of upstream lazy stages)
+    # or loaded, once on first use. Inputs are only resolved if it isn't cached, so a hit
+    # skips everything upstream of it.
+    # record: called w/ (seconds, cache hit), excl. the time spent on upstream stages
+    @cache
+    def _run() -> T:
+        start = time.perf_counter()
+
+        def _compute() -> T:
+            nonlocal start
+            args = [get_input() for get_input in inputs]
+            start = time.perf_counter()
+            return compute(*args)
+
+        value, hit = run_stage(stage_cache, key, _compute)
+        if record is not None:
+            record(time.perf_counter() - start, hit)
+        return value
+
+    return _run
@@ -0,0 +1,135 @@
+from dataclasses import asdict, dataclass
+import math
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from .data_helpers import MaskedDepthGrid, masked_grid_stats
+from .grid_stats import GridStats
+from .quantize import (
+    LEVEL_STRATEGIES,
+    assign_levels,
+    decode_quantized_depths,
+    layer_levels,
+    level_thresholds,
+)
+
+
+@dataclass(frozen=True)
+class SweepConfig:
+    levels: int
+    quantize_depth_start_m: float
+    force_first_layer: bool = True
+    level_strategy: str = "linspace"
+
+
+@dataclass(frozen=True)
+class SweepSummary:
+    config: SweepConfig
+    quantized_depth_values: List[float]
+    cells_per_layer: List[int]
+    area_per_layer_m2: List[float]
+    # Outer contours/holes per layer, traced on the raw (unsmoothed) layer masks if counted
+    contours_per_layer: Optional[List[int]] = None
+    holes_per_layer: Optional[List[int]] = None
+
+    def to_json(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass(frozen=True)
+class SweepResult:
+    summary: SweepSummary
+    # Number of layers covering each cell, at thumbnail resolution
+    layer_count_thumbnail: np.ndarray
+
+
+def _count_contours(layer_mask: np.ndarray) -> tuple:
+    # (outer contours, holes)
+    _, hierarchy = cv2.findContours(
+        layer_mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+    )
+    if hierarchy is None:
+        return 0, 0
+    outer = int((hierarchy[0][:, 3] == -1).sum())
+    return outer, hierarchy.shape[1] - outer
+
+
+def sweep_quantize(
+    masked_depth_grid: MaskedDepthGrid,
+    configs: List[SweepConfig],
+    cell_size_m: float,
+    stats: Optional[GridStats] = None,
+    count_contours: bool = False,
+    thumbnail_size: int = 256,
+) -> List[SweepResult]:
+    # Evaluate many quantization configs against a single loaded grid. Cells per layer are
+    # counted by binary search on the sorted depths (computed once) and label maps are only
+    # assigned at thumbnail resolution, so each config costs O(levels * log(cells)) plus a
+    # thumbnail. Counting contours assigns (and traces) the full grid per config.
+    depth_grid = masked_depth_grid.depth_grid
+    if stats is None:
+        stats = masked_grid_stats(masked_depth_grid)
+    max_depth_m = stats.max
+    # Normalized as in assign_levels, so counts match the levels assigned to the grid
+    sorted_depths_norm = np.sort(masked_depth_grid.valid_values()) / max_depth_m
+    step = max(1, math.ceil(max(depth_grid.shape) / thumbnail_size))
+    thumbnail = depth_grid[::step, ::step]
+
+    results = []
+    for config in configs:
+        quantized_depth_values_norm = LEVEL_STRATEGIES[config.level_strategy](
+            stats, max_depth_m, config.levels, config.quantize_depth_start_m
+        )
+        quantized_depth_values = decode_quantized_depths(
+            quantized_depth_values_norm, max_depth_m
+        )
+        in_layer = layer_levels(quantized_depth_values, config.force_first_layer)
+
+        # Cells per level: a cell takes the level whose threshold interval holds its depth
+        order = np.argsort(quantized_depth_values_norm, kind="stable")
+        bounds = np.searchsorted(
+            sorted_depths_norm,
+            level_thresholds(
+                quantized_depth_values_norm[order], sorted_depths_norm.dtype
+            ),
+            side="left",
+        )
+        cells_per_level = np.zeros(config.levels, dtype=np.int64)
+        cells_per_level[order] = np.diff(
+            np.concatenate(([0], bounds, [len(sorted_depths_norm)]))
+        )
+        cells_per_layer = in_layer.astype(np.int64) @ cells_per_level
+
+        contours_per_layer = holes_per_layer = None
+        if count_contours:
+            level_grid = assign_levels(
+                depth_grid,
+                quantized_depth_values_norm,
+                max_depth_m=max_depth_m,
+                valid_mask=masked_depth_grid.valid_mask,
+            )
+            counts = [_count_contours(layer[level_grid]) for layer in in_layer]
+            contours_per_layer = [outer for outer, _ in counts]
+            holes_per_layer = [holes for _, holes in counts]
+
+        layer_count_thumbnail = in_layer.sum(axis=0).astype(np.uint8)[
+            assign_levels(thumbnail, quantized_depth_values_norm, max_depth_m)
+        ]
+        results.append(
+            SweepResult(
+                summary=SweepSummary(
+                    config=config,
+                    quantized_depth_values=quantized_depth_values.tolist(),
+                    cells_per_layer=cells_per_layer.tolist(),
+                    area_per_layer_m2=(
+                        cells_per_layer * float(cell_size_m) ** 2
+                    ).tolist(),
+                    contours_per_layer=contours_per_layer,
+                    holes_per_layer=holes_per_layer,
+                ),
+                layer_count_thumbnail=layer_count_thumbnail,
+            )
+        )
+    return results
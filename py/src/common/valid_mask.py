@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Rows packed per block when building a mask, bounds the transient bool temporaries
+_PACK_BLOCK_ROWS = 1024
+# Number of set bits in each byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+@dataclass(frozen=True)
+class ValidMask:
+    # 1 bit per cell, packed along each row (np.packbits(..., axis=1))
+    bits: np.ndarray
+    shape: Tuple[int, int]
+
+    @staticmethod
+    def from_bool(valid: np.ndarray) -> "ValidMask":
+        return ValidMask(bits=np.packbits(valid, axis=1), shape=valid.shape[:2])
+
+    @staticmethod
+    def from_nodata(
+        grid: np.ndarray, nodata_value: Optional[float]
+    ) -> Optional["ValidMask"]:
+        # NaN cells are always invalid. Returns None when every cell is valid.
+        bits = np.empty((grid.shape[0], (grid.shape[1] + 7) // 8), dtype=np.uint8)
+        any_invalid = False
+        for r in range(0, grid.shape[0], _PACK_BLOCK_ROWS):
+            block = grid[r : r + _PACK_BLOCK_ROWS]
+            valid = ~np.isnan(block)
+            if nodata_value is not None:
+                valid &= block != nodata_value
+            any_invalid = any_invalid or not valid.all()
+            bits[r : r + _PACK_BLOCK_ROWS] = np.packbits(valid, axis=1)
+        return ValidMask(bits=bits, shape=grid.shape[:2]) if any_invalid else None
+
+    def unpack(self, row_start: int = 0, row_stop: Optional[int] = None) -> np.ndarray:
+        return np.unpackbits(
+            self.bits[row_start:row_stop], axis=1, count=self.shape[1]
+        ).astype(bool)
+
+    def crop(self, row0: int, row1: int, col0: int, col1: int) -> "ValidMask":
+        bits = np.empty((row1 - row0, (col1 - col0 + 7) // 8), dtype=np.uint8)
+        for r in range(row0, row1, _PACK_BLOCK_ROWS):
+            r_end = min(r + _PACK_BLOCK_ROWS, row1)
+            bits[r - row0 : r_end - row0] = np.packbits(
+                self.unpack(r, r_end)[:, col0:col1], axis=1
+            )
+        return ValidMask(bits=bits, shape=(row1 - row0, col1 - col0))
+
+    def fill_invalid(self, grid: np.ndarray, value: float) -> None:
+        # In place, block by block
+        for r in range(0, self.shape[0], _PACK_BLOCK_ROWS):
+            block = grid[r : r + _PACK_BLOCK_ROWS]
+            block[~self.unpack(r, r + _PACK_BLOCK_ROWS)] = value
+
+    def count(self) -> int:
+        # Row padding bits are always 0
+        return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def rows_any(self) -> np.ndarray:
+        # Whether each row holds any valid cell, without unpacking
+        return self.bits.any(axis=1)
+
+    def cols_any(self) -> np.ndarray:
+        return np.unpackbits(
+            np.bitwise_or.reduce(self.bits, axis=0), count=self.shape[1]
+        ).astype(bool)
@@ -1,18 +1,47 @@
+import math
 from typing import Any, List
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
+from .grid_stats import GridStats
+
 
 def _plot_histogram(data):
-    data_mean = np.mean(data, axis=None)
-    data_std = np.std(data, axis=None)
     fig = plt.figure()
 
     # Plot Data
     plt.hist(data, color="c", edgecolor="k")
 
+    _annotate_histogram(
+        data_mean=np.mean(data, axis=None),
+        data_std=np.std(data, axis=None),
+        data_max=np.amax(data),
+    )
+    fig.tight_layout()
+    return fig
+
+
+def _plot_histogram_from_stats(stats: GridStats):
+    # Same plot as _plot_histogram, from precomputed statistics (no pass over the data)
+    fig = plt.figure()
+
+    # Plot Data
+    plt.hist(
+        stats.hist_centers(),
+        weights=stats.hist_counts,
+        range=(stats.min, stats.max),
+        color="c",
+        edgecolor="k",
+    )
+
+    _annotate_histogram(data_mean=stats.mean, data_std=stats.std, data_max=stats.max)
+    fig.tight_layout()
+    return fig
+
+
+def _annotate_histogram(data_mean: float, data_std: float, data_max: float) -> None:
     # Plot mean + std-dev
     plt.axvline(data_mean, color="k", linestyle="dashed", label="mean")
     for i in range(3):
@@ -24,14 +53,12 @@ def _plot_histogram(data):
         )
 
     # Plot max
-    plt.axvline(np.amax(data), color="r", linestyle="dotted", label="Max Depth")
+    plt.axvline(data_max, color="r", linestyle="dotted", label="Max Depth")
 
     plt.title("Depth Readings Histogram (m)")
     plt.ylabel("# of depth readings")
     plt.xlabel("Water depth (m)")
     plt.legend()
-    fig.tight_layout()
-    return fig
 
 
 def _plot_depth_as_heat_map(data, cell_size_m: int):
@@ -162,6 +189,18 @@ def plot_polys(
     return fig
 
 
+def plot_contact_sheet(images: List[np.ndarray], titles: List[str], cols: int = 5):
+    rows = max(1, math.ceil(len(images) / cols))
+    fig, axes = plt.subplots(rows, cols, figsize=(3 * cols, 3 * rows), squeeze=False)
+    for ax in axes.ravel():
+        ax.axis("off")
+    for ax, im, title in zip(axes.ravel(), images, titles):
+        ax.imshow(im, cmap="viridis", interpolation="nearest")
+        ax.set_title(title, fontsize=8)
+    fig.tight_layout()
+    return fig
+
+
 def _plot_contour_results(background: np.ndarray, contours: Any, hierarchy: Any) -> Any:
     return cv2.drawContours(
         cv2.drawContours(
@@ -1,28 +1,38 @@
 from dataclasses import asdict
 import json
+import os
 from pathlib import Path
 import shutil
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 import matplotlib.pyplot as plt
 import numpy as np
 import streamlit as st
-from common.data_helpers import Config
+from common.artifacts import DEFAULT_ARTIFACTS, EXPORT_ARTIFACTS
+from common.data_helpers import Config, masked_grid_stats, trim_to_data_extent
 from common.io import make_zip_archive
 from common.quantize import (
+    LEVEL_STRATEGIES,
     export_quantize_results,
     get_contours,
     quantize_depth_grid,
+    remove_layer_specks,
+    smooth_layer_counts,
     smooth_layer_mask,
 )
+from common.simplify import SIMPLIFY_METHODS
+from common.smoothing import (
+    DEFAULT_SMOOTHING_STRENGTHS,
+    FIELD_SMOOTHING_METHODS,
+    SMOOTHING_METHODS,
+)
 from common.st_extensions import (
-    crop_depth_grid,
     upload_and_configure_depth_grid,
     viz_depth_grid,
 )
 from common.viz import (
     _plot_contour_results,
     _plot_depth_as_heat_map,
-    _plot_histogram,
+    _plot_histogram_from_stats,
     plot_polys,
 )
 from PIL import Image
@@ -38,12 +48,26 @@ def smooth_layer_mask_CACHED(*args, **kwargs):
     return smooth_layer_mask(*args, **kwargs)
 
 
+@st.cache(allow_output_mutation=True)
+def smooth_layer_counts_CACHED(*args, **kwargs):
+    return smooth_layer_counts(*args, **kwargs)
+
+
 def main():
     st.title("Quantize Bathymetry")
-    depth_grid = upload_and_configure_depth_grid()
-    if depth_grid is None:
+    masked_depth_grid = upload_and_configure_depth_grid(allow_crop=True)
+    if masked_depth_grid is None:
         st.warning("No data grid...")
         return
+    if st.sidebar.checkbox(
+        label="Trim to data extent",
+        value=False,
+        help="If True, process only the bounding box of cells w/ depth. Exported contours remain relative to the full grid.",
+    ):
+        masked_depth_grid = trim_to_data_extent(masked_depth_grid)
+    depth_grid = masked_depth_grid.depth_grid
+    valid_mask = masked_depth_grid.valid_mask
+    stats = masked_grid_stats(masked_depth_grid)
     cell_size_m = st.sidebar.select_slider(
         label="Cell Size (m)",
         help="The resolution of x,y readings in m.",
@@ -51,16 +75,17 @@ def main():
         value=30,
     )
 
-    if st.checkbox(label="Crop Region", value=False):
-        depth_grid = crop_depth_grid(depth_grid=np.copy(depth_grid))
-
     c1, _, c2, _, c3 = st.columns((3, 1, 10, 1, 10))
     c1.subheader("Details")
     c1.write("Grid shape: {0}".format(depth_grid.shape))
-    c1.write(f"Max depth: {depth_grid.max()}m")
+    c1.write(f"Max depth: {stats.max}m")
+    if masked_depth_grid.peak_memory_bytes is not None:
+        c1.write(
+            f"Preprocessing peak memory: {masked_depth_grid.peak_memory_bytes / 2**20:.1f}MB"
+        )
 
     c2.subheader("Histogram")
-    c2.pyplot(_plot_histogram(depth_grid.flatten()))
+    c2.pyplot(_plot_histogram_from_stats(stats))
 
     c3.subheader("Heatmap")
     c3.pyplot(_plot_depth_as_heat_map(depth_grid, cell_size_m=cell_size_m))
@@ -71,8 +96,8 @@ def main():
     if st.checkbox("Visualize depth grid", value=False):
         viz_depth_grid(depth_grid=depth_grid, cell_size_m=cell_size_m)
 
-    max_depth_m = depth_grid.max()
-    depth_grid_norm = depth_grid / depth_grid.max()
+    max_depth_m = stats.max
+    depth_grid_norm = depth_grid / max_depth_m
 
     st.subheader("Depth Map - Raw")
     c1, _, c2 = st.columns((4, 1, 4))
@@ -109,10 +134,22 @@ def main():
         help="The starting depth for the first layer... beyond which subsequent layers will be evenly spaced. This helps to visualize shallow depths when overall water depth range is high.",
     )
 
+    level_strategy = st.selectbox(
+        label="Level strategy",
+        options=list(LEVEL_STRATEGIES),
+        help="How the depth levels are chosen: evenly spaced (linspace), equal-area (quantiles), Jenks natural breaks (jenks) or k-means (kmeans).",
+    )
+
     quantize_results = quantize_depth_grid_CACHED(
         depth_grid=depth_grid,
         levels=levels,
         quantize_depth_start_m=quantize_depth_start_m,
+        valid_mask=valid_mask,
+        origin=masked_depth_grid.origin,
+        canvas_shape=masked_depth_grid.canvas_shape,
+        max_depth_m=max_depth_m,
+        level_strategy=level_strategy,
+        stats=stats,
     )
 
     c1, _, c2 = st.columns((4, 1, 4))
@@ -148,14 +185,36 @@ def main():
     scale_up_factor = c3.number_input(
         label="Scale up factor", value=1, min_value=1, max_value=8, step=1
     )
-    layer_depth = layer_depths[layer_idx]
+    smooth_once = c3.checkbox(
+        "Smooth all layers at once",
+        value=False,
+        help="If True, smooth all layers from a single field so they stay nested. Not supported by the sdf smoothing method.",
+    )
+    smoothing_method = c3.selectbox(
+        label="Smoothing method",
+        # Only those which can smooth a single field, if smoothing all layers at once
+        options=list(FIELD_SMOOTHING_METHODS if smooth_once else SMOOTHING_METHODS),
+        help="How layer masks are smoothed: repeated median blurs (median), gaussian blur (gaussian), opening + closing (morphological) or a blurred signed distance field (sdf).",
+    )
+    smoothing_strength = c3.number_input(
+        label="Smoothing strength",
+        value=float(DEFAULT_SMOOTHING_STRENGTHS[smoothing_method]),
+        min_value=0.0,
+        step=0.5,
+        help="The number of passes for median, or a radius/std-dev in cells for the others.",
+    )
+    min_speck_area_m2 = c3.number_input(
+        label="Min speck area (m^2)",
+        value=0.0,
+        min_value=0.0,
+        step=float(cell_size_m) ** 2,
+        help="If > 0, islands and holes of the smoothed mask w/ a smaller area are removed before tracing contours.",
+    )
 
     c1, _, c2 = st.columns((4, 1, 4))
     # Retrieve the mask for this layer. If configured for the first layer, ignore the quantization and take anything with a depth reading > 0
-    layer_mask = (
-        quantize_results.depth_grid_quant > 0
-        if layer_idx == 0 and force_first_layer
-        else quantize_results.depth_grid_quant >= layer_depth
+    layer_mask = quantize_results.layer_mask(
+        layer_idx, force_first_layer=force_first_layer
     )
     # Convert boolean arr to black/white image
     layer_mask_im = Image.fromarray(255 * layer_mask.astype(np.uint8))
@@ -163,9 +222,29 @@ def main():
     c1.image(layer_mask_im)
 
     with st.spinner("Smoothing image..."):
-        layer_mask_smoothed = smooth_layer_mask_CACHED(
-            layer_mask, scale_up_factor=scale_up_factor
-        )
+        if smooth_once:
+            layer_mask_smoothed = (
+                smooth_layer_counts_CACHED(
+                    quantize_results,
+                    force_first_layer=force_first_layer,
+                    scale_up_factor=scale_up_factor,
+                    smoothing_method=smoothing_method,
+                    smoothing_strength=smoothing_strength,
+                )
+                > layer_idx
+            )
+        else:
+            layer_mask_smoothed = smooth_layer_mask_CACHED(
+                layer_mask,
+                scale_up_factor=scale_up_factor,
+                valid_mask=valid_mask,
+                smoothing_method=smoothing_method,
+                smoothing_strength=smoothing_strength,
+            )
+        if min_speck_area_m2 > 0:
+            layer_mask_smoothed = remove_layer_specks(
+                layer_mask_smoothed, min_speck_area_m2, cell_size_m
+            )
         c2.write("Smoothed Mask:")
         c2.image(Image.fromarray(np.invert(layer_mask_smoothed)))
 
@@ -179,10 +258,21 @@ def main():
         step=0.001,
         format="%.3f",
     )
+    simplify_method = c1.selectbox(
+        "Simplification method",
+        options=list(SIMPLIFY_METHODS),
+        index=0,
+    )
     include_originals = c1.checkbox("Show originals", value=False)
     include_simplified = c1.checkbox("Show simplified", value=True)
     contour_results = get_contours(
-        layer_mask=layer_mask_smoothed, simplify_tolerance=simplify_tolerance
+        layer_mask=layer_mask_smoothed,
+        simplify_tolerance=simplify_tolerance,
+        # Already applied when smoothing, and filled holes may cover cells w/o data
+        valid_mask=None if min_speck_area_m2 > 0 else valid_mask,
+        origin=masked_depth_grid.origin,
+        canvas_shape=masked_depth_grid.canvas_shape,
+        simplify_method=simplify_method,
     )
     c2.write("Polygons:")
     c2.pyplot(
@@ -205,6 +295,20 @@ def main():
     )
 
     st.subheader("Export")
+    export_workers = st.number_input(
+        label="Export workers",
+        value=1,
+        min_value=1,
+        max_value=os.cpu_count() or 1,
+        step=1,
+        help="The number of processes exporting layers concurrently.",
+    )
+    export_artifacts = st.multiselect(
+        label="Artifacts",
+        options=list(EXPORT_ARTIFACTS),
+        default=[name for name in EXPORT_ARTIFACTS if name in DEFAULT_ARTIFACTS],
+        help="The outputs to export, only the intermediates they need are computed.",
+    )
     if st.button("Generate Export"):
         with TemporaryDirectory() as tmp_dir:
             tmp_dir = Path(tmp_dir)
@@ -224,6 +328,12 @@ def main():
                             quantize_depth_start_m=float(quantize_depth_start_m),
                             scale_up_factor=int(scale_up_factor),
                             force_first_layer=force_first_layer,
+                            level_strategy=level_strategy,
+                            smoothing_method=smoothing_method,
+                            smoothing_strength=float(smoothing_strength),
+                            smooth_once=smooth_once,
+                            simplify_method=simplify_method,
+                            min_speck_area_m2=float(min_speck_area_m2),
                         )
                     ),
                     f,
@@ -236,6 +346,7 @@ def main():
                 str(tmp_dir / "depth_map_quantized_plot.jpg"),
                 dpi=1000,
             )
+            progress_bar = st.progress(0)
             with st.spinner("Exporting results... this may take a moment."):
                 export_quantize_results(
                     quantize_results=quantize_results,
@@ -243,6 +354,17 @@ def main():
                     force_first_layer=force_first_layer,
                     scale_up_factor=scale_up_factor,
                     simplify_tolerance=0.001,
+                    simplify_method=simplify_method,
+                    smoothing_method=smoothing_method,
+                    smoothing_strength=smoothing_strength,
+                    smooth_once=smooth_once,
+                    min_speck_area_m2=min_speck_area_m2,
+                    cell_size_m=cell_size_m,
+                    workers=int(export_workers),
+                    artifacts=export_artifacts,
+                    progress=lambda n_done, n_layers: progress_bar.progress(
+                        n_done / max(n_layers, 1)
+                    ),
                 )
 
             with NamedTemporaryFile(suffix=".zip") as tmp_zip:
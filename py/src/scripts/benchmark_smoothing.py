@@ -0,0 +1,173 @@
+import json
+import os
+import os.path as osp
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from common.data_helpers import load_data, masked_grid_stats
+from common.quantize import quantize_depth_grid, smooth_layer_mask
+from common.smoothing import (
+    DEFAULT_SMOOTHING_STRENGTHS,
+    SMOOTHING_METHODS,
+    smoothing_halo,
+)
+
+
+def _read_status_kb(key: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> None:
+    # Linux only: resets VmHWM to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def main(args):
+    os.makedirs(args.output, exist_ok=True)
+    print("Loading data...")
+    masked_depth_grid = load_data(
+        fpath=args.input,
+        depth_unit_m=args.depth_unit_m,
+        max_z_score=args.max_z_score,
+    )
+    stats = masked_grid_stats(masked_depth_grid)
+    quantize_results = quantize_depth_grid(
+        depth_grid=masked_depth_grid.depth_grid,
+        levels=args.levels,
+        quantize_depth_start_m=args.quantize_depth_start_m,
+        valid_mask=masked_depth_grid.valid_mask,
+        max_depth_m=stats.max,
+    )
+
+    methods = args.methods or list(SMOOTHING_METHODS)
+    if args.tile_size is not None:
+        # The signed distance field can't be tiled
+        methods = [m for m in methods if smoothing_halo(2, m) is not None]
+    results = []
+    for method in methods:
+        strength = DEFAULT_SMOOTHING_STRENGTHS[method]
+        for layer_idx in range(args.levels - 1):
+            layer_mask = quantize_results.layer_mask(layer_idx, force_first_layer=True)
+            _reset_peak_rss()
+            rss_start_kb = _read_status_kb("VmRSS:")
+            t_start = time.perf_counter()
+            smoothed = smooth_layer_mask(
+                layer_mask,
+                scale_up_factor=args.scale_up_factor,
+                valid_mask=masked_depth_grid.valid_mask,
+                smoothing_method=method,
+                smoothing_strength=strength,
+                smoothing_tile_size=args.tile_size,
+                smoothing_workers=args.workers,
+            )
+            elapsed_s = time.perf_counter() - t_start
+            peak_kb = _read_status_kb("VmHWM:")
+            peak_mb = (
+                (peak_kb - rss_start_kb) / 1024
+                if peak_kb is not None and rss_start_kb is not None
+                else None
+            )
+            results.append(
+                {
+                    "method": method,
+                    "strength": strength,
+                    "layer": layer_idx,
+                    "seconds": elapsed_s,
+                    "peak_memory_mb": peak_mb,
+                    # Cells flipped by smoothing, a rough measure of how aggressive it is
+                    "cells_changed": int((smoothed != layer_mask).sum()),
+                }
+            )
+            print(
+                f"{method:>14} layer {layer_idx}: {elapsed_s * 1000:8.1f}ms"
+                + (f", peak +{peak_mb:.1f}MB" if peak_mb is not None else "")
+                + f", {results[-1]['cells_changed']} cells changed"
+            )
+
+    with open(osp.join(args.output, "smoothing_benchmark.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="Path to GIS ASCII, of GeoTiff data file.",
+    )
+    parser.add_argument(
+        "--depth_unit_m",
+        type=float,
+        required=True,
+        help="The resolution of z readings in m.",
+    )
+    parser.add_argument(
+        "--max_z_score",
+        type=float,
+        default=0,
+        help="The max z-score, beyond which data is clipped.",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        default=4,
+        help="The number of evenly spaced contour levels. This includes the depth-0 contour.",
+    )
+    parser.add_argument(
+        "--quantize_depth_start_m",
+        type=float,
+        default=1.0,
+        help="The starting depth for the first layer.",
+    )
+    parser.add_argument(
+        "--scale_up_factor",
+        default=4,
+        type=int,
+        help="The scale up factor to use (multiple of 2) when smoothing.",
+    )
+    parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=list(SMOOTHING_METHODS),
+        help="The smoothing methods to benchmark, all by default.",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=None,
+        help="If provided, smooth by tiles of this many cells.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="The number of processes smoothing tiles. Peak memory is only measured for this process, ie: w/ 1 worker.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=osp.join("output", "benchmarks"),
+        help="Path to write the benchmark results.",
+    )
+    args = parser.parse_args()
+
+    print(args)
+    main(args)
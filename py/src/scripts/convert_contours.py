@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from common.contour_format import CONTOUR_ENCODINGS, convert_contours
+
+
+def main(args):
+    convert_contours(args.input, args.output, encoding=args.encoding)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="Path to a layer's contours, either JSON (.json) or a binary contours directory.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="Path to write the converted contours, binary if the input is JSON and vice versa.",
+    )
+    parser.add_argument(
+        "--encoding",
+        type=str,
+        default="float32",
+        choices=list(CONTOUR_ENCODINGS),
+        help="The coordinate encoding when writing binary contours. int32 is fixed-point.",
+    )
+    args = parser.parse_args()
+
+    print(args)
+    main(args)
@@ -7,14 +7,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
-from common.data_helpers import load_data
+from common.data_helpers import load_data, masked_grid_stats
 from common.viz import (
     _plot_depth_3D_as_contours,
     _plot_depth_3D_as_height_map,
     _plot_depth_3D_surface,
     _plot_depth_3D_wireframe,
     _plot_depth_as_heat_map,
-    _plot_histogram,
+    _plot_histogram_from_stats,
 )
 
 
@@ -24,21 +24,25 @@ def main(args):
         json.dump(vars(args), f)
 
     print("Loading data...")
-    depth_grid = load_data(
+    masked_depth_grid = load_data(
         fpath=args.input,
         depth_unit_m=args.depth_unit_m,
         depth_min_m=args.depth_min_m,
         depth_max_m=args.depth_max_m,
         max_z_score=args.max_z_score,
+        window=tuple(args.window) if args.window else None,
+        step=args.step,
     )
+    depth_grid = masked_depth_grid.depth_grid
+    stats = masked_grid_stats(masked_depth_grid)
 
     print("Grid shape: {0}".format(depth_grid.shape))
-    print(f"Max depth: {depth_grid.max()}m")
+    print(f"Max depth: {stats.max}m")
 
-    inverted_depth_grid = -(depth_grid - np.amax(depth_grid))
+    inverted_depth_grid = -(depth_grid - stats.max)
 
     print("Creating histogram...")
-    fig = _plot_histogram(depth_grid.flatten())
+    fig = _plot_histogram_from_stats(stats)
     plt.savefig(osp.join(args.output, "histogram.jpg"))
     plt.close()
 
@@ -137,6 +141,20 @@ if __name__ == "__main__":
         default=0,
         help="The max permitted zscore, beyond which data is clipped.",
     )
+    parser.add_argument(
+        "--window",
+        type=int,
+        nargs=4,
+        default=None,
+        metavar=("ROW", "COL", "HEIGHT", "WIDTH"),
+        help="If provided, only read this pixel window of the input.",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=1,
+        help="Decimation factor applied when reading the input.",
+    )
     parser.add_argument(
         "--output",
         type=str,
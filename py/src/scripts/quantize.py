@@ -3,20 +3,32 @@ import os
 import os.path as osp
 from pathlib import Path
 import sys
+import time
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
-from common.data_helpers import load_data
+from common.artifacts import (
+    ARTIFACTS,
+    DEFAULT_ARTIFACTS,
+    SCRIPT_ARTIFACTS,
+    ArtifactManifest,
+    estimate_cost,
+)
+from common.data_helpers import load_data, masked_grid_stats, trim_to_data_extent
 from common.quantize import (
+    CONTOUR_METHODS,
+    LEVEL_STRATEGIES,
     export_quantize_results,
     quantize_depth_grid,
-    smooth_layer_mask,
 )
+from common.simplify import SIMPLIFY_METHODS
+from common.smoothing import FIELD_SMOOTHING_METHODS, SMOOTHING_METHODS
+from common.stage_cache import StageCache, file_identity, lazy_stage, stage_key
 from common.viz import (
     _plot_depth_3D_as_contours,
-    _plot_histogram,
+    _plot_histogram_from_stats,
 )
 
 
@@ -26,69 +38,183 @@ def main(args):
     with open(osp.join(output_dir, "args.json"), "w") as f:
         json.dump(vars(args), f)
 
-    print("Loading data...")
-    depth_grid = load_data(
-        fpath=args.input,
-        depth_unit_m=args.depth_unit_m,
-        depth_min_m=args.depth_min_m,
-        depth_max_m=args.depth_max_m,
-        max_z_score=args.max_z_score,
+    artifacts = set(args.artifacts)
+    manifest = ArtifactManifest(output_dir)
+    cache = (
+        StageCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 2**30))
+        if args.cache_dir
+        else None
+    )
+
+    def _stage(name: str, key: str, compute, *inputs):
+        # Computed on first use, unless cached. See stage_cache.
+        def _record(seconds: float, cached: bool):
+            manifest.record_stage(name, seconds, cached=cached)
+            if cached:
+                print(f"Loaded {name} from the cache")
+
+        return lazy_stage(cache, key, compute, *inputs, record=_record)
+
+    # The input file's identity stands in for its content
+    load_key = stage_key(
+        "load",
+        {
+            "input": file_identity(args.input),
+            "depth_unit_m": args.depth_unit_m,
+            "depth_min_m": args.depth_min_m,
+            "depth_max_m": args.depth_max_m,
+            "max_z_score": args.max_z_score,
+            "window": args.window,
+            "step": args.step,
+        },
+    )
+
+    def _load():
+        print("Loading data...")
+        masked_depth_grid = load_data(
+            fpath=args.input,
+            depth_unit_m=args.depth_unit_m,
+            depth_min_m=args.depth_min_m,
+            depth_max_m=args.depth_max_m,
+            max_z_score=args.max_z_score,
+            window=tuple(args.window) if args.window else None,
+            step=args.step,
+        )
+        if masked_depth_grid.peak_memory_bytes is not None:
+            print(
+                f"Preprocessing peak memory: {masked_depth_grid.peak_memory_bytes / 2**20:.1f}MB"
+            )
+        return masked_depth_grid
+
+    def _trim(masked_depth_grid):
+        return trim_to_data_extent(masked_depth_grid, margin=args.trim_margin)
+
+    def _stats(masked_depth_grid):
+        # Reduced by row blocks, unless already known from the dataset's statistics
+        return masked_grid_stats(masked_depth_grid)
+
+    def _quantize(preprocessed):
+        masked_depth_grid, grid_stats = preprocessed
+        return quantize_depth_grid(
+            depth_grid=masked_depth_grid.depth_grid,
+            levels=args.levels,
+            quantize_depth_start_m=args.quantize_depth_start_m,
+            valid_mask=masked_depth_grid.valid_mask,
+            origin=masked_depth_grid.origin,
+            canvas_shape=masked_depth_grid.canvas_shape,
+            max_depth_m=grid_stats.max,
+            level_strategy=args.level_strategy,
+            stats=grid_stats,
+        )
+
+    load = _stage("load", load_key, _load)
+    preprocess_key = stage_key(
+        "preprocess", {"trim": args.trim, "trim_margin": args.trim_margin}, load_key
     )
+    # Only a trimmed grid is cached, an untrimmed one is the loaded grid itself
+    trimmed = (
+        _stage("trim", stage_key("trim", {}, preprocess_key), _trim, load)
+        if args.trim
+        else load
+    )
+    stats = _stage("stats", stage_key("stats", {}, preprocess_key), _stats, trimmed)
+
+    def preprocess():
+        return trimmed(), stats()
 
-    max_depth_m = depth_grid.max()
-    depth_grid_norm = depth_grid / depth_grid.max()
+    quantize_key = stage_key(
+        "quantize",
+        {
+            "levels": args.levels,
+            "quantize_depth_start_m": args.quantize_depth_start_m,
+            "level_strategy": args.level_strategy,
+        },
+        preprocess_key,
+    )
+    quantize = _stage("quantize", quantize_key, _quantize, preprocess)
+
+    # The data is only loaded if a cached stage downstream of it is missing
+    quantize_results = quantize()
+    max_depth_m = quantize_results.max_depth_m
 
     print(f"Max depth: {max_depth_m}m")
 
+    def _depth_grid_norm():
+        return preprocess()[0].depth_grid / max_depth_m
+
+    def _timed(name: str, write):
+        # Render + write an artifact if selected, recording it in the manifest
+        if name not in artifacts:
+            return
+        start = time.perf_counter()
+        write()
+        manifest.record_artifact(
+            name,
+            osp.join(output_dir, SCRIPT_ARTIFACTS[name].path),
+            time.perf_counter() - start,
+        )
+
     print("Creating plots...")
 
     # Histogram
-    fig = _plot_histogram(depth_grid.flatten())
-    plt.savefig(osp.join(args.output, "histogram.jpg"))
-    plt.close()
+    def _histogram():
+        fig = _plot_histogram_from_stats(stats())
+        plt.savefig(osp.join(args.output, "histogram.jpg"))
+        plt.close()
+
+    _timed("histogram", _histogram)
 
     # Raw depth map image
     # yields a grayscale image w/ pixel values in range 0-255 corresponding to 0-max-depth)
-    depth_map_im_raw = Image.fromarray((255.0 * depth_grid_norm).astype(np.uint8))
-    depth_map_im_raw.save(osp.join(output_dir, "depth_map_raw.png"))
-
-    plt.figure()
-    p = plt.imshow(depth_grid_norm * max_depth_m)
-    clb = plt.colorbar(p)
-    clb.ax.set_title("Water Depth (m)", fontsize=8)
-    plt.title("Raw Depth Map")
-    plt.xlabel(f"X ({args.cell_size_m} m)")
-    plt.ylabel(f"Y ({args.cell_size_m} m)")
-    plt.savefig(
-        osp.join(output_dir, "depth_map_raw_plot.jpg"),
-        dpi=1000,
-    )
-    plt.close()
-
-    quantize_results = quantize_depth_grid(
-        depth_grid=depth_grid,
-        levels=args.levels,
-        quantize_depth_start_m=args.quantize_depth_start_m,
+    def _depth_map_raw():
+        depth_map_im_raw = Image.fromarray(
+            (255.0 * _depth_grid_norm()).astype(np.uint8)
+        )
+        depth_map_im_raw.save(osp.join(output_dir, "depth_map_raw.png"))
+
+    _timed("depth_map_raw", _depth_map_raw)
+
+    def _depth_map_raw_plot():
+        plt.figure()
+        p = plt.imshow(_depth_grid_norm() * max_depth_m)
+        clb = plt.colorbar(p)
+        clb.ax.set_title("Water Depth (m)", fontsize=8)
+        plt.title("Raw Depth Map")
+        plt.xlabel(f"X ({args.cell_size_m} m)")
+        plt.ylabel(f"Y ({args.cell_size_m} m)")
+        plt.savefig(
+            osp.join(output_dir, "depth_map_raw_plot.jpg"),
+            dpi=1000,
+        )
+        plt.close()
+
+    _timed("depth_map_raw_plot", _depth_map_raw_plot)
+
+    print(
+        f"Estimated cost of the selected artifacts: {estimate_cost(artifacts, args.levels - 1):.0f}"
     )
     print(
         f"Quantizing w/ {args.levels} discrete depth values: {[round(max_depth_m*z, 1) for z in quantize_results.quantized_depth_values_norm]}m"
     )
 
     # Plot quantized heatmap
-    plt.figure()
-    p = plt.imshow(quantize_results.depth_grid_quant)
-    clb = plt.colorbar(p)
-    clb.ax.set_title("Water Depth (m)", fontsize=8)
-    plt.title(
-        f"Quantized Depth Map: {args.levels} depths\n{[round(z, 1) for z in quantize_results.quantized_depth_values]}m"
-    )
-    plt.xlabel(f"X ({args.cell_size_m} m)")
-    plt.ylabel(f"Y ({args.cell_size_m} m)")
-    plt.savefig(
-        osp.join(output_dir, "depth_map_quantized_plot.jpg"),
-        dpi=1000,
-    )
-    plt.close()
+    def _depth_map_quantized_plot():
+        plt.figure()
+        p = plt.imshow(quantize_results.depth_grid_quant)
+        clb = plt.colorbar(p)
+        clb.ax.set_title("Water Depth (m)", fontsize=8)
+        plt.title(
+            f"Quantized Depth Map: {args.levels} depths\n{[round(z, 1) for z in quantize_results.quantized_depth_values]}m"
+        )
+        plt.xlabel(f"X ({args.cell_size_m} m)")
+        plt.ylabel(f"Y ({args.cell_size_m} m)")
+        plt.savefig(
+            osp.join(output_dir, "depth_map_quantized_plot.jpg"),
+            dpi=1000,
+        )
+        plt.close()
+
+    _timed("depth_map_quantized_plot", _depth_map_quantized_plot)
 
     # Create masks for the layers
     export_quantize_results(
@@ -96,33 +222,66 @@ def main(args):
         output_dir=Path(output_dir) / "layer_masks",
         force_first_layer=args.force_first_layer,
         scale_up_factor=args.scale_up_factor,
-        simplify_tolerance=0.001,
+        simplify_tolerance=args.simplify_tolerance,
+        smoothing_method=args.smoothing_method,
+        smoothing_strength=args.smoothing_strength,
+        smooth_once=args.smooth_once,
+        smoothing_tile_size=args.smoothing_tile_size,
+        smoothing_workers=args.smoothing_workers,
+        simplify_method=args.simplify_method,
+        binary_contours=args.binary_contours,
+        contour_method=args.contour_method,
+        depth_grid=(
+            preprocess()[0].depth_grid
+            if args.contour_method == "marching_squares"
+            else None
+        ),
+        iso_smoothing_sigma=args.iso_smoothing_sigma,
+        min_area=args.min_area,
+        min_speck_area_m2=args.min_speck_area_m2,
+        # Cells of the decimated grid
+        cell_size_m=args.cell_size_m * args.step,
+        workers=args.export_workers,
+        writer_threads=args.writer_threads,
+        progress=lambda n_done, n_layers: print(f"Exported {n_done}/{n_layers} layers"),
+        artifacts=artifacts,
+        manifest=manifest,
+        cache=cache,
+        cache_key=quantize_key,
     )
 
     # Plot contours
-    fig = _plot_depth_3D_as_contours(
-        data=quantize_results.depth_grid_quant,
-        cell_size_m=args.cell_size_m,
-        levels=args.levels,
-        cmap="viridis",
-        title=f"Depth as 3d contours. N-Levels={args.levels}",
-    )
-    plt.savefig(osp.join(output_dir, "separated_contours.jpg"), dpi=500)
-    plt.close()
+    def _separated_contours():
+        fig = _plot_depth_3D_as_contours(
+            data=quantize_results.depth_grid_quant,
+            cell_size_m=args.cell_size_m,
+            levels=args.levels,
+            cmap="viridis",
+            title=f"Depth as 3d contours. N-Levels={args.levels}",
+        )
+        plt.savefig(osp.join(output_dir, "separated_contours.jpg"), dpi=500)
+        plt.close()
+
+    _timed("separated_contours", _separated_contours)
 
     # Plot inverted contours
-    fig = _plot_depth_3D_as_contours(
-        data=-(
-            quantize_results.depth_grid_quant
-            - np.amax(quantize_results.depth_grid_quant)
-        ),
-        cell_size_m=args.cell_size_m,
-        levels=args.levels,
-        cmap="viridis",
-        title=f"Depth as 3d contours. N-Levels={args.levels}",
-    )
-    plt.savefig(osp.join(output_dir, "separated_contours_inverted.jpg"), dpi=500)
-    plt.close()
+    def _separated_contours_inverted():
+        fig = _plot_depth_3D_as_contours(
+            data=-(
+                quantize_results.depth_grid_quant
+                - np.amax(quantize_results.depth_grid_quant)
+            ),
+            cell_size_m=args.cell_size_m,
+            levels=args.levels,
+            cmap="viridis",
+            title=f"Depth as 3d contours. N-Levels={args.levels}",
+        )
+        plt.savefig(osp.join(output_dir, "separated_contours_inverted.jpg"), dpi=500)
+        plt.close()
+
+    _timed("separated_contours_inverted", _separated_contours_inverted)
+
+    print(f"Wrote {manifest.write()}")
 
 
 if __name__ == "__main__":
@@ -175,12 +334,31 @@ if __name__ == "__main__":
         default=0,
         help="The max z-score, beyond which data is clipped.",
     )
+    parser.add_argument(
+        "--trim",
+        type=str2bool,
+        default=False,
+        help="If True, process only the bounding box of cells w/ depth. Exported contours remain relative to the full grid.",
+    )
+    parser.add_argument(
+        "--trim_margin",
+        type=int,
+        default=16,
+        help="The margin (in cells) kept around the bounding box when trimming.",
+    )
     parser.add_argument(
         "--levels",
         type=int,
         default=4,
         help="The number of evenly spaced contour levels. This includes the depth-0 contour. ie: N levels will correspond to N-1 output layers.",
     )
+    parser.add_argument(
+        "--level_strategy",
+        type=str,
+        default="linspace",
+        choices=list(LEVEL_STRATEGIES),
+        help="How the depth levels are chosen: evenly spaced (linspace), equal-area (quantiles), Jenks natural breaks (jenks) or k-means (kmeans).",
+    )
     parser.add_argument(
         "--quantize_depth_start_m",
         type=float,
@@ -193,12 +371,134 @@ if __name__ == "__main__":
         type=int,
         help="The scale up factor to use (multiple of 2) when smoothing.",
     )
+    parser.add_argument(
+        "--smoothing_method",
+        type=str,
+        default="median",
+        choices=list(SMOOTHING_METHODS),
+        help="How layer masks are smoothed: repeated median blurs (median), gaussian blur (gaussian), opening + closing (morphological) or a blurred signed distance field (sdf).",
+    )
+    parser.add_argument(
+        "--smoothing_strength",
+        type=float,
+        default=None,
+        help="The strength of the smoothing method, ie: the number of passes for median, or a radius/std-dev in cells for the others. Uses the method's default if not provided.",
+    )
+    parser.add_argument(
+        "--smooth_once",
+        type=str2bool,
+        default=False,
+        help="If True, smooth all layers at once from a single field so they stay nested. Not supported by the sdf smoothing method.",
+    )
+    parser.add_argument(
+        "--smoothing_tile_size",
+        type=int,
+        default=None,
+        help="If provided, smooth by tiles of this many cells (w/ overlap) to bound memory on large grids. The result is identical. Not supported by the sdf smoothing method.",
+    )
+    parser.add_argument(
+        "--smoothing_workers",
+        type=int,
+        default=1,
+        help="The number of processes smoothing tiles concurrently, if smoothing by tiles.",
+    )
+    parser.add_argument(
+        "--simplify_method",
+        type=str,
+        default="douglas_peucker",
+        choices=list(SIMPLIFY_METHODS),
+        help="The polygon simplification method.",
+    )
+    parser.add_argument(
+        "--simplify_tolerance",
+        "--simplify-tolerance",
+        type=float,
+        default=0.001,
+        help="The polygon simplification tolerance, in coordinates normalized to the grid (range 0:1).",
+    )
+    parser.add_argument(
+        "--binary_contours",
+        type=str2bool,
+        default=False,
+        help="If True, also write each layer's contours in the compact binary format.",
+    )
+    parser.add_argument(
+        "--contour_method",
+        type=str,
+        default="raster",
+        choices=list(CONTOUR_METHODS),
+        help="How contours are traced: from the smoothed layer masks (raster), or as sub-cell iso lines of the depth grid (marching_squares), which ignores the mask smoothing args.",
+    )
+    parser.add_argument(
+        "--iso_smoothing_sigma",
+        type=float,
+        default=0.0,
+        help="If > 0 and tracing iso lines, the std-dev (in cells) of a blur applied to the depth grid first.",
+    )
+    parser.add_argument(
+        "--min_area",
+        type=float,
+        default=0.0,
+        help="Polygons and holes w/ a smaller area (normalized, ie: as a fraction of the square canvas) are dropped from the exported contours.",
+    )
+    parser.add_argument(
+        "--min_speck_area_m2",
+        type=float,
+        default=0.0,
+        help="If > 0, islands and holes of the smoothed layer masks w/ a smaller area (in m^2) are removed before tracing contours.",
+    )
+    parser.add_argument(
+        "--export_workers",
+        type=int,
+        default=1,
+        help="The number of processes exporting layers concurrently. The output is identical to a serial export.",
+    )
+    parser.add_argument(
+        "--writer_threads",
+        type=int,
+        default=2,
+        help="The number of threads writing exported files in the background (per export worker). 0 writes them synchronously.",
+    )
+    parser.add_argument(
+        "--artifacts",
+        type=str,
+        nargs="+",
+        default=list(DEFAULT_ARTIFACTS),
+        choices=list(ARTIFACTS),
+        help="The outputs to produce, only the intermediates they need are computed. ex: contours_json alone for CAD. All but contours_binary by default.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="If provided, cache the output of each pipeline stage here, so a re-run only recomputes the stages downstream of a changed arg.",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=4.0,
+        help="The size of the cache, beyond which the least recently used stage outputs are evicted.",
+    )
     parser.add_argument(
         "--force_first_layer",
         type=str2bool,
         default=True,
         help="If True, force all depth > 0 to be included in the first layer. This helps with high depth range, causing the shallow areas be shorelines to be marked as 0.",
     )
+    parser.add_argument(
+        "--window",
+        type=int,
+        nargs=4,
+        default=None,
+        metavar=("ROW", "COL", "HEIGHT", "WIDTH"),
+        help="If provided, only read this pixel window of the input.",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=1,
+        help="Decimation factor applied when reading the input.",
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -206,6 +506,10 @@ if __name__ == "__main__":
         help="Path to write plots.",
     )
     args = parser.parse_args()
+    if args.smooth_once and args.smoothing_method not in FIELD_SMOOTHING_METHODS:
+        parser.error(
+            f"--smooth_once requires one of the smoothing methods {FIELD_SMOOTHING_METHODS}"
+        )
 
     print(args)
     main(args)
@@ -0,0 +1,206 @@
+import itertools
+import json
+import os
+import os.path as osp
+import sys
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from common.data_helpers import load_data, masked_grid_stats, trim_to_data_extent
+from common.quantize import LEVEL_STRATEGIES
+from common.sweep import SweepConfig, sweep_quantize
+from common.viz import plot_contact_sheet
+
+
+def main(args):
+    output_dir = args.output
+    os.makedirs(output_dir, exist_ok=True)
+    with open(osp.join(output_dir, "args.json"), "w") as f:
+        json.dump(vars(args), f)
+
+    print("Loading data...")
+    masked_depth_grid = load_data(
+        fpath=args.input,
+        depth_unit_m=args.depth_unit_m,
+        depth_min_m=args.depth_min_m,
+        depth_max_m=args.depth_max_m,
+        max_z_score=args.max_z_score,
+        window=tuple(args.window) if args.window else None,
+        step=args.step,
+    )
+    if args.trim:
+        masked_depth_grid = trim_to_data_extent(masked_depth_grid)
+    stats = masked_grid_stats(masked_depth_grid)
+
+    configs = [
+        SweepConfig(
+            levels=levels,
+            quantize_depth_start_m=start_m,
+            force_first_layer=force_first_layer,
+            level_strategy=level_strategy,
+        )
+        for levels, start_m, force_first_layer, level_strategy in itertools.product(
+            args.levels,
+            args.quantize_depth_start_m,
+            args.force_first_layer,
+            args.level_strategy,
+        )
+    ]
+    print(f"Sweeping {len(configs)} configurations...")
+    results = sweep_quantize(
+        masked_depth_grid,
+        configs=configs,
+        # Cells of the decimated grid
+        cell_size_m=args.cell_size_m * args.step,
+        stats=stats,
+        count_contours=args.count_contours,
+        thumbnail_size=args.thumbnail_size,
+    )
+
+    for result in results:
+        summary = result.summary
+        print(
+            f"{summary.config}: depths {[round(z, 1) for z in summary.quantized_depth_values]}m, cells per layer {summary.cells_per_layer}"
+            + (
+                f", contours per layer {summary.contours_per_layer}"
+                if summary.contours_per_layer is not None
+                else ""
+            )
+        )
+    with open(osp.join(output_dir, "sweep_summary.json"), "w") as f:
+        json.dump([result.summary.to_json() for result in results], f, indent=2)
+
+    print("Creating contact sheet...")
+    fig = plot_contact_sheet(
+        images=[result.layer_count_thumbnail for result in results],
+        titles=[
+            f"levels={r.summary.config.levels} start={r.summary.config.quantize_depth_start_m}m\n"
+            f"force_first={r.summary.config.force_first_layer} {r.summary.config.level_strategy}"
+            for r in results
+        ],
+    )
+    plt.savefig(osp.join(output_dir, "contact_sheet.jpg"), dpi=150)
+    plt.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    def str2bool(v):
+        if isinstance(v, bool):
+            return v
+        if v.lower() in ("yes", "true", "t", "y", "1"):
+            return True
+        elif v.lower() in ("no", "false", "f", "n", "0"):
+            return False
+        else:
+            raise argparse.ArgumentTypeError("Boolean value expected.")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="Path to GIS ASCII, of GeoTiff data file.",
+    )
+    parser.add_argument(
+        "--cell_size_m",
+        type=int,
+        required=True,
+        help="The resolution of x,y readings in m.",
+    )
+    parser.add_argument(
+        "--depth_unit_m",
+        type=float,
+        required=True,
+        help="The resolution of z readings in m.",
+    )
+    parser.add_argument(
+        "--depth_min_m",
+        type=float,
+        default=0.0,
+        help="Min depth in meters, values will be clipped.",
+    )
+    parser.add_argument(
+        "--depth_max_m",
+        type=float,
+        default=None,
+        help="If provided and > 0, Max depth in meters, values will be clipped.",
+    )
+    parser.add_argument(
+        "--max_z_score",
+        type=float,
+        default=0,
+        help="The max z-score, beyond which data is clipped.",
+    )
+    parser.add_argument(
+        "--trim",
+        type=str2bool,
+        default=False,
+        help="If True, process only the bounding box of cells w/ depth.",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        nargs="+",
+        default=[3, 4, 5, 6, 8],
+        help="The numbers of contour levels to sweep. This includes the depth-0 contour.",
+    )
+    parser.add_argument(
+        "--quantize_depth_start_m",
+        type=float,
+        nargs="+",
+        default=[0.0, 1.0],
+        help="The starting depths for the first layer to sweep.",
+    )
+    parser.add_argument(
+        "--force_first_layer",
+        type=str2bool,
+        nargs="+",
+        default=[True],
+        help="The force_first_layer values to sweep.",
+    )
+    parser.add_argument(
+        "--level_strategy",
+        type=str,
+        nargs="+",
+        default=["linspace"],
+        choices=list(LEVEL_STRATEGIES),
+        help="The level selection strategies to sweep.",
+    )
+    parser.add_argument(
+        "--count_contours",
+        type=str2bool,
+        default=False,
+        help="If True, also count the contours of each layer. This assigns levels to the full grid for each configuration.",
+    )
+    parser.add_argument(
+        "--thumbnail_size",
+        type=int,
+        default=256,
+        help="The max size (in cells) of the label maps in the contact sheet.",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        nargs=4,
+        default=None,
+        metavar=("ROW", "COL", "HEIGHT", "WIDTH"),
+        help="If provided, only read this pixel window of the input.",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=1,
+        help="Decimation factor applied when reading the input.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=osp.join("output", "sweep"),
+        help="Path to write the sweep summary and contact sheet.",
+    )
+    args = parser.parse_args()
+
+    print(args)
+    main(args)
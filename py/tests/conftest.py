@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules are imported as in the scripts, ie: w/ py/src on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
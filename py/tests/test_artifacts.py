@@ -0,0 +1,150 @@
+import json
+from pathlib import Path
+import threading
+
+from matplotlib.figure import Figure
+import numpy as np
+import pytest
+
+from common.artifacts import (
+    ARTIFACTS,
+    CAD_ARTIFACTS,
+    DEFAULT_ARTIFACTS,
+    EXPORT_ARTIFACTS,
+    ArtifactManifest,
+    estimate_cost,
+    needs_intermediate,
+)
+from common.quantize import export_quantize_results, quantize_depth_grid
+
+
+def test_needs_intermediate():
+    assert needs_intermediate(["contours_json"], "quantized")
+    assert needs_intermediate(["contours_json"], "smoothed_mask")
+    assert needs_intermediate(["layer_mask"], "layer_mask")
+    assert not needs_intermediate(["layer_mask"], "smoothed_mask")
+    assert not needs_intermediate(["histogram", "depth_map_raw"], "layer_mask")
+    assert not needs_intermediate([], "quantized")
+
+
+def test_estimate_cost():
+    # Per-layer outputs scale w/ the layers, others don't
+    assert estimate_cost(["contours_json"], 10) == 10 * ARTIFACTS["contours_json"].cost
+    assert estimate_cost(["histogram"], 10) == ARTIFACTS["histogram"].cost
+    assert estimate_cost(CAD_ARTIFACTS, 10) < estimate_cost(DEFAULT_ARTIFACTS, 10)
+    assert "contours_binary" not in DEFAULT_ARTIFACTS
+
+
+def test_manifest(tmp_path):
+    manifest = ArtifactManifest(tmp_path)
+    (tmp_path / "b.json").write_text("12345")
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "x.npy").write_bytes(b"123")
+    (tmp_path / "a" / "y.npy").write_bytes(b"1234")
+    manifest.timed_write("b", tmp_path / "b.json", lambda: None, render_seconds=1)()
+    manifest.record_artifact("a", tmp_path / "a", 0.5)
+    manifest.record_stage("smooth", 2, layer_idx=1, cached=True)
+    manifest.record_stage("quantize", 3)
+    # Records from elsewhere, ex: a worker process
+    other = ArtifactManifest(tmp_path)
+    other.record_stage("smooth", 4, layer_idx=0)
+    manifest.merge(other.artifacts, other.stages)
+
+    with open(manifest.write(), "r") as f:
+        written = json.load(f)
+    # Sorted by path, and by layer (w/ stages of no layer first)
+    assert [a["path"] for a in written["artifacts"]] == ["a", "b.json"]
+    assert [a["bytes"] for a in written["artifacts"]] == [7, 5]
+    assert written["artifacts"][1]["seconds"] >= 1
+    assert [(s["stage"], s["layer_idx"]) for s in written["stages"]] == [
+        ("quantize", None),
+        ("smooth", 0),
+        ("smooth", 1),
+    ]
+    assert written["stages"][2]["cached"]
+    assert written["total_bytes"] == 12
+    assert written["total_seconds"] == pytest.approx(
+        sum(a["seconds"] for a in written["artifacts"]) + 9
+    )
+
+
+def _quantize_results():
+    rows, cols = np.mgrid[:40, :50]
+    depth_grid = (np.hypot(rows - 20, cols - 25) * 0.5).astype(np.float32)
+    return quantize_depth_grid(depth_grid, levels=4)
+
+
+@pytest.mark.parametrize(
+    "artifacts",
+    [CAD_ARTIFACTS, ("quantized_depth_values",), ("layer_mask", "contours_binary")],
+)
+def test_export_only_selected_artifacts(tmp_path, artifacts):
+    export_quantize_results(
+        _quantize_results(), tmp_path, artifacts=artifacts, writer_threads=0
+    )
+    with open(tmp_path / "manifest.json", "r") as f:
+        manifest = json.load(f)
+    assert {a["artifact"] for a in manifest["artifacts"]} == set(artifacts)
+    # Only what the manifest lists is written
+    written = {p for p in tmp_path.rglob("*") if p.is_file()}
+    listed = {
+        p
+        for a in manifest["artifacts"]
+        for p in [tmp_path / a["path"], *(tmp_path / a["path"]).rglob("*")]
+        if p.is_file()
+    }
+    assert written == listed | {tmp_path / "manifest.json"}
+    # Intermediates which aren't needed aren't computed
+    stages = {s["stage"] for s in manifest["stages"]}
+    assert ("smooth" in stages) == needs_intermediate(artifacts, "smoothed_mask")
+
+
+def test_export_w_workers_matches_serial(tmp_path):
+    quantize_results = _quantize_results()
+    outputs = {}
+    for workers in (1, 2):
+        calls = []
+        export_quantize_results(
+            quantize_results,
+            tmp_path / str(workers),
+            artifacts=EXPORT_ARTIFACTS,
+            workers=workers,
+            progress=lambda n_done, n_layers: calls.append((n_done, n_layers)),
+        )
+        # Once up front, then once per layer
+        assert calls == [(n_done, 3) for n_done in range(4)]
+        outputs[workers] = {
+            p.relative_to(tmp_path / str(workers)): p.read_bytes()
+            for p in (tmp_path / str(workers)).rglob("*")
+            if p.is_file() and p.name != "manifest.json"
+        }
+    # Every artifact of every layer, files or directories of files
+    listed = {
+        Path(artifact.path.format(layer_idx=layer_idx))
+        for artifact in EXPORT_ARTIFACTS.values()
+        for layer_idx in range(3)
+    }
+    assert listed == {
+        next((p for p in listed if p == path or p in path.parents), None)
+        for path in outputs[1]
+    }
+    assert outputs[1].keys() == outputs[2].keys()
+    for path, content in outputs[1].items():
+        assert content == outputs[2][path], path
+
+
+def test_figures_are_rendered_on_the_calling_thread(tmp_path, monkeypatch):
+    # pyplot isn't thread-safe, writer threads only write what's already rendered
+    threads = []
+    savefig = Figure.savefig
+
+    def _savefig(self, *args, **kwargs):
+        threads.append(threading.current_thread())
+        return savefig(self, *args, **kwargs)
+
+    monkeypatch.setattr(Figure, "savefig", _savefig)
+    export_quantize_results(
+        _quantize_results(), tmp_path, artifacts=("contours_viz",), writer_threads=2
+    )
+    assert threads == [threading.main_thread()] * 3
+    assert len(list(tmp_path.glob("layer_masks/*_contours_viz.jpg"))) == 3
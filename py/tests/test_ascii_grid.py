@@ -0,0 +1,96 @@
+import io
+
+import numpy as np
+import pytest
+
+from common import ascii_grid
+from common.ascii_grid import read_ascii_grid, read_ascii_grid_header
+
+_GRID = np.array([[1, 2.5, -3], [4, -9999, 6]], dtype=np.float32)
+
+
+def _write_grid(path, grid=_GRID, header_extra=""):
+    rows = "\n".join(" ".join(f"{v:g}" for v in row) for row in grid)
+    path.write_text(
+        f"ncols {grid.shape[1]}\nnrows {grid.shape[0]}\n"
+        f"xllcenter 10\nyllcenter 20\ncellsize 2\nNODATA_value -9999\n"
+        f"{header_extra}{rows}\n"
+    )
+    return path
+
+
+def test_header(tmp_path):
+    header = read_ascii_grid_header(
+        _write_grid(tmp_path / "g.asc", header_extra="cellvalue 0.01\n")
+    )
+    assert (header.nrows, header.ncols) == (2, 3)
+    # Cell-center registration is normalized to corners
+    assert (header.xllcorner, header.yllcorner) == (9, 19)
+    assert header.nodata_value == -9999
+    assert header.extra == {"cellvalue": 0.01}
+
+
+def test_read_matches_source(tmp_path):
+    grid = read_ascii_grid(_write_grid(tmp_path / "g.asc"), use_cache=False)
+    np.testing.assert_array_equal(grid.data, _GRID)
+
+
+def test_read_across_chunks(tmp_path, monkeypatch):
+    # Numbers are never split across chunks of the body
+    monkeypatch.setattr(ascii_grid, "_CHUNK_CHARS", 3)
+    grid = np.arange(60, dtype=np.float32).reshape(6, 10) * 1.25
+    data = read_ascii_grid(_write_grid(tmp_path / "g.asc", grid), use_cache=False).data
+    np.testing.assert_array_equal(data, grid)
+
+
+def test_sidecar_is_reused_and_copy_on_write(tmp_path):
+    path = _write_grid(tmp_path / "g.asc")
+    data = read_ascii_grid(path).data
+    sidecars = list(tmp_path.glob(".g.asc.*.npy"))
+    assert len(sidecars) == 1
+    data[0, 0] = 42
+    # Edits by callers never touch the sidecar
+    np.testing.assert_array_equal(read_ascii_grid(path).data, _GRID)
+    assert list(tmp_path.glob(".g.asc.*.npy")) == sidecars
+
+
+def test_stale_sidecar_is_replaced(tmp_path):
+    path = _write_grid(tmp_path / "g.asc")
+    read_ascii_grid(path)
+    grid = _GRID + 1
+    _write_grid(path, grid)
+    np.testing.assert_array_equal(read_ascii_grid(path).data, grid)
+    assert len(list(tmp_path.glob(".g.asc.*.npy"))) == 1
+
+
+def test_file_like_input():
+    text = "ncols 2\nnrows 1\ncellsize 1\n1 2\n"
+    grid = read_ascii_grid(io.StringIO(text))
+    np.testing.assert_array_equal(grid.data, [[1, 2]])
+
+
+def test_file_like_input_can_be_read_again(tmp_path):
+    f = io.BytesIO(_write_grid(tmp_path / "g.asc").read_bytes())
+    f.name = "g.asc"
+    assert read_ascii_grid_header(f).nrows == 2
+    np.testing.assert_array_equal(read_ascii_grid(f).data, _GRID)
+    # Ex: stats of an upload, then its data
+    np.testing.assert_array_equal(read_ascii_grid(f).data, _GRID)
+    assert f.tell() == 0
+
+
+def test_value_count_mismatch(tmp_path):
+    path = tmp_path / "g.asc"
+    path.write_text("ncols 2\nnrows 2\ncellsize 1\n1 2 3\n")
+    with pytest.raises(ValueError):
+        read_ascii_grid(path, use_cache=False)
+    path.write_text("ncols 2\nnrows 1\ncellsize 1\n1 2 3\n")
+    with pytest.raises(ValueError):
+        read_ascii_grid(path, use_cache=False)
+
+
+def test_missing_header_keys(tmp_path):
+    path = tmp_path / "g.asc"
+    path.write_text("ncols 2\ncellsize 1\n1 2\n")
+    with pytest.raises(ValueError):
+        read_ascii_grid_header(path)
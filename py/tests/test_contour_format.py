@@ -0,0 +1,120 @@
+import json
+
+import numpy as np
+import pytest
+
+from common import contour_format
+from common.contour_format import (
+    ContourBuffers,
+    convert_contours,
+    read_contours,
+    write_contours,
+)
+
+_RNG = np.random.default_rng(0)
+
+
+def _ring(n, with_metadata, role):
+    ring = _RNG.uniform(-0.5, 1.5, size=(n, 2))
+    ring = np.concatenate((ring, ring[:1])).tolist()
+    shape = {"vertices": ring, "simplified": ring[::2] + [ring[0]]}
+    if with_metadata:
+        shape["metadata"] = {
+            "role": role,
+            "area": float(_RNG.uniform()),
+            "perimeter": float(_RNG.uniform()),
+            "bbox": _RNG.uniform(size=4).tolist(),
+            "centroid": _RNG.uniform(size=2).tolist(),
+            "vertex_count": int(n),
+        }
+    return shape
+
+
+def _layer_shapes(with_metadata=True):
+    # A shape w/o holes, one w/ two holes, and one w/ an empty holes list
+    return [
+        {**_ring(5, with_metadata, "outer"), "holes": []},
+        {
+            **_ring(12, with_metadata, "outer"),
+            "holes": [_ring(4, with_metadata, "hole"), _ring(7, with_metadata, "hole")],
+        },
+        {**_ring(3, with_metadata, "outer"), "holes": []},
+    ]
+
+
+def _assert_layer_shapes_close(actual, expected, atol):
+    assert len(actual) == len(expected)
+    for a_shape, e_shape in zip(actual, expected):
+        assert len(a_shape["holes"]) == len(e_shape["holes"])
+        for a, e in zip([a_shape, *a_shape["holes"]], [e_shape, *e_shape["holes"]]):
+            for key in ("vertices", "simplified"):
+                np.testing.assert_allclose(a[key], e[key], rtol=0, atol=atol)
+            if "metadata" in e:
+                assert a["metadata"] == e["metadata"]
+            else:
+                assert "metadata" not in a
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("encoding,atol", [("float32", 1e-7), ("int32", 2**-29)])
+def test_round_trip(tmp_path, encoding, atol, mmap):
+    layer_shapes = _layer_shapes()
+    buffers = ContourBuffers.from_layer_shapes(layer_shapes, encoding)
+    assert buffers.n_polygons == 3
+    assert buffers.polygon_offsets.tolist() == [0, 1, 4, 5]
+    assert buffers.vertices.dtype == np.dtype(encoding)
+    write_contours(tmp_path / "layer", buffers)
+    read = read_contours(tmp_path / "layer", mmap=mmap)
+    assert isinstance(read.vertices, np.memmap) == mmap
+    assert read.encoding == encoding
+    _assert_layer_shapes_close(read.to_layer_shapes(), layer_shapes, atol)
+    # Rings are closed, as in the JSON schema
+    np.testing.assert_array_equal(read.ring(1)[0], read.ring(1)[-1])
+
+
+def test_without_metadata(tmp_path):
+    layer_shapes = _layer_shapes(with_metadata=False)
+    write_contours(tmp_path / "layer", ContourBuffers.from_layer_shapes(layer_shapes))
+    assert not (tmp_path / "layer" / "ring_metadata.npy").exists()
+    read = read_contours(tmp_path / "layer")
+    assert read.ring_metadata is None
+    _assert_layer_shapes_close(read.to_layer_shapes(), layer_shapes, 1e-7)
+
+
+def test_empty_layer(tmp_path):
+    write_contours(tmp_path / "layer", ContourBuffers.from_layer_shapes([]))
+    read = read_contours(tmp_path / "layer")
+    assert read.n_polygons == 0
+    assert read.to_layer_shapes() == []
+
+
+def test_overwrite_leaves_no_temporary(tmp_path):
+    write_contours(
+        tmp_path / "layer", ContourBuffers.from_layer_shapes(_layer_shapes())
+    )
+    layer_shapes = _layer_shapes(with_metadata=False)[:1]
+    write_contours(tmp_path / "layer", ContourBuffers.from_layer_shapes(layer_shapes))
+    assert [p.name for p in tmp_path.iterdir()] == ["layer"]
+    # Stale buffers of the previous layer are gone
+    assert not (tmp_path / "layer" / "ring_metadata.npy").exists()
+    assert read_contours(tmp_path / "layer").n_polygons == 1
+
+
+def test_unsupported_version(tmp_path, monkeypatch):
+    write_contours(
+        tmp_path / "layer", ContourBuffers.from_layer_shapes(_layer_shapes())
+    )
+    monkeypatch.setattr(contour_format, "CONTOUR_FORMAT_VERSION", 2)
+    with pytest.raises(ValueError):
+        read_contours(tmp_path / "layer")
+
+
+def test_convert_contours(tmp_path):
+    layer_shapes = _layer_shapes()
+    with open(tmp_path / "layer.json", "w") as f:
+        json.dump(layer_shapes, f)
+    convert_contours(tmp_path / "layer.json", tmp_path / "layer", encoding="int32")
+    assert read_contours(tmp_path / "layer").encoding == "int32"
+    convert_contours(tmp_path / "layer", tmp_path / "back.json")
+    with open(tmp_path / "back.json", "r") as f:
+        _assert_layer_shapes_close(json.load(f), layer_shapes, 2**-29)
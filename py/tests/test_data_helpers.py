@@ -0,0 +1,221 @@
+import io
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from common import data_helpers
+from common.grid_stats import compute_array_stats
+from common.data_helpers import (
+    MaskedDepthGrid,
+    load_data,
+    load_grid_stats,
+    preprocess_depth_grid,
+    trim_to_data_extent,
+)
+from common.valid_mask import ValidMask
+
+_RNG = np.random.default_rng(0)
+
+
+def _grid():
+    grid = _RNG.gamma(2, 40, (300, 200)).astype(np.float32)
+    # Outliers, for z-score clipping
+    grid[::37, ::23] *= 20
+    return grid
+
+
+def _reference(grid, depth_unit_m, depth_min_m, depth_max_m, max_z_score):
+    # The unfused computation
+    grid = np.clip(
+        grid.astype(np.float64) * depth_unit_m, depth_min_m, depth_max_m or None
+    )
+    grid -= grid.min()
+    if max_z_score > 0:
+        grid = np.clip(grid, 0, grid.mean() + max_z_score * grid.std(ddof=1))
+    return grid
+
+
+@pytest.mark.parametrize(
+    "depth_unit_m,depth_min_m,depth_max_m,max_z_score",
+    [(1, 0, None, 0), (0.01, 0.2, None, 3), (1, 5, 150, 2)],
+)
+def test_preprocess_matches_reference(
+    depth_unit_m, depth_min_m, depth_max_m, max_z_score
+):
+    grid = _grid()
+    expected = _reference(grid, depth_unit_m, depth_min_m, depth_max_m, max_z_score)
+    result = preprocess_depth_grid(
+        grid.copy(),
+        depth_unit_m=depth_unit_m,
+        depth_min_m=depth_min_m,
+        depth_max_m=depth_max_m,
+        max_z_score=max_z_score,
+    )
+    assert result.depth_grid.dtype == np.float32
+    np.testing.assert_allclose(result.depth_grid, expected, rtol=1e-5, atol=1e-4)
+
+
+def test_preprocess_is_in_place():
+    # Temporaries are bounded by row blocks, not the grid
+    grid = np.tile(_grid(), (15, 1))
+    result = preprocess_depth_grid(grid, depth_unit_m=2)
+    assert result.depth_grid is grid
+    assert result.peak_memory_bytes < grid.nbytes
+
+
+def test_preprocess_ignores_invalid_cells():
+    grid = _grid()
+    valid = np.ones(grid.shape, dtype=bool)
+    valid[:50] = False
+    grid[:50] = -1e6
+    result = preprocess_depth_grid(
+        grid.copy(), max_z_score=2, valid_mask=ValidMask.from_bool(valid)
+    )
+    expected = _reference(grid[50:], 1, 0, None, 2)
+    np.testing.assert_allclose(result.depth_grid[50:], expected, rtol=1e-5, atol=1e-4)
+    # Cells w/o data are ground
+    assert not result.depth_grid[:50].any()
+
+
+def test_load_data_window_matches_full_read(tmp_path):
+    grid = _grid()
+    path = tmp_path / "g.asc"
+    rows = "\n".join(" ".join(f"{v:.2f}" for v in row) for row in grid)
+    path.write_text(f"ncols 200\nnrows 300\ncellsize 1\n{rows}\n")
+    full = load_data(path)
+    window = load_data(path, window=(10, 20, 100, 50), step=3)
+    # Offset by the min of the whole grid (from its stats sidecar)
+    np.testing.assert_array_equal(window.depth_grid, full.depth_grid[10:110:3, 20:70:3])
+    assert full.stats is not None and window.stats is None
+
+
+def test_load_data_after_stats_of_an_upload(tmp_path):
+    grid = _grid()
+    rows = "\n".join(" ".join(f"{v:.2f}" for v in row) for row in grid)
+    f = io.BytesIO(f"ncols 200\nnrows 300\ncellsize 1\n{rows}\n".encode())
+    f.name = "g.asc"
+    # The same upload, read twice
+    stats = load_grid_stats(f)
+    loaded = load_data(f, stats=stats, window=(10, 20, 100, 50))
+    assert loaded.depth_grid.shape == (100, 50)
+
+
+@pytest.mark.parametrize("fname", ["g.tif", "g.geo.tif"])
+def test_tiff_stats_are_streamed(tmp_path, monkeypatch, fname):
+    grid = -_grid()[:100] if fname.endswith(".geo.tif") else _grid()[:100]
+    path = tmp_path / fname
+    Image.fromarray(grid).save(path, tiffinfo={278: 8})
+    raw = data_helpers.load_raw(path)
+    expected = compute_array_stats(raw.depth_grid, raw.valid_mask)
+
+    monkeypatch.setattr(data_helpers, "_STATS_BLOCK_ROWS", 16)
+    windows = []
+    read_tiff_window = data_helpers.read_tiff_window
+
+    def _read_tiff_window(fpath, window=None, step=1):
+        windows.append(window)
+        return read_tiff_window(fpath, window=window, step=step)
+
+    monkeypatch.setattr(data_helpers, "read_tiff_window", _read_tiff_window)
+    stats = data_helpers._compute_raw_stats(path, workers=2)
+    # Never read in full
+    assert windows and all(window[2] == 16 for window in windows)
+    assert stats.count == expected.count
+    assert stats.min == pytest.approx(expected.min)
+    assert stats.max == pytest.approx(expected.max)
+    assert stats.mean == pytest.approx(expected.mean)
+    np.testing.assert_array_equal(stats.hist_counts, expected.hist_counts)
+
+
+def _z_score_clip(capsys):
+    # The max depth z-score clipping reported by the last load
+    return float(capsys.readouterr().out.split("max depth of ")[-1].rstrip("m\n"))
+
+
+def test_load_data_window_clips_by_the_full_grid(tmp_path, capsys):
+    grid = _grid()[:200]
+    path = tmp_path / "g.asc"
+    rows = "\n".join(" ".join(f"{v:.2f}" for v in row) for row in grid)
+    path.write_text(f"ncols 200\nnrows 200\ncellsize 1\n{rows}\n")
+    window = (100, 0, 100, 200)
+    full = load_data(path, max_z_score=1)
+    full_clip = _z_score_clip(capsys)
+    np.testing.assert_array_equal(
+        load_data(path, window=window, max_z_score=1).depth_grid, full.depth_grid[100:]
+    )
+    assert _z_score_clip(capsys) == full_clip
+    # A min clip within a bin of the histogram clips by (approximate) moments of the full
+    # grid all the same, not by those of the window
+    depth_min_m = float(np.round(grid, 2).min()) + 1e-4
+    load_data(path, depth_min_m=depth_min_m, max_z_score=1, window=window)
+    assert _z_score_clip(capsys) == pytest.approx(full_clip, abs=0.1)
+
+
+def test_trim_to_data_extent():
+    grid = np.zeros((100, 80), dtype=np.float32)
+    grid[40:50, 30:35] = 1
+    trimmed = trim_to_data_extent(MaskedDepthGrid(depth_grid=grid), margin=5)
+    assert trimmed.origin == (35, 25)
+    assert trimmed.canvas_shape == (100, 80)
+    np.testing.assert_array_equal(trimmed.depth_grid, grid[35:55, 25:40])
+
+
+def test_preprocess_from_stats_is_exact():
+    grid = _grid()
+    stats = compute_array_stats(grid)
+    # No bin straddles the clip, the statistics are derived w/o a pass
+    result = preprocess_depth_grid(grid.copy(), max_z_score=2, stats=stats)
+    expected = preprocess_depth_grid(grid.copy(), max_z_score=2)
+    np.testing.assert_allclose(result.depth_grid, expected.depth_grid, rtol=1e-6)
+    assert result.std_m == pytest.approx(expected.std_m)
+
+
+def test_preprocess_from_stats_straddling_clip():
+    grid = _grid()
+    stats = compute_array_stats(grid)
+    # Within a bin of the histogram
+    depth_min_m = float(stats.hist_edges[3] + stats.hist_edges[4]) / 2
+    assert not stats.clip_affine_is_exact(lo=depth_min_m)
+    kwargs = dict(depth_min_m=depth_min_m, max_z_score=2)
+    result = preprocess_depth_grid(grid.copy(), stats=stats, **kwargs)
+    expected = preprocess_depth_grid(grid.copy(), **kwargs)
+    np.testing.assert_array_equal(result.depth_grid, expected.depth_grid)
+    assert result.depth_clip_max_m == expected.depth_clip_max_m
+    # Not derivable exactly either
+    assert result.stats is None
+
+    # Opted in, within the documented bound
+    approx = preprocess_depth_grid(
+        grid.copy(), stats=stats, approximate_stats=True, **kwargs
+    )
+    straddling = stats.hist_counts[3] / stats.count
+    bin_width = stats.hist_edges[1] - stats.hist_edges[0]
+    assert abs(approx.mean_m - expected.mean_m) <= straddling * bin_width
+    assert approx.stats is not None
+
+
+def test_peak_memory_is_reported(tmp_path):
+    grid = _grid()
+    path = tmp_path / "g.asc"
+    rows = "\n".join(" ".join(f"{v:.2f}" for v in row) for row in grid)
+    path.write_text(f"ncols 200\nnrows 300\ncellsize 1\n{rows}\n")
+    assert load_data(path, max_z_score=2).peak_memory_bytes > 0
+    assert not tracemalloc.is_tracing()
+
+
+def test_callers_tracing_is_left_alone():
+    tracemalloc.start()
+    try:
+        # An earlier peak of the caller's, above any of the preprocessing
+        peak = np.ones(10**6)
+        del peak
+        _, peak_before = tracemalloc.get_traced_memory()
+        result = preprocess_depth_grid(_grid(), max_z_score=2)
+        assert tracemalloc.is_tracing()
+        assert tracemalloc.get_traced_memory()[1] == peak_before
+        # Not measurable w/o resetting the caller's peak
+        assert result.peak_memory_bytes is None
+    finally:
+        tracemalloc.stop()
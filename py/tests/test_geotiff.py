@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from common import geotiff
+from common.data_helpers import load_raw
+from common.geotiff import read_tiff_nodata, read_tiff_shape, read_tiff_window
+
+_RNG = np.random.default_rng(0)
+_GRID = np.round(_RNG.normal(100, 30, (70, 45)), 2).astype(np.float32)
+
+
+def _write_tiff(path, grid=_GRID, compression=None, rows_per_strip=16, tags=None):
+    tiffinfo = {278: rows_per_strip, **(tags or {})}
+    Image.fromarray(grid).save(path, compression=compression, tiffinfo=tiffinfo)
+    return path
+
+
+@pytest.mark.parametrize("compression", [None, "tiff_lzw", "tiff_adobe_deflate"])
+@pytest.mark.parametrize("predictor", [1, 2, 3])
+def test_full_read_matches_pillow(tmp_path, compression, predictor):
+    path = _write_tiff(
+        tmp_path / "g.tif", compression=compression, tags={317: predictor}
+    )
+    np.testing.assert_array_equal(read_tiff_window(path), _GRID)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint16, np.int32])
+def test_integer_samples(tmp_path, dtype):
+    grid = _RNG.integers(-300, 300, (33, 20)).astype(dtype)
+    if dtype == np.uint16:
+        grid = np.abs(grid).astype(dtype)
+    path = _write_tiff(tmp_path / "g.tif", grid, compression="tiff_lzw", tags={317: 2})
+    np.testing.assert_array_equal(read_tiff_window(path), grid.astype(np.float32))
+
+
+@pytest.mark.parametrize("window", [(0, 0, 70, 45), (5, 7, 30, 11), (60, 40, 50, 50)])
+@pytest.mark.parametrize("step", [1, 3, 16])
+def test_window_matches_full_read(tmp_path, window, step):
+    path = _write_tiff(tmp_path / "g.tif", compression="tiff_lzw")
+    row, col, height, width = window
+    np.testing.assert_array_equal(
+        read_tiff_window(path, window=window, step=step),
+        _GRID[row : row + height : step, col : col + width : step],
+    )
+
+
+def test_tiled(tmp_path):
+    tifffile = pytest.importorskip("tifffile")
+    path = tmp_path / "g.tif"
+    tifffile.imwrite(path, _GRID, tile=(16, 16), compression="zlib", predictor=True)
+    np.testing.assert_array_equal(read_tiff_window(path), _GRID)
+    np.testing.assert_array_equal(
+        read_tiff_window(path, window=(10, 20, 40, 20), step=2),
+        _GRID[10:50:2, 20:40:2],
+    )
+
+
+def test_only_sampled_blocks_are_decoded(tmp_path, monkeypatch):
+    path = _write_tiff(tmp_path / "g.tif", compression="tiff_lzw", rows_per_strip=2)
+    decoded = []
+    decode_block = geotiff._decode_block
+
+    def _decode_block(f, layout, block_idx, rows):
+        decoded.append(block_idx)
+        return decode_block(f, layout, block_idx, rows)
+
+    monkeypatch.setattr(geotiff, "_decode_block", _decode_block)
+    # Rows 10, 14, .. 38: strips 5, 7, .. 19
+    read_tiff_window(path, window=(10, 0, 30, 45), step=4)
+    assert decoded == list(range(5, 20, 2))
+
+
+def test_lzw_without_imagecodecs(tmp_path, monkeypatch):
+    # Falls back to decoding the full raster
+    monkeypatch.setattr(geotiff, "imagecodecs", None)
+    path = _write_tiff(tmp_path / "g.tif", compression="tiff_lzw")
+    np.testing.assert_array_equal(
+        read_tiff_window(path, window=(3, 4, 20, 20), step=2), _GRID[3:23:2, 4:24:2]
+    )
+
+
+def test_shape_and_nodata(tmp_path):
+    path = _write_tiff(tmp_path / "g.tif", tags={42113: "-9999"})
+    assert read_tiff_shape(path) == (70, 45)
+    assert read_tiff_nodata(path) == -9999
+    assert read_tiff_nodata(_write_tiff(tmp_path / "h.tif")) is None
+
+
+@pytest.mark.parametrize("name", ["g.tif", "g.geo.tif"])
+def test_load_raw_window_matches_full_read(tmp_path, name):
+    grid = _GRID.copy()
+    # Ground (0) and cells w/o data
+    grid[:10, :10] = 0
+    grid[-5:, -5:] = -9999
+    # The max of the raster lies outside of the window
+    grid[60, 40] = 1000
+    path = _write_tiff(
+        tmp_path / name, grid, compression="tiff_lzw", tags={42113: "-9999"}
+    )
+    full = load_raw(path)
+    window = load_raw(path, window=(5, 5, 30, 30), step=2)
+    np.testing.assert_array_equal(window.depth_grid, full.depth_grid[5:35:2, 5:35:2])
+    np.testing.assert_array_equal(
+        window.valid_mask.unpack() if window.valid_mask else True,
+        full.valid_mask.unpack()[5:35:2, 5:35:2],
+    )
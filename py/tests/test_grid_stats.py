@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from common.grid_stats import (
+    GridStats,
+    Moments,
+    compute_array_stats,
+    load_or_compute_grid_stats,
+)
+from common.valid_mask import ValidMask
+
+_RNG = np.random.default_rng(0)
+
+
+def test_moments_merge_matches_numpy():
+    values = _RNG.normal(50, 10, 1000)
+    merged = Moments()
+    for block in np.array_split(values, 7):
+        merged = merged.merge(Moments.of(block))
+    assert merged.count == values.size
+    assert (merged.min, merged.max) == (values.min(), values.max())
+    assert merged.mean == pytest.approx(values.mean())
+    assert merged.std == pytest.approx(values.std(ddof=1))
+
+
+@pytest.mark.parametrize("block_rows,workers", [(1024, 1), (7, 1), (7, 3)])
+def test_array_stats(block_rows, workers):
+    grid = _RNG.gamma(2, 10, (50, 40)).astype(np.float32)
+    valid = _RNG.random(grid.shape) > 0.2
+    stats = compute_array_stats(
+        grid, ValidMask.from_bool(valid), block_rows=block_rows, workers=workers
+    )
+    values = grid[valid].astype(np.float64)
+    assert stats.count == values.size
+    assert (stats.min, stats.max) == (values.min(), values.max())
+    assert stats.mean == pytest.approx(values.mean())
+    assert stats.std == pytest.approx(values.std(ddof=1))
+    assert stats.hist_counts.sum() == values.size
+    assert stats.hist_sums.sum() == pytest.approx(values.sum())
+    # Exact at the histogram's edges
+    assert stats.quantiles(np.array([0, 1])) == pytest.approx(
+        [values.min(), values.max()]
+    )
+    assert stats.percentiles[50] == pytest.approx(np.median(values), rel=0.05)
+
+
+def test_stats_do_not_depend_on_blocks():
+    grid = _RNG.normal(size=(64, 10))
+    a, b = compute_array_stats(grid, block_rows=5), compute_array_stats(grid)
+    np.testing.assert_array_equal(a.hist_counts, b.hist_counts)
+    assert a.mean == pytest.approx(b.mean)
+
+
+def test_clip_affine():
+    values = _RNG.normal(50, 10, (100, 100))
+    stats = compute_array_stats(values)
+    # Scale + offset only, exact
+    derived = stats.clip_affine(scale=2, offset=-3)
+    assert stats.clip_affine_is_exact(scale=2, offset=-3)
+    assert derived.mean == pytest.approx((2 * values - 3).mean())
+    assert derived.std == pytest.approx((2 * values - 3).std(ddof=1))
+    # Clipped at a bin edge, exact
+    hi = float(stats.hist_edges[700])
+    assert stats.clip_affine_is_exact(hi=hi)
+    assert stats.clip_affine(hi=hi).mean == pytest.approx(np.minimum(values, hi).mean())
+    # Clipped within a bin, approximate
+    assert not stats.clip_affine_is_exact(hi=hi + 1e-3)
+
+
+def test_json_round_trip():
+    stats = compute_array_stats(_RNG.normal(size=(20, 20)))
+    restored = GridStats.from_json(stats.to_json())
+    assert restored.percentiles == stats.percentiles
+    np.testing.assert_array_equal(restored.hist_sums, stats.hist_sums)
+
+
+def test_sidecar(tmp_path):
+    fpath = tmp_path / "g.asc"
+    fpath.write_text("data")
+    calls = []
+
+    def _compute():
+        calls.append(1)
+        return compute_array_stats(np.arange(10.0).reshape(2, 5))
+
+    first = load_or_compute_grid_stats(fpath, _compute)
+    second = load_or_compute_grid_stats(fpath, _compute)
+    assert len(calls) == 1
+    assert first.to_json() == second.to_json()
+    # Stale once the file changes
+    fpath.write_text("other data")
+    load_or_compute_grid_stats(fpath, _compute)
+    assert len(calls) == 2
+    assert len(list(tmp_path.glob(".g.asc.*.stats.json"))) == 1
@@ -0,0 +1,148 @@
+import os
+import threading
+
+import pytest
+
+from common.io import ArtifactWriter, load_or_compute_json_sidecar
+
+
+def _append_to(written, value, event=None):
+    def _write():
+        if event is not None:
+            event.wait()
+        written.append(value)
+
+    return _write
+
+
+@pytest.mark.parametrize("threads", [0, 1, 3])
+def test_every_write_runs(threads):
+    written = []
+    with ArtifactWriter(threads=threads, max_pending=2) as writer:
+        for i in range(20):
+            writer.submit(_append_to(written, i))
+    assert sorted(written) == list(range(20))
+
+
+def test_synchronous_without_threads():
+    written = []
+    writer = ArtifactWriter(threads=0)
+    writer.submit(_append_to(written, 1))
+    # Written before submit returns
+    assert written == [1]
+    writer.close()
+
+
+def test_flush_waits_for_pending_writes():
+    written = []
+    event = threading.Event()
+    writer = ArtifactWriter(threads=2)
+    writer.submit(_append_to(written, 1, event))
+    writer.submit(_append_to(written, 2, event))
+    assert written == []
+    event.set()
+    writer.flush()
+    assert sorted(written) == [1, 2]
+    writer.close()
+
+
+def test_submit_blocks_once_the_queue_is_full():
+    event = threading.Event()
+    writer = ArtifactWriter(threads=1, max_pending=1)
+    # One write in progress, one queued
+    writer.submit(_append_to([], 0, event))
+    writer.submit(_append_to([], 1, event))
+    submitted = threading.Event()
+    blocked = threading.Thread(
+        target=lambda: (writer.submit(_append_to([], 2)), submitted.set())
+    )
+    blocked.start()
+    assert not submitted.wait(0.2)
+    event.set()
+    assert submitted.wait(5)
+    blocked.join()
+    writer.close()
+
+
+def _fail():
+    raise OSError("disk full")
+
+
+@pytest.mark.parametrize("threads", [0, 2])
+def test_errors_are_raised(threads):
+    written = []
+    writer = ArtifactWriter(threads=threads)
+    if threads:
+        writer.submit(_fail)
+        with pytest.raises(OSError):
+            writer.flush()
+    else:
+        with pytest.raises(OSError):
+            writer.submit(_fail)
+    # Raised once, the writer is usable after
+    writer.submit(_append_to(written, 1))
+    writer.close()
+    assert written == [1]
+
+
+def test_error_raised_by_the_next_submit():
+    writer = ArtifactWriter(threads=1)
+    writer.submit(_fail)
+    writer._queue.join()
+    with pytest.raises(OSError):
+        writer.submit(_append_to([], 1))
+    writer.close()
+
+
+def test_context_does_not_mask_errors():
+    writer = ArtifactWriter(threads=1)
+    with pytest.raises(KeyError):
+        with writer:
+            writer.submit(_fail)
+            raise KeyError()
+    # The writers are joined all the same
+    assert writer._threads == []
+
+
+def test_json_sidecar(tmp_path):
+    fpath = tmp_path / "grid.asc"
+    fpath.write_text("data")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"value": len(calls)}
+
+    assert load_or_compute_json_sidecar(fpath, ".test.json", compute) == {"value": 1}
+    assert load_or_compute_json_sidecar(fpath, ".test.json", compute) == {"value": 1}
+    assert len(calls) == 1
+    (sidecar,) = tmp_path.glob(".grid.asc.*.test.json")
+
+    # Modifying the source invalidates the sidecar, and the stale one is removed
+    fpath.write_text("modified data")
+    assert load_or_compute_json_sidecar(fpath, ".test.json", compute) == {"value": 2}
+    assert not sidecar.exists()
+    assert len(list(tmp_path.glob(".grid.asc.*.test.json"))) == 1
+
+
+def test_json_sidecar_cache_dir(tmp_path):
+    fpath = tmp_path / "grid.asc"
+    fpath.write_text("data")
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    load_or_compute_json_sidecar(fpath, ".test.json", lambda: [1], cache_dir=cache_dir)
+    assert len(list(cache_dir.glob(".grid.asc.*.test.json"))) == 1
+    assert not list(tmp_path.glob(".grid.asc.*"))
+
+
+def test_json_sidecar_read_only(tmp_path, monkeypatch):
+    fpath = tmp_path / "grid.asc"
+    fpath.write_text("data")
+
+    def _replace(src, dst):
+        raise PermissionError(dst)
+
+    # The value is returned (uncached), w/o leaving a temporary file behind
+    monkeypatch.setattr(os, "replace", _replace)
+    assert load_or_compute_json_sidecar(fpath, ".test.json", lambda: [1]) == [1]
+    assert not list(tmp_path.glob(".grid.asc.*"))
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from shapely import geometry
+
+from common.marching_squares import trace_iso_rings
+
+_RNG = np.random.default_rng(0)
+
+
+def _rings(iso_rings):
+    return np.split(iso_rings.points, iso_rings.ring_offsets[1:-1])
+
+
+def test_single_point():
+    values = np.zeros((3, 3))
+    values[1, 1] = 1
+    iso_rings = trace_iso_rings(values, 0.5)
+    (ring,) = _rings(iso_rings)
+    # A diamond through the edge midpoints around the point
+    assert sorted(map(tuple, ring)) == [(0.5, 1), (1, 0.5), (1, 1.5), (1.5, 1)]
+    assert iso_rings.is_hole.tolist() == [False]
+
+
+def test_interpolated_crossings():
+    values = np.array([[0, 0, 0], [0, 4, 0], [0, 0, 0]], dtype=np.float32)
+    (ring,) = _rings(trace_iso_rings(values, 1))
+    # Three quarters of the way from the point to each neighbour
+    assert sorted(map(tuple, ring)) == [(0.25, 1), (1, 0.25), (1, 1.75), (1.75, 1)]
+
+
+def test_invalid_and_border_crossings_are_halfway():
+    # The invalid point would be inside by value
+    values = np.array([[1, 2, 3], [1, 2, 100]], dtype=np.float64)
+    valid = np.array([[True, True, True], [True, True, False]])
+    (ring,) = _rings(trace_iso_rings(values, 0.5, valid))
+    # Halfway to the invalid point and to the border, rather than interpolated
+    assert {(1.5, 1), (2, 0.5), (2.5, 0), (1, 1.5), (-0.5, 0)} <= set(map(tuple, ring))
+    assert ring.min(axis=0).tolist() == [-0.5, -0.5]
+    assert ring.max(axis=0).tolist() == [2.5, 1.5]
+
+
+def test_holes_and_regions():
+    # An annulus, a separate point and a diagonal pair (one 8-connected region)
+    values = np.zeros((12, 12))
+    values[1:8, 1:8] = 1
+    values[3:6, 3:6] = 0
+    values[10, 1] = 1
+    values[9, 9] = values[10, 10] = 1
+    iso_rings = trace_iso_rings(values, 0.5)
+    rings = _rings(iso_rings)
+    assert len(rings) == 4
+    assert iso_rings.is_hole.sum() == 1
+    hole = int(np.flatnonzero(iso_rings.is_hole)[0])
+    outers = np.flatnonzero(~iso_rings.is_hole)
+    # The hole shares the region of the ring around it, and lies within it
+    (annulus,) = [i for i in outers if iso_rings.region[i] == iso_rings.region[hole]]
+    assert geometry.Polygon(rings[annulus]).contains(geometry.Polygon(rings[hole]))
+    assert len(set(iso_rings.region[outers].tolist())) == 3
+    for ring in rings:
+        assert geometry.LinearRing(ring).is_simple
+
+
+def test_rings_enclose_the_region():
+    # Every point above the threshold is within an outer ring and outside of the holes
+    values = _RNG.normal(size=(40, 50))
+    iso_rings = trace_iso_rings(values, 0.3)
+    rings = _rings(iso_rings)
+    inside = np.zeros(values.shape, dtype=bool)
+    rows, cols = np.mgrid[: values.shape[0], : values.shape[1]]
+    points = geometry.MultiPoint(np.stack((cols.ravel(), rows.ravel()), axis=1))
+    for ring, is_hole in zip(rings, iso_rings.is_hole):
+        polygon = geometry.Polygon(ring)
+        within = np.array([polygon.contains(p) for p in points.geoms]).reshape(
+            values.shape
+        )
+        inside ^= within
+    np.testing.assert_array_equal(inside, values > 0.3)
+
+
+def test_empty():
+    iso_rings = trace_iso_rings(np.zeros((5, 5)), 0.5)
+    assert len(iso_rings.points) == 0
+    assert iso_rings.ring_offsets.tolist() == [0]
@@ -0,0 +1,246 @@
+import numpy as np
+import pytest
+
+from common import quantize
+from common.quantize import (
+    assign_levels,
+    get_contours,
+    get_iso_contours,
+    quantize_depth_grid,
+    simplify_contours,
+    trace_contours,
+)
+from common.valid_mask import ValidMask
+
+_RNG = np.random.default_rng(0)
+
+
+def _nearest_level(depth_grid, levels_norm):
+    # The original quantizer: an argmin over the distance to each level (ties to the
+    # lower level), in the grid's precision
+    depth_norm = depth_grid / depth_grid.max()
+    return np.abs(depth_norm[..., None] - levels_norm).argmin(axis=-1)
+
+
+@pytest.mark.parametrize("max_depth_m", [10.0, 37.23, 50.0, 123.45])
+@pytest.mark.parametrize("levels", [2, 4, 9])
+def test_levels_match_nearest_level(max_depth_m, levels):
+    # cm resolution, ie: many cells exactly on (or around) levels and their midpoints
+    depth_grid = np.round(
+        np.arange(0, int(max_depth_m * 100) + 1, dtype=np.float32) * 0.01, 2
+    ).astype(np.float32)[None, :]
+    result = quantize_depth_grid(depth_grid, levels=levels, quantize_depth_start_m=1)
+    np.testing.assert_array_equal(
+        result.level_grid,
+        _nearest_level(depth_grid, result.quantized_depth_values_norm),
+    )
+
+
+def test_ties_on_levels_and_midpoints():
+    levels_norm = np.array([0, 0.25, 0.5, 1], dtype=np.float32)
+    depth_grid = np.array([[0, 0.125, 0.25, 0.375, 0.5, 0.75, 1]], dtype=np.float32)
+    # Cells on a level take it, cells on a midpoint take the lower level
+    np.testing.assert_array_equal(
+        assign_levels(depth_grid, levels_norm, max_depth_m=1),
+        [[0, 0, 1, 1, 2, 2, 3]],
+    )
+
+
+def test_duplicate_levels_take_the_first():
+    levels_norm = np.array([0, 0.5, 0.5, 1], dtype=np.float32)
+    depth_grid = np.array([[0.4, 0.5, 0.6]], dtype=np.float32)
+    np.testing.assert_array_equal(
+        assign_levels(depth_grid, levels_norm, max_depth_m=1), [[1, 1, 1]]
+    )
+
+
+def test_invalid_blocks_are_ground(monkeypatch):
+    monkeypatch.setattr(quantize, "_QUANTIZE_BLOCK_ROWS", 5)
+    depth_grid = _RNG.uniform(0, 10, (20, 8)).astype(np.float32)
+    valid = np.ones(depth_grid.shape, dtype=bool)
+    valid[:5] = False
+    result = quantize_depth_grid(
+        depth_grid, levels=4, valid_mask=ValidMask.from_bool(valid)
+    )
+    assert not result.level_grid[:5].any()
+    np.testing.assert_array_equal(
+        result.depth_grid_quant, result.quantized_depth_values[result.level_grid]
+    )
+
+
+@pytest.mark.parametrize("levels", [4, 6, 9])
+def test_quantile_levels_are_equal_area(levels):
+    depth_grid = _RNG.gamma(2, 10, (400, 400)).astype(np.float32)
+    result = quantize_depth_grid(
+        depth_grid, levels=levels, quantize_depth_start_m=1, level_strategy="quantiles"
+    )
+    # Cells of each (non-ground) level
+    counts = np.bincount(result.level_grid.reshape(-1), minlength=levels)[1:]
+    assert counts.min() > 0.75 * counts.mean()
+    assert counts.max() < 1.25 * counts.mean()
+
+
+@pytest.mark.parametrize("level_strategy", ["linspace", "quantiles", "jenks", "kmeans"])
+def test_level_strategies(level_strategy):
+    depth_grid = _RNG.gamma(2, 10, (100, 100)).astype(np.float32)
+    result = quantize_depth_grid(
+        depth_grid, levels=6, quantize_depth_start_m=1, level_strategy=level_strategy
+    )
+    levels_norm = result.quantized_depth_values_norm
+    assert len(levels_norm) == 6 and levels_norm[0] == 0
+    assert (np.diff(levels_norm) >= 0).all() and levels_norm[-1] <= 1
+    # Every level is populated
+    assert len(np.unique(result.level_grid)) == 6
+
+
+def _nested_islands():
+    # An island w/ a lake, holding an island w/ a lake of its own, and a separate island
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[2:30, 2:30] = True
+    mask[6:26, 6:26] = False
+    mask[10:22, 10:22] = True
+    mask[14:18, 14:18] = False
+    mask[33:37, 5:12] = True
+    return mask
+
+
+def _ring_winding(layer_shapes):
+    # (role, sign of the area, sign of the area from the vertices) of each ring
+    rings = [r for shape in layer_shapes for r in [shape, *shape["holes"]]]
+    windings = []
+    for ring in rings:
+        x, y = np.array(ring["simplified"]).T
+        windings.append(
+            (
+                ring["metadata"]["role"],
+                bool(ring["metadata"]["area"] > 0),
+                bool(np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) > 0),
+            )
+        )
+    return sorted(windings)
+
+
+def test_raster_and_iso_rings_wind_alike():
+    mask = _nested_islands()
+    raster = get_contours(mask).layer_shapes
+    iso = get_iso_contours(mask.astype(np.float32), 0.5).layer_shapes
+    assert _ring_winding(raster) == _ring_winding(iso)
+    # Outer rings wind one way, holes the other
+    assert (
+        _ring_winding(raster)
+        == [("hole", True, True)] * 2 + [("outer", False, False)] * 3
+    )
+
+
+def _ring_bounds(traced, ring_idx):
+    # (row0, row1, col0, col1) of a ring, in cells
+    ring = traced.rings[ring_idx] * max(traced.layer_mask_bw.shape)
+    return (
+        round(ring[:, 1].min()),
+        round(ring[:, 1].max()) + 1,
+        round(ring[:, 0].min()),
+        round(ring[:, 0].max()) + 1,
+    )
+
+
+def test_nested_islands_are_polygons():
+    traced = trace_contours(_nested_islands())
+    shapes = [
+        (
+            _ring_bounds(traced, contour_idx),
+            [_ring_bounds(traced, h_idx) for h_idx in hole_indices],
+        )
+        for contour_idx, hole_indices in traced.shape_indices
+    ]
+    # Polygons at even depths w/ their holes, each followed by those nested within it.
+    # Holes are traced along the cells around them.
+    outer = shapes.index(((2, 30, 2, 30), [(5, 27, 5, 27)]))
+    assert shapes[outer + 1] == ((10, 22, 10, 22), [(13, 19, 13, 19)])
+    assert sorted(shapes) == [
+        ((2, 30, 2, 30), [(5, 27, 5, 27)]),
+        ((10, 22, 10, 22), [(13, 19, 13, 19)]),
+        ((33, 37, 5, 12), []),
+    ]
+
+
+def test_empty_mask_has_no_contours():
+    traced = trace_contours(np.zeros((20, 30), dtype=bool))
+    assert traced.rings == []
+    assert traced.shape_indices == []
+    assert get_contours(np.zeros((20, 30), dtype=bool)).layer_shapes == []
+
+
+def test_many_siblings_match_a_rescan():
+    # Lakes of many islands, w/ islands in some lakes
+    mask = np.zeros((200, 200), dtype=bool)
+    mask[::10, :] = mask[:, ::10] = False
+    for r in range(0, 200, 20):
+        for c in range(0, 200, 20):
+            mask[r + 1 : r + 19, c + 1 : c + 19] = True
+            mask[r + 4 : r + 16, c + 4 : c + 16] = False
+            mask[r + 7 : r + 13, c + 7 : c + 13] = (r + c) % 40 == 0
+    mask[_RNG.uniform(size=mask.shape) < 0.02] ^= True
+    traced = trace_contours(mask)
+    parents = traced.hierarchy[0][:, 3]
+    n_vertices = [len(c) for c in traced.contours]
+
+    def depth(contour_idx):
+        return 0 if parents[contour_idx] < 0 else 1 + depth(parents[contour_idx])
+
+    # The original scan over all contours, for the children of each
+    expected = {
+        contour_idx: [
+            h_idx
+            for h_idx in range(len(parents))
+            if parents[h_idx] == contour_idx and n_vertices[h_idx] > 2
+        ]
+        for contour_idx in range(len(parents))
+        if depth(contour_idx) % 2 == 0 and n_vertices[contour_idx] > 2
+    }
+    assert len(expected) > 100
+    assert dict(traced.shape_indices) == expected
+    assert len(traced.shape_indices) == len(expected)
+
+
+def test_ring_metadata_of_a_rectangle():
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[10:30, 4:12] = True
+    (shape,) = get_contours(mask).layer_shapes
+    assert shape["holes"] == []
+    # Traced through the centers of the edge cells, normalized by the canvas size
+    metadata = shape["metadata"]
+    assert metadata["role"] == "outer"
+    assert metadata["vertex_count"] == 4
+    assert metadata["bbox"] == pytest.approx(np.array([4, 10, 11, 29]) / 40)
+    assert metadata["area"] == pytest.approx(-7 * 19 / 40**2)
+    assert metadata["perimeter"] == pytest.approx(2 * (7 + 19) / 40)
+    assert metadata["centroid"] == pytest.approx([7.5 / 40, 19.5 / 40])
+
+
+def test_rings_below_min_area_are_dropped():
+    mask = _nested_islands()
+    traced = trace_contours(mask)
+    areas = sorted(
+        abs(ring["metadata"]["area"]) * 40**2
+        for shape in simplify_contours(traced).layer_shapes
+        for ring in [shape, *shape["holes"]]
+    )
+    # The separate island (3 x 6), the inner lake (traced around it, 5 x 5 w/ its
+    # corners cut) and the inner island (11 x 11)
+    assert areas[:3] == pytest.approx([18, 23, 121])
+
+    def _rings(min_area):
+        return sorted(
+            (shape["metadata"]["role"], [h["metadata"]["role"] for h in shape["holes"]])
+            for shape in simplify_contours(
+                traced, min_area=min_area / 40**2
+            ).layer_shapes
+        )
+
+    assert _rings(0) == [("outer", []), ("outer", ["hole"]), ("outer", ["hole"])]
+    # The separate island is dropped
+    assert _rings(20) == [("outer", ["hole"]), ("outer", ["hole"])]
+    # Then the inner lake, from its island
+    assert _rings(100) == [("outer", []), ("outer", ["hole"])]
+    # The inner island is dropped w/ any holes of its own
+    assert _rings(200) == [("outer", ["hole"])]
@@ -0,0 +1,68 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import pickle
+
+import numpy as np
+import pytest
+
+from common.shared_grid import SharedGrid, as_array, share_grid
+
+_RNG = np.random.default_rng(0)
+
+
+def _sum_rows(args):
+    grid, r0, r1 = args
+    return as_array(grid)[r0:r1].sum(axis=0)
+
+
+def test_attach_is_a_read_only_view():
+    grid = _RNG.normal(size=(30, 40)).astype(np.float32)
+    with share_grid(grid) as shared:
+        view = shared.attach()
+        np.testing.assert_array_equal(view, grid)
+        assert view.dtype == grid.dtype
+        assert not view.flags.writeable
+        with pytest.raises(ValueError):
+            view[0, 0] = 1
+        # Repeated attaches map the same segment
+        assert np.shares_memory(shared.attach(), view)
+        # The handle is small, whatever the size of the grid
+        assert len(pickle.dumps(shared)) < 200
+
+
+def test_non_contiguous_and_empty_grids():
+    grid = _RNG.integers(0, 255, size=(20, 30), dtype=np.uint8)[::2, ::3]
+    with share_grid(grid) as shared:
+        np.testing.assert_array_equal(as_array(shared), grid)
+    with share_grid(np.zeros((0, 5), dtype=bool)) as shared:
+        assert as_array(shared).shape == (0, 5)
+
+
+def test_as_array_passes_arrays_through():
+    grid = np.zeros((2, 2))
+    assert as_array(grid) is grid
+
+
+def test_workers_read_the_shared_grid():
+    grid = _RNG.normal(size=(64, 16))
+    with share_grid(grid) as shared:
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            sums = list(
+                executor.map(_sum_rows, [(shared, r, r + 16) for r in range(0, 64, 16)])
+            )
+    np.testing.assert_allclose(sum(sums), grid.sum(axis=0))
+
+
+def test_unlinked_on_exit():
+    with share_grid(np.ones((4, 4))) as shared:
+        shared.attach()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=shared.name)
+
+
+def test_unlinked_on_error():
+    with pytest.raises(RuntimeError):
+        with share_grid(np.ones((4, 4))) as shared:
+            raise RuntimeError()
+    with pytest.raises(FileNotFoundError):
+        SharedGrid(name=shared.name, shape=(4, 4), dtype="<f8").attach()
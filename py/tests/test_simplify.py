@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+from shapely import geometry
+
+from common.simplify import SIMPLIFY_METHODS, ring_properties, simplify_rings
+
+_RNG = np.random.default_rng(0)
+
+
+def _offsets(rings):
+    return np.concatenate(([0], np.cumsum([len(r) for r in rings])))
+
+
+def _split(points, offsets):
+    return np.split(points, offsets[1:-1])
+
+
+def _noisy_circle(n=200, radius=10.0, noise=0.05, center=(0, 0)):
+    angles = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    r = radius + _RNG.normal(0, noise, n)
+    return np.stack(
+        (center[0] + r * np.cos(angles), center[1] + r * np.sin(angles)), axis=1
+    )
+
+
+@pytest.mark.parametrize("method", sorted(SIMPLIFY_METHODS))
+def test_simplify_within_tolerance(method):
+    rings = [_noisy_circle(), _noisy_circle(50, 3, center=(30, 0))]
+    points, offsets = simplify_rings(
+        np.concatenate(rings), _offsets(rings), 0.2, method
+    )
+    assert len(offsets) == 3
+    for ring, simplified in zip(rings, _split(points, offsets)):
+        assert 3 <= len(simplified) < len(ring)
+        # Simplified vertices are a subset of the ring's
+        assert (simplified[:, None] == ring[None]).all(axis=-1).any(axis=1).all()
+        # And stay close to it
+        distance = geometry.LinearRing(ring).hausdorff_distance(
+            geometry.LinearRing(simplified)
+        )
+        assert distance < (0.2 if method == "douglas_peucker" else 1.0)
+
+
+def test_douglas_peucker_matches_shapely():
+    ring = _noisy_circle(noise=0.3)
+    points, _ = simplify_rings(ring, [0, len(ring)], 0.5, preserve_topology=False)
+    closed = np.concatenate((ring, ring[:1]))
+    expected = np.asarray(
+        geometry.LineString(closed).simplify(0.5, preserve_topology=False).coords
+    )[:-1]
+    np.testing.assert_array_equal(points, expected)
+
+
+@pytest.mark.parametrize("method", sorted(SIMPLIFY_METHODS))
+def test_rings_keep_a_triangle(method):
+    # A tiny ring collapses below the tolerance, but is never simplified below a triangle
+    ring = _noisy_circle(20, 0.1, noise=0.001)
+    points, offsets = simplify_rings(ring, [0, len(ring)], 1.0, method)
+    assert np.diff(offsets).tolist() == [3]
+    points, offsets = simplify_rings(
+        ring, [0, len(ring)], 1.0, method, preserve_topology=False
+    )
+    assert np.diff(offsets)[0] < 3
+
+
+def test_zero_tolerance_is_identity():
+    ring = _noisy_circle()
+    points, offsets = simplify_rings(ring, [0, len(ring)], 0)
+    np.testing.assert_array_equal(points, ring)
+    assert offsets.tolist() == [0, len(ring)]
+
+
+def test_self_intersection_is_retried():
+    ring = np.array(
+        [
+            [-5.2, 3.6],
+            [-6.2, 1.6],
+            [-2.1, -1.1],
+            [-5.8, -3.2],
+            [-0.3, -9.7],
+            [0.4, -1.4],
+            [3.2, -4.7],
+            [2.0, -2.6],
+        ]
+    )
+    assert geometry.LinearRing(ring).is_simple
+    points, _ = simplify_rings(ring, [0, len(ring)], 1.0, preserve_topology=False)
+    assert not geometry.LinearRing(points).is_simple
+    points, _ = simplify_rings(ring, [0, len(ring)], 1.0)
+    assert geometry.LinearRing(points).is_simple
+
+
+def _nested(points, offsets):
+    outer, hole = _split(points, offsets)
+    return geometry.Polygon(outer).contains(geometry.LinearRing(hole))
+
+
+def test_hole_crossing_its_parent_is_restored():
+    # A spike of the exterior reaching into a shallow notch of a hole. Simplified, the
+    # notch is removed and the hole crosses the spike.
+    outer = np.array(
+        [[0, 0], [5, 0.1], [10, 0], [10, 10], [5.1, 10], [5, 8.7], [4.9, 10], [0, 10]],
+        dtype=np.float64,
+    )
+    hole = np.array(
+        [[4, 9], [4, 8], [6, 8], [6, 9], [5.2, 9], [5.2, 8.6], [4.8, 8.6], [4.8, 9]],
+        dtype=np.float64,
+    )
+    rings = [outer, hole]
+    assert _nested(np.concatenate(rings), _offsets(rings))
+    points, offsets = simplify_rings(np.concatenate(rings), _offsets(rings), 0.5)
+    assert not _nested(points, offsets)
+
+    points, offsets = simplify_rings(
+        np.concatenate(rings), _offsets(rings), 0.5, ring_parents=[-1, 0]
+    )
+    assert _nested(points, offsets)
+    simplified_outer, restored_hole = _split(points, offsets)
+    # Only the hole is restored
+    assert len(simplified_outer) < len(outer)
+    np.testing.assert_array_equal(restored_hole, hole)
+
+
+def test_hole_escaping_its_parent_restores_both():
+    # A hole in a shallow bump of the exterior, which simplifying the exterior removes
+    outer = np.array(
+        [[0, 0], [10, 0], [10, 10], [6, 10], [6, 10.4], [4, 10.4], [4, 10], [0, 10]],
+        dtype=np.float64,
+    )
+    hole = np.array([[4.8, 10.1], [5.2, 10.1], [5.2, 10.3], [4.8, 10.3]])
+    rings = [outer, hole]
+    points, offsets = simplify_rings(np.concatenate(rings), _offsets(rings), 0.5)
+    assert not _nested(points, offsets)
+
+    points, offsets = simplify_rings(
+        np.concatenate(rings), _offsets(rings), 0.5, ring_parents=[-1, 0]
+    )
+    assert _nested(points, offsets)
+    np.testing.assert_array_equal(points, np.concatenate(rings))
+
+
+def test_ring_properties():
+    # Counter-clockwise unit square and a clockwise triangle
+    rings = [
+        np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float64),
+        np.array([[2, 0], [2, 3], [4, 0]], dtype=np.float64),
+    ]
+    properties = ring_properties(np.concatenate(rings), _offsets(rings))
+    np.testing.assert_allclose(properties["area"], [1, -3])
+    np.testing.assert_allclose(properties["perimeter"], [4, 3 + 2 + np.hypot(2, 3)])
+    np.testing.assert_allclose(properties["bbox"], [[0, 0, 1, 1], [2, 0, 4, 3]])
+    np.testing.assert_allclose(properties["centroid"], [[0.5, 0.5], [8 / 3, 1]])
+    assert properties["vertex_count"].tolist() == [4, 3]
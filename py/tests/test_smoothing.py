@@ -0,0 +1,190 @@
+import cv2
+import numpy as np
+import pytest
+
+from common.smoothing import (
+    FIELD_SMOOTHING_METHODS,
+    SMOOTHING_METHODS,
+    remove_specks,
+    smooth_layer_count_field,
+    smooth_mask,
+    smoothing_halo,
+)
+
+_RNG = np.random.default_rng(0)
+
+
+def _blob_mask(shape=(64, 64)):
+    # A disc w/ a ragged (noisy) edge and a lone speck in the corner
+    rows, cols = np.mgrid[: shape[0], : shape[1]]
+    radius = np.hypot(rows - shape[0] / 2, cols - shape[1] / 2)
+    mask = radius + _RNG.normal(0, 1.5, size=shape) < min(shape) / 3
+    mask[3, 3] = True
+    return mask
+
+
+def _edge_cells(mask):
+    return np.count_nonzero(np.diff(mask, axis=0)) + np.count_nonzero(
+        np.diff(mask, axis=1)
+    )
+
+
+def _baseline_smooth(mask, scale_up_factor=4):
+    # The original smoother: 15 7x7 median passes at the upsampled resolution
+    wip = mask.astype(np.uint8) * 255
+    for _ in range(scale_up_factor // 2):
+        wip = cv2.pyrUp(wip)
+    for _ in range(15):
+        wip = cv2.medianBlur(wip, 7)
+    for _ in range(scale_up_factor // 2):
+        wip = cv2.pyrDown(wip)
+    return wip >= 128
+
+
+def test_median_default_matches_baseline():
+    mask = _blob_mask()
+    np.testing.assert_array_equal(smooth_mask(mask), _baseline_smooth(mask))
+
+
+@pytest.mark.parametrize("method", sorted(SMOOTHING_METHODS))
+def test_methods_smooth(method):
+    mask = _blob_mask()
+    smoothed = smooth_mask(mask, method=method)
+    assert smoothed.shape == mask.shape and smoothed.dtype == bool
+    # The speck is removed, the disc is kept (and its ragged edge evened out)
+    assert not smoothed[3, 3]
+    assert smoothed[32, 32]
+    assert abs(int(smoothed.sum()) - int(mask.sum())) < 0.1 * mask.sum()
+    assert _edge_cells(smoothed) < _edge_cells(mask)
+
+
+@pytest.mark.parametrize("method", ["gaussian", "morphological", "sdf"])
+def test_strength(method):
+    # strength is a size in cells: a stronger smoothing removes a larger feature
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[30:34, 30:34] = True
+    assert smooth_mask(mask, method=method, strength=0.5).any()
+    assert not smooth_mask(mask, method=method, strength=4).any()
+
+
+def test_empty_and_full():
+    for mask in [np.zeros((20, 30), dtype=bool), np.ones((20, 30), dtype=bool)]:
+        for method in SMOOTHING_METHODS:
+            np.testing.assert_array_equal(smooth_mask(mask, method=method), mask)
+
+
+def _layer_counts(shape=(64, 64), n_layers=4):
+    # Nested layers: the number of (noisy) depth thresholds each cell is deeper than
+    rows, cols = np.mgrid[: shape[0], : shape[1]]
+    depth = np.hypot(rows - shape[0] / 2, cols - shape[1] / 2) + _RNG.normal(
+        0, 1.5, size=shape
+    )
+    return (
+        (depth[..., None] < np.linspace(8, 28, n_layers)).sum(axis=-1).astype(np.uint8)
+    )
+
+
+@pytest.mark.parametrize("method", FIELD_SMOOTHING_METHODS)
+def test_single_layer_field_matches_smooth_mask(method):
+    mask = _blob_mask()
+    np.testing.assert_array_equal(
+        smooth_layer_count_field(mask.astype(np.uint8), 1, method=method) > 0,
+        smooth_mask(mask, method=method),
+    )
+
+
+@pytest.mark.parametrize("method", FIELD_SMOOTHING_METHODS)
+def test_field_layers_stay_nested(method):
+    n_layers = 4
+    layer_counts = _layer_counts(n_layers=n_layers)
+    counts = smooth_layer_count_field(layer_counts, n_layers, method=method)
+    assert counts.dtype == np.uint8 and counts.max() <= n_layers
+    for k in range(n_layers):
+        # Layer k (counts > k) is nested in the layer above it, and its edge moves by
+        # about a cell from the raw layer's
+        layer = counts > k
+        if k:
+            assert not (layer & ~(counts > k - 1)).any()
+        raw = layer_counts > k
+        assert layer[32, 32]
+        assert (layer != raw).sum() <= 2 * _edge_cells(raw)
+
+
+def test_field_rejects_sdf():
+    with pytest.raises(ValueError):
+        smooth_layer_count_field(np.zeros((8, 8), dtype=np.uint8), 1, method="sdf")
+
+
+@pytest.mark.parametrize("method", FIELD_SMOOTHING_METHODS)
+@pytest.mark.parametrize("tile_size", [16, 23, 50])
+def test_tiled_matches_untiled(method, tile_size):
+    # Odd tile sizes leave partial tiles at the edges
+    mask = _blob_mask((70, 90))
+    np.testing.assert_array_equal(
+        smooth_mask(mask, method=method, tile_size=tile_size),
+        smooth_mask(mask, method=method),
+    )
+
+
+@pytest.mark.parametrize("scale_up_factor", [2, 4])
+def test_tiled_matches_untiled_across_workers(scale_up_factor):
+    layer_counts = _layer_counts((80, 80))
+    expected = smooth_layer_count_field(
+        layer_counts, 4, scale_up_factor=scale_up_factor, method="gaussian"
+    )
+    tiled = smooth_layer_count_field(
+        layer_counts,
+        4,
+        scale_up_factor=scale_up_factor,
+        method="gaussian",
+        tile_size=24,
+        workers=2,
+    )
+    np.testing.assert_array_equal(tiled, expected)
+
+
+def test_sdf_is_not_tiled():
+    assert smoothing_halo(4, "sdf") is None
+    # Only grids larger than a tile are tiled
+    mask = _blob_mask((40, 40))
+    np.testing.assert_array_equal(
+        smooth_mask(mask, method="sdf", tile_size=64), smooth_mask(mask, method="sdf")
+    )
+    with pytest.raises(ValueError):
+        smooth_mask(mask, method="sdf", tile_size=16)
+
+
+def test_remove_specks():
+    mask = np.zeros((20, 20), dtype=bool)
+    # An island w/ a 1-cell and a 4-cell hole
+    mask[2:12, 2:12] = True
+    mask[4, 4] = False
+    mask[7:9, 7:9] = False
+    # A 2-cell island, and a 3-cell diagonal (one island under 8-connectivity)
+    mask[15, 15:17] = True
+    mask[17, 2] = mask[18, 3] = mask[19, 4] = True
+    # A notch open to the background is not a hole
+    mask[2, 6] = False
+
+    cleaned = remove_specks(mask, min_island_cells=3)
+    expected = mask.copy()
+    expected[15, 15:17] = False
+    expected[4, 4] = True
+    np.testing.assert_array_equal(cleaned, expected)
+
+    # Islands and holes have their own thresholds
+    cleaned = remove_specks(mask, min_island_cells=1, min_hole_cells=5)
+    expected = mask.copy()
+    expected[4, 4] = True
+    expected[7:9, 7:9] = True
+    np.testing.assert_array_equal(cleaned, expected)
+
+
+def test_remove_specks_keeps_border_background():
+    # Background touching the border is never filled, however small
+    mask = np.ones((10, 10), dtype=bool)
+    mask[0, 5] = False
+    mask[5, 5] = False
+    expected = np.ones((10, 10), dtype=bool)
+    expected[0, 5] = False
+    np.testing.assert_array_equal(remove_specks(mask, 4), expected)
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from common import quantize
+from common.quantize import export_quantize_results, quantize_depth_grid
+from common.stage_cache import (
+    StageCache,
+    file_identity,
+    lazy_stage,
+    run_stage,
+    stage_key,
+)
+
+
+def test_stage_key():
+    key = stage_key("smooth", {"a": 1, "b": 2.5}, "upstream")
+    # Independent of the order of params, and sensitive to each part
+    assert key == stage_key("smooth", {"b": 2.5, "a": 1}, "upstream")
+    assert key != stage_key("smooth", {"a": 1, "b": 2.6}, "upstream")
+    assert key != stage_key("contour", {"a": 1, "b": 2.5}, "upstream")
+    assert key != stage_key("smooth", {"a": 1, "b": 2.5}, "other")
+    assert key != stage_key("smooth", {"a": 1, "b": 2.5}, "upstream", None)
+
+
+def test_file_identity(tmp_path):
+    fpath = tmp_path / "grid.asc"
+    fpath.write_text("data")
+    identity = file_identity(fpath)
+    assert identity == file_identity(fpath)
+    fpath.write_text("modified data")
+    assert file_identity(fpath) != identity
+
+
+def test_get_put(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    assert cache.get("key") == (False, None)
+    value = {"grid": np.arange(6).reshape(2, 3), "name": "x"}
+    cache.put("key", value)
+    hit, cached = cache.get("key")
+    assert hit
+    np.testing.assert_array_equal(cached["grid"], value["grid"])
+    # A shared cache, entries written by one are read by another
+    assert StageCache(tmp_path / "cache").get("key")[0]
+    assert not list((tmp_path / "cache").glob("*.tmp"))
+
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    cache = StageCache(tmp_path)
+    cache.put("key", np.zeros(100))
+    path = tmp_path / "key.pkl"
+    path.write_bytes(path.read_bytes()[:10])
+    assert cache.get("key") == (False, None)
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    entry = np.zeros(1000)
+    cache = StageCache(tmp_path, max_bytes=1)
+    cache.put("a", entry)
+    entry_bytes = (tmp_path / "a.pkl").stat().st_size
+    cache = StageCache(tmp_path, max_bytes=int(2.5 * entry_bytes))
+    cache.put("b", entry)
+    # Entry mtimes record their last use
+    past = time.time() - 100
+    os.utime(tmp_path / "a.pkl", (past, past))
+    os.utime(tmp_path / "b.pkl", (past - 10, past - 10))
+    cache.get("b")
+    cache.put("c", entry)
+    assert cache.get("a")[0] is False
+    assert cache.get("b")[0] and cache.get("c")[0]
+    # The entry just written is kept, even if larger than the cache
+    StageCache(tmp_path, max_bytes=1).put("d", entry)
+    assert [p.name for p in tmp_path.glob("*.pkl")] == ["d.pkl"]
+
+
+def test_run_stage(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert run_stage(None, "key", compute) == (1, False)
+    assert run_stage(None, "key", compute) == (2, False)
+    cache = StageCache(tmp_path)
+    assert run_stage(cache, "key", compute) == (3, False)
+    assert run_stage(cache, "key", compute) == (3, True)
+
+
+def test_lazy_stage(tmp_path):
+    cache = StageCache(tmp_path)
+    calls = []
+    records = []
+
+    def _stages():
+        def _upstream():
+            calls.append("upstream")
+            time.sleep(0.05)
+            return 2
+
+        def _downstream(x):
+            calls.append("downstream")
+            return x * 3
+
+        upstream = lazy_stage(
+            cache,
+            "upstream",
+            _upstream,
+            record=lambda s, hit: records.append(("upstream", s, hit)),
+        )
+        return lazy_stage(
+            cache,
+            "downstream",
+            _downstream,
+            upstream,
+            record=lambda s, hit: records.append(("downstream", s, hit)),
+        )
+
+    downstream = _stages()
+    # Nothing is computed until used, and only once
+    assert calls == []
+    assert downstream() == 6 and downstream() == 6
+    assert calls == ["upstream", "downstream"]
+    # Time spent upstream isn't counted downstream
+    (_, upstream_seconds, _), (_, downstream_seconds, _) = records
+    assert upstream_seconds >= 0.05 > downstream_seconds
+
+    # A hit skips everything upstream of it
+    calls.clear()
+    records.clear()
+    assert _stages()() == 6
+    assert calls == []
+    assert [(name, hit) for name, _, hit in records] == [("downstream", True)]
+
+
+def test_export_render_time_excludes_stages(tmp_path, monkeypatch):
+    # Artifacts rendered from a (slow) stage don't count its time as theirs
+    def _slow_smooth(layer_mask, **kwargs):
+        time.sleep(0.2)
+        return layer_mask
+
+    monkeypatch.setattr(quantize, "smooth_layer_mask", _slow_smooth)
+    rows, cols = np.mgrid[:40, :50]
+    depth_grid = (np.hypot(rows - 20, cols - 25) * 0.5).astype(np.float32)
+    export_quantize_results(
+        quantize_depth_grid(depth_grid, levels=2),
+        tmp_path,
+        artifacts=("layer_mask_smoothed", "contours_json"),
+        writer_threads=0,
+    )
+    with open(tmp_path / "manifest.json", "r") as f:
+        manifest = json.load(f)
+    (smooth,) = [s for s in manifest["stages"] if s["stage"] == "smooth"]
+    assert smooth["seconds"] >= 0.2
+    for artifact in manifest["artifacts"]:
+        assert artifact["seconds"] < 0.1
+    assert manifest["total_seconds"] < 0.2 + 0.2
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from common.data_helpers import MaskedDepthGrid, masked_grid_stats
+from common.quantize import quantize_depth_grid
+from common.sweep import SweepConfig, sweep_quantize
+from common.valid_mask import ValidMask
+
+_RNG = np.random.default_rng(0)
+
+
+def _masked_depth_grid(with_mask):
+    # cm resolution, ie: many cells exactly on (or around) levels and their thresholds
+    depth_grid = np.round(_RNG.uniform(0, 40, size=(60, 80)), 2).astype(np.float32)
+    if not with_mask:
+        return MaskedDepthGrid(depth_grid)
+    valid = _RNG.random(depth_grid.shape) > 0.2
+    depth_grid[~valid] = 0
+    return MaskedDepthGrid(depth_grid, valid_mask=ValidMask.from_bool(valid))
+
+
+@pytest.mark.parametrize("with_mask", [False, True])
+@pytest.mark.parametrize("level_strategy", ["linspace", "quantiles"])
+def test_cells_per_layer_match_layer_masks(with_mask, level_strategy):
+    masked_depth_grid = _masked_depth_grid(with_mask)
+    configs = [
+        SweepConfig(
+            levels=levels, quantize_depth_start_m=start, level_strategy=level_strategy
+        )
+        for levels in [2, 5, 9]
+        for start in [0, 1]
+    ]
+    # Levels from the same stats (and so the same max depth) as the sweep
+    stats = masked_grid_stats(masked_depth_grid)
+    results = sweep_quantize(masked_depth_grid, configs, cell_size_m=2.5, stats=stats)
+    valid = (
+        masked_depth_grid.valid_mask.unpack()
+        if masked_depth_grid.valid_mask is not None
+        else np.ones(masked_depth_grid.depth_grid.shape, dtype=bool)
+    )
+    for config, result in zip(configs, results):
+        quant = quantize_depth_grid(
+            masked_depth_grid.depth_grid,
+            levels=config.levels,
+            quantize_depth_start_m=config.quantize_depth_start_m,
+            valid_mask=masked_depth_grid.valid_mask,
+            level_strategy=config.level_strategy,
+            stats=stats,
+        )
+        expected = [
+            int((quant.layer_mask(layer_idx, config.force_first_layer) & valid).sum())
+            for layer_idx in range(config.levels - 1)
+        ]
+        assert result.summary.cells_per_layer == expected
+        assert result.summary.quantized_depth_values == pytest.approx(
+            quant.quantized_depth_values.tolist()
+        )
+
+
+def test_area_per_layer():
+    masked_depth_grid = _masked_depth_grid(False)
+    (result,) = sweep_quantize(
+        masked_depth_grid, [SweepConfig(levels=5, quantize_depth_start_m=1)], 2.5
+    )
+    assert result.summary.area_per_layer_m2 == pytest.approx(
+        [cells * 2.5**2 for cells in result.summary.cells_per_layer]
+    )
+
+
+def test_count_contours_and_thumbnail():
+    depth_grid = np.zeros((40, 40), dtype=np.float32)
+    depth_grid[5:15, 5:15] = 10
+    depth_grid[20:35, 20:35] = 10
+    # A hole in the second island
+    depth_grid[25:30, 25:30] = 0
+    (result,) = sweep_quantize(
+        MaskedDepthGrid(depth_grid),
+        [SweepConfig(levels=2, quantize_depth_start_m=0)],
+        cell_size_m=1,
+        count_contours=True,
+        thumbnail_size=20,
+    )
+    assert result.summary.contours_per_layer == [2]
+    assert result.summary.holes_per_layer == [1]
+    assert result.layer_count_thumbnail.shape == (20, 20)
+    np.testing.assert_array_equal(
+        result.layer_count_thumbnail, (depth_grid[::2, ::2] > 0).astype(np.uint8)
+    )
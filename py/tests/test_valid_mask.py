@@ -0,0 +1,43 @@
+import numpy as np
+
+from common import valid_mask as valid_mask_module
+from common.valid_mask import ValidMask
+
+_RNG = np.random.default_rng(0)
+
+
+def test_from_nodata(monkeypatch):
+    # Packed by blocks of rows
+    monkeypatch.setattr(valid_mask_module, "_PACK_BLOCK_ROWS", 3)
+    grid = _RNG.normal(size=(10, 13)).astype(np.float32)
+    grid[2, 3] = -9999
+    grid[7, 12] = np.nan
+    mask = ValidMask.from_nodata(grid, -9999)
+    expected = np.ones(grid.shape, dtype=bool)
+    expected[2, 3] = expected[7, 12] = False
+    np.testing.assert_array_equal(mask.unpack(), expected)
+    assert mask.count() == expected.sum()
+
+
+def test_all_valid_is_none():
+    assert ValidMask.from_nodata(np.ones((4, 4)), -9999) is None
+    assert ValidMask.from_nodata(np.ones((4, 4)), None) is None
+
+
+def test_unpack_rows_crop_and_reductions():
+    valid = _RNG.random((20, 19)) > 0.7
+    valid[5] = False
+    valid[:, 4] = False
+    mask = ValidMask.from_bool(valid)
+    np.testing.assert_array_equal(mask.unpack(3, 9), valid[3:9])
+    np.testing.assert_array_equal(mask.crop(2, 15, 3, 17).unpack(), valid[2:15, 3:17])
+    np.testing.assert_array_equal(mask.rows_any(), valid.any(axis=1))
+    np.testing.assert_array_equal(mask.cols_any(), valid.any(axis=0))
+    assert mask.count() == valid.sum()
+
+
+def test_fill_invalid():
+    valid = _RNG.random((6, 9)) > 0.5
+    grid = np.ones(valid.shape, dtype=np.float32)
+    ValidMask.from_bool(valid).fill_invalid(grid, 0)
+    np.testing.assert_array_equal(grid, valid)